@@ -244,34 +244,29 @@ class Normalizable(MeasurementTypeable):
         else:
             return 1, self.unit
 
+    @property
+    def norm_conversion(self):
+        """ Conversion to the normalized unit, see MeasurementType.norm_conversion.
+
+        :return: tuple (factor, unit), i.e., pre-factor and resulting unit
+        """
+        substance = getattr(self, "substance", None)
+        substance_mass = substance.mass if substance else None
+        return self.measurement_type.norm_conversion(self.unit, substance_mass=substance_mass)
+
     def normalize(self):
         """ Normalizes the units.
 
         Units are brought to default units.
         Values are changed according to the conversion factor.
         If possible removes substance dimension (mole -> g) via molecular weight.
+        The conversion factor is resolved once per (measurement type, unit, substance mass).
 
         :return:
         """
-
-        factor, unit = self.remove_substance_dimension()
-
-        # remove substance unit
-
-        if unit and self.unit:
-            if ureg(unit) != ureg(self.unit):
-                for key, value in self.norm_fields.items():
-                    if value is not None:
-                        setattr(self, key, value * factor)
-                self.unit = unit
-
-            # else:
-            #    self.unit = str(ureg(self.unit).u)
-
-        # normalization
-        if not self.is_norm:
+        factor, unit = self.norm_conversion
+        if unit != self.unit or factor != 1:
             for key, value in self.norm_fields.items():
-                if not value is None:
-                    setattr(self, key, self.measurement_type.normalize(value, self.unit).magnitude)
-
-            self.unit = str(self.measurement_type.norm_unit(self.unit))
+                if value is not None:
+                    setattr(self, key, value * factor)
+            self.unit = unit
@@ -0,0 +1,199 @@
+"""
+Compressed bitmaps for sets of ids.
+
+The layout follows roaring bitmaps: ids are partitioned by their upper 16 bits into
+containers. A container stores the lower 16 bits either as a sorted array (sparse,
+at most 4096 values) or as a bitmap of 2^16 bits (dense, 8 KiB).
+
+Serialized format (little endian):
+    uint32                       number of containers
+    n * (uint16, uint8, uint32)  key, container type and cardinality per container
+    payloads                     array containers: cardinality * uint16,
+                                 bitmap containers: 8192 bytes
+Payloads are only decoded when accessed, so a slice of the ids only decodes
+the containers it overlaps.
+"""
+from typing import Iterable, List
+
+import numpy as np
+
+ARRAY = 0
+BITMAP = 1
+
+# containers with more values are stored as bitmap
+ARRAY_MAX_SIZE = 4096
+BITMAP_BYTES = 2 ** 16 // 8
+
+HEADER_DTYPE = np.dtype([("key", "<u2"), ("type", "u1"), ("cardinality", "<u4")])
+
+
+def _container(values: np.ndarray):
+    """ Container for sorted unique uint16 values. """
+    if len(values) > ARRAY_MAX_SIZE:
+        bits = np.zeros(2 ** 16, dtype=bool)
+        bits[values] = True
+        return BITMAP, np.packbits(bits, bitorder="little")
+    return ARRAY, values.astype("<u2")
+
+
+def _values(ctype: int, payload: np.ndarray) -> np.ndarray:
+    """ Sorted uint16 values of a container. """
+    if ctype == BITMAP:
+        return np.flatnonzero(np.unpackbits(payload, bitorder="little")).astype(np.uint16)
+    return payload
+
+
+class Bitmap(object):
+    """ Immutable set of non-negative integer ids (< 2^32). """
+
+    def __init__(self, keys=None, types=None, cardinalities=None, payloads=None):
+        self.keys = np.asarray([] if keys is None else keys, dtype=np.uint16)
+        self.types = np.asarray([] if types is None else types, dtype=np.uint8)
+        self.cardinalities = np.asarray([] if cardinalities is None else cardinalities, dtype=np.int64)
+        self.payloads = [] if payloads is None else payloads
+        # first position of every container in the sorted ids
+        self.offsets = np.concatenate([[0], np.cumsum(self.cardinalities)])
+
+    @classmethod
+    def from_ids(cls, ids: Iterable[int]) -> "Bitmap":
+        ids = np.unique(np.fromiter(ids, dtype=np.int64))
+        if len(ids) and (ids[0] < 0 or ids[-1] >= 2 ** 32):
+            raise ValueError("Bitmap ids have to be in the range [0, 2^32).")
+        return cls._from_sorted(ids.astype(np.uint32))
+
+    @classmethod
+    def _from_sorted(cls, ids: np.ndarray) -> "Bitmap":
+        high = (ids >> 16).astype(np.uint16)
+        low = (ids & 0xFFFF).astype(np.uint16)
+        keys, starts, cardinalities = np.unique(high, return_index=True, return_counts=True)
+        types = []
+        payloads = []
+        for start, cardinality in zip(starts, cardinalities):
+            ctype, payload = _container(low[start:start + cardinality])
+            types.append(ctype)
+            payloads.append(payload)
+        return cls(keys, types, cardinalities, payloads)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Bitmap":
+        data = memoryview(data)
+        n = int(np.frombuffer(data[:4], dtype="<u4")[0])
+        header = np.frombuffer(data[4:4 + n * HEADER_DTYPE.itemsize], dtype=HEADER_DTYPE)
+        sizes = np.where(header["type"] == BITMAP, BITMAP_BYTES, header["cardinality"].astype(np.int64) * 2)
+        position = 4 + n * HEADER_DTYPE.itemsize
+        payloads = []
+        for ctype, size in zip(header["type"], sizes):
+            chunk = data[position:position + size]
+            payloads.append(np.frombuffer(chunk, dtype=np.uint8 if ctype == BITMAP else "<u2"))
+            position += size
+        return cls(header["key"], header["type"], header["cardinality"], payloads)
+
+    def to_bytes(self) -> bytes:
+        header = np.empty(len(self.keys), dtype=HEADER_DTYPE)
+        header["key"] = self.keys
+        header["type"] = self.types
+        header["cardinality"] = self.cardinalities
+        return b"".join([
+            np.uint32(len(self.keys)).astype("<u4").tobytes(),
+            header.tobytes(),
+            *(payload.tobytes() for payload in self.payloads)
+        ])
+
+    def _container_ids(self, index: int) -> np.ndarray:
+        values = _values(self.types[index], self.payloads[index])
+        return (np.uint32(self.keys[index]) << np.uint32(16)) | values.astype(np.uint32)
+
+    def to_array(self) -> np.ndarray:
+        """ Sorted ids. """
+        if not len(self.keys):
+            return np.empty(0, dtype=np.uint32)
+        return np.concatenate([self._container_ids(k) for k in range(len(self.keys))])
+
+    def to_list(self) -> List[int]:
+        return self.to_array().tolist()
+
+    def slice(self, start: int = None, stop: int = None) -> np.ndarray:
+        """ Sorted ids[start:stop], only the overlapping containers are decoded. """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return np.empty(0, dtype=np.uint32)
+        first = np.searchsorted(self.offsets, start, side="right") - 1
+        last = np.searchsorted(self.offsets, stop, side="left")
+        ids = np.concatenate([self._container_ids(k) for k in range(first, last)])
+        offset = self.offsets[first]
+        return ids[start - offset:stop - offset]
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __iter__(self):
+        for k in range(len(self.keys)):
+            yield from self._container_ids(k).tolist()
+
+    def __contains__(self, pk):
+        if pk < 0 or pk >= 2 ** 32:
+            return False
+        index = np.searchsorted(self.keys, pk >> 16)
+        if index == len(self.keys) or self.keys[index] != pk >> 16:
+            return False
+        low = pk & 0xFFFF
+        if self.types[index] == BITMAP:
+            return bool(self.payloads[index][low >> 3] >> (low & 7) & 1)
+        values = self.payloads[index]
+        position = np.searchsorted(values, low)
+        return position < len(values) and values[position] == low
+
+    def _combine(self, other: "Bitmap", keys: np.ndarray, operation) -> "Bitmap":
+        index_self = {key: k for k, key in enumerate(self.keys.tolist())}
+        index_other = {key: k for k, key in enumerate(other.keys.tolist())}
+        result_keys, types, cardinalities, payloads = [], [], [], []
+        for key in keys.tolist():
+            a, b = index_self.get(key), index_other.get(key)
+            if a is None or b is None:
+                # only in one of the bitmaps (union)
+                bitmap, k = (self, a) if b is None else (other, b)
+                ctype, payload, cardinality = bitmap.types[k], bitmap.payloads[k], bitmap.cardinalities[k]
+            elif self.types[a] == BITMAP and other.types[b] == BITMAP:
+                bits = operation.bits(self.payloads[a], other.payloads[b])
+                values = np.flatnonzero(np.unpackbits(bits, bitorder="little")).astype(np.uint16)
+                ctype, payload = _container(values)
+                cardinality = len(values)
+            else:
+                values = operation.values(_values(self.types[a], self.payloads[a]),
+                                          _values(other.types[b], other.payloads[b]))
+                ctype, payload = _container(values)
+                cardinality = len(values)
+            if cardinality:
+                result_keys.append(key)
+                types.append(ctype)
+                payloads.append(payload)
+                cardinalities.append(cardinality)
+        return Bitmap(result_keys, types, cardinalities, payloads)
+
+    def __and__(self, other: "Bitmap") -> "Bitmap":
+        return self._combine(other, np.intersect1d(self.keys, other.keys), _And)
+
+    def __or__(self, other: "Bitmap") -> "Bitmap":
+        return self._combine(other, np.union1d(self.keys, other.keys), _Or)
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and np.array_equal(self.to_array(), other.to_array())
+
+    def __repr__(self):
+        return f"<Bitmap: {len(self)} ids in {len(self.keys)} containers>"
+
+
+class _And(object):
+    bits = staticmethod(np.bitwise_and)
+
+    @staticmethod
+    def values(a, b):
+        return np.intersect1d(a, b, assume_unique=True)
+
+
+class _Or(object):
+    bits = staticmethod(np.bitwise_or)
+
+    @staticmethod
+    def values(a, b):
+        return np.union1d(a, b)
@@ -0,0 +1,107 @@
+"""
+Compact columnar storage of merged timecourses, i.e. dictionaries of column -> value.
+
+Numeric arrays (time, value, mean, ..., pks) are stored as typed arrays (float64, int64),
+all other values as json in which tuples are tagged to restore them. The blob is zlib
+compressed.
+
+Serialized format (before compression, little endian):
+    uint32      length of the header
+    header      json, column -> {"kind": "array", ...} or {"kind": "json", "value": ...}
+    payloads    concatenated arrays
+"""
+import json
+import zlib
+from typing import Dict
+
+import numpy as np
+
+TUPLE_TAG = "__tuple__"
+
+
+def _is_float(value) -> bool:
+    return isinstance(value, float)
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _array_dtype(value):
+    """ dtype of a list or tuple which is stored as typed array, None otherwise. """
+    if not isinstance(value, (list, tuple)) or not value:
+        return None
+    if all(_is_int(v) for v in value):
+        return "<i8"
+    if all(v is None or _is_float(v) for v in value) and any(v is not None for v in value):
+        return "<f8"
+    return None
+
+
+def _encode(value):
+    if isinstance(value, tuple):
+        return {TUPLE_TAG: [_encode(v) for v in value]}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict) and TUPLE_TAG in value:
+        return tuple(_decode(v) for v in value[TUPLE_TAG])
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+def pack(columns: Dict) -> bytes:
+    """ Serializes the columns. """
+    header = {}
+    payloads = []
+    offset = 0
+    for key, value in columns.items():
+        dtype = _array_dtype(value)
+        if dtype is None:
+            header[key] = {"kind": "json", "value": _encode(value)}
+            continue
+
+        nones = [k for k, v in enumerate(value) if v is None]
+        array = np.array([np.nan if v is None else v for v in value], dtype=dtype)
+        header[key] = {
+            "kind": "array",
+            "dtype": dtype,
+            "tuple": isinstance(value, tuple),
+            "offset": offset,
+            "size": len(array),
+            "none": nones,
+        }
+        payloads.append(array.tobytes())
+        offset += array.nbytes
+
+    header = json.dumps(header).encode()
+    data = b"".join([np.uint32(len(header)).astype("<u4").tobytes(), header, *payloads])
+    return zlib.compress(data)
+
+
+def unpack(data: bytes) -> Dict:
+    """ Deserializes the columns. """
+    data = zlib.decompress(data)
+    size = int(np.frombuffer(data[:4], dtype="<u4")[0])
+    header = json.loads(data[4:4 + size])
+    payloads = memoryview(data)[4 + size:]
+
+    columns = {}
+    for key, info in header.items():
+        if info["kind"] == "json":
+            columns[key] = _decode(info["value"])
+            continue
+
+        dtype = np.dtype(info["dtype"])
+        start = info["offset"]
+        values = np.frombuffer(payloads[start:start + info["size"] * dtype.itemsize], dtype=dtype).tolist()
+        for k in info["none"]:
+            values[k] = None
+        columns[key] = tuple(values) if info["tuple"] else values
+    return columns
@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of the merging of timecourse values.
+
+Compares the vectorized merge_values with the former groupby.apply implementation
+(merge_values_apply) on synthetic timecourses with 10 to 10000 points. No database
+access is required.
+
+python manage.py benchmark_merge_values --points 10 100 1000 10000 --repeat 5
+"""
+import math
+import random
+import time
+
+from django.core.management import CommandError
+from django.core.management.base import BaseCommand
+
+from pkdb_app.data.models import SubSet
+
+
+def normalized(value):
+    """ Comparable value, missing values (None, nan) are identical. """
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__, [normalized(v) for v in value]
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmark of merge_values on synthetic timecourses.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--points', type=int, nargs="+", default=[10, 100, 1000, 10000],
+                            help="Number of points of the timecourses")
+        parser.add_argument('--interventions', type=int, default=2, help="Number of interventions per output")
+        parser.add_argument('--repeat', type=int, default=5, help="Number of repetitions")
+
+    def handle(self, *args, **options):
+        keys = list(SubSet().keys_timecourse_representation().values())
+        for n_points in options["points"]:
+            values = self.synthetic_timecourse(keys, n_points, options["interventions"])
+
+            results = {}
+            durations = {}
+            for name, function in [("apply", SubSet.merge_values_apply), ("vectorized", SubSet.merge_values)]:
+                durations[name] = []
+                for _ in range(options["repeat"]):
+                    time_start = time.time()
+                    results[name] = function(values)
+                    durations[name].append(time.time() - time_start)
+
+            for key, value in results["apply"].items():
+                if normalized(value) != normalized(results["vectorized"].get(key)):
+                    raise CommandError(f"Different merged values for '{key}' ({n_points} points).")
+
+            apply_time = min(durations["apply"])
+            vectorized_time = min(durations["vectorized"])
+            self.stdout.write(
+                f"points: {n_points:>6}, rows: {len(values):>6}, apply: {apply_time:.4f} s, "
+                f"vectorized: {vectorized_time:.4f} s, speedup: {apply_time / vectorized_time:.1f}"
+            )
+        self.stdout.write("identical merged values")
+
+    @staticmethod
+    def synthetic_timecourse(keys, n_points, n_interventions):
+        """ Rows of data_points.values(*keys) of a timecourse, one row per output x intervention. """
+        random.seed(n_points)
+        values = []
+        for k in range(n_points):
+            for i in range(n_interventions):
+                row = {key: None for key in keys}
+                row.update({
+                    "outputs__study__sid": "BENCHMARK0",
+                    "outputs__study__name": "benchmark_merge_values",
+                    "outputs__pk": k,
+                    "subset_id": 1,
+                    "subset__name": "subset",
+                    "outputs__interventions__pk": i + 1,
+                    "outputs__group_id": 1,
+                    "outputs__normed": True,
+                    "outputs__calculated": False,
+                    "outputs__tissue__info_node__sid": "plasma",
+                    "outputs__label": "timecourse",
+                    "outputs__output_type": "timecourse",
+                    "outputs__time": float(k),
+                    "outputs__time_unit": "hr",
+                    "outputs__measurement_type__info_node__sid": "concentration",
+                    "outputs__substance__info_node__sid": "caffeine",
+                    "outputs__mean": random.random(),
+                    "outputs__sd": random.random() if k % 10 else None,
+                    "outputs__unit": "mg/l",
+                })
+                values.append(row)
+        return values
@@ -1,16 +1,26 @@
 import itertools
-from collections import Iterable
+from collections import Iterable, defaultdict
+from typing import Dict, Iterator
 
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.db import models
 from django.utils.functional import cached_property
 from pkdb_app.behaviours import Accessible
+from pkdb_app.columnar import pack, unpack
 from pkdb_app.interventions.models import Intervention
 from pkdb_app.utils import CHAR_MAX_LENGTH
 from django.utils.translation import gettext_lazy as _
+import numpy as np
 import pandas as pd
 from django.apps import apps
 
+# number of subsets of which the data points are loaded in one query
+SCATTER_CHUNK_SIZE = 500
+
+# merged columns which stay arrays over the outputs. sd and se are reduced like the
+# other columns, as with the former key list ('outputs__sd' 'outputs__se' without comma).
+MERGE_ARRAY_KEYS = ['outputs__time', 'outputs__value', 'outputs__mean', 'outputs__median', 'outputs__cv']
+
 
 class DataSet(models.Model):
     """
@@ -47,7 +57,13 @@ class Timecourseable(models.Model):
     @cached_property
     def timecourse(self):
         """ FIXME: Documentation """
+        if self.timecourse_store is not None:
+            return unpack(self.timecourse_store)
+        timecourse = self._timecourse()
+        self._store_timecourse(timecourse_store=pack(timecourse))
+        return timecourse
 
+    def _timecourse(self):
         tc = self.merge_values(
             self.data_points.prefetch_related('outputs').values(*self._timecourse_extra().values()),
             sort_values=["outputs__interventions__pk", "outputs__time"]
@@ -56,6 +72,38 @@ class Timecourseable(models.Model):
         self.validate_timecourse(tc)
         return tc
 
+    def materialize_timecourse(self):
+        """ Stores the timecourse and its representation in columnar form (see pkdb_app.columnar).
+
+        Called when the timecourse is created, afterwards the stores are read instead of
+        merging the data points. Stores removed by invalidate_timecourses are rebuilt on access.
+        """
+        return self.timecourse, self.timecourse_representation
+
+    def _store_timecourse(self, **stores):
+        for key, value in stores.items():
+            setattr(self, key, value)
+        if self.pk is not None:
+            type(self).objects.filter(pk=self.pk).update(**stores)
+
+    @classmethod
+    def invalidate_timecourses(cls, queryset=None):
+        """ Removes the stored timecourses, e.g. after changes of the outputs or info nodes. """
+        queryset = cls.objects.all() if queryset is None else queryset
+        stored = models.Q(timecourse_store__isnull=False) | models.Q(representation_store__isnull=False)
+        queryset.filter(stored).update(timecourse_store=None, representation_store=None)
+
+    @classmethod
+    def invalidate_timecourses_of_info_nodes(cls, info_node_pks):
+        """ Removes the stored timecourses which contain names or labels of the info nodes. """
+        if not info_node_pks:
+            return
+        references = models.Q(data_points__outputs__interventions__application__info_node__in=info_node_pks)
+        for field in ["measurement_type", "tissue", "method", "substance", "choice"]:
+            references |= models.Q(**{f"data_points__outputs__{field}__info_node__in": info_node_pks})
+        subset_pks = cls.objects.filter(references).values("pk")
+        cls.invalidate_timecourses(cls.objects.filter(pk__in=subset_pks))
+
     def reformat_timecourse(self, timecourse, mapping):
         """ FIXME: Documentation & type hinting """
         for new_key, old_key in mapping.items():
@@ -67,6 +115,14 @@ class Timecourseable(models.Model):
     @cached_property
     def timecourse_representation(self):
         """ FIXME: Documentation """
+        if self.representation_store is not None:
+            return unpack(self.representation_store)
+        timecourse = self._timecourse_representation()
+        if timecourse is not None:
+            self._store_timecourse(representation_store=pack(timecourse))
+        return timecourse
+
+    def _timecourse_representation(self):
         if self.data.data_type == Data.DataTypes.Timecourse:
             timecourse = self.merge_values(
                 self.data_points.values(*self.keys_timecourse_representation().values()), )
@@ -172,7 +228,56 @@ class Timecourseable(models.Model):
     @staticmethod
     def merge_values(values=None, df=None, groupby=("outputs__pk",),
                      sort_values=["outputs__interventions__pk", "outputs__time"]):
+        """ Merges the rows of data points per group (output).
+
+        Per group and column the value is None if all values are missing, the value if all
+        values are identical and the tuple of values otherwise. Afterwards all columns except
+        MERGE_ARRAY_KEYS are reduced over the groups in the same way (a list instead of a tuple).
 
+        Vectorized version of merge_values_apply, the groups are compared via factorized codes.
+        """
+        if values:
+            df = pd.DataFrame(values)
+        if sort_values:
+            df = df.sort_values(sort_values)
+
+        codes = df.groupby(list(groupby), sort=True).ngroup().to_numpy()
+        # rows with missing group keys are dropped (as by groupby)
+        valid = codes >= 0
+        if not valid.any():
+            return {key: None for key in df.columns}
+        order = np.argsort(codes[valid], kind="stable")
+        counts = np.bincount(codes[valid])
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        bounds = list(zip(starts.tolist(), (starts + counts).tolist()))
+
+        merged_dict = {}
+        for key in df.columns:
+            column = df[key].to_numpy()[valid][order]
+            column_codes, _ = pd.factorize(column)
+            all_na = np.add.reduceat((column_codes < 0).astype(np.int64), starts) == counts
+            identical = np.minimum.reduceat(column_codes, starts) == np.maximum.reduceat(column_codes, starts)
+            column = column.tolist()
+            merged_dict[key] = [
+                None if na else (column[start] if same else tuple(column[start:stop]))
+                for na, same, (start, stop) in zip(all_na.tolist(), identical.tolist(), bounds)
+            ]
+
+        for key, values in merged_dict.items():
+            if key not in MERGE_ARRAY_KEYS:
+                merged_dict[key] = SubSet.tuple_or_value(values)
+
+            if all(v is None for v in values):
+                merged_dict[key] = None
+
+        return merged_dict
+
+    @staticmethod
+    def merge_values_apply(values=None, df=None, groupby=("outputs__pk",),
+                           sort_values=["outputs__interventions__pk", "outputs__time"]):
+        """ Merges the rows of data points per group with groupby.apply, superseded by merge_values
+        (used for benchmarking).
+        """
         if values:
             df = pd.DataFrame(values)
         if sort_values:
@@ -180,8 +285,7 @@ class Timecourseable(models.Model):
         merged_dict = df.groupby(list(groupby), as_index=False).apply(SubSet.to_list).to_dict("list")
 
         for key, values in merged_dict.items():
-            if key not in ['outputs__time', 'outputs__value', 'outputs__mean', 'outputs__median', 'outputs__cv',
-                           'outputs__sd' 'outputs__se']:
+            if key not in MERGE_ARRAY_KEYS:
                 merged_dict[key] = SubSet.tuple_or_value(values)
 
             if all(v is None for v in values):
@@ -223,6 +327,11 @@ class SubSet(Accessible, Timecourseable):
     name = models.CharField(max_length=CHAR_MAX_LENGTH)
     data = models.ForeignKey(Data, related_name="subsets", on_delete=models.CASCADE)
     study = models.ForeignKey('studies.Study', on_delete=models.CASCADE, related_name="subsets")
+    # materialized timecourses (pkdb_app.columnar)
+    timecourse_store = models.BinaryField(null=True, blank=True)
+    representation_store = models.BinaryField(null=True, blank=True)
+    # inputs of the calculated pharmacokinetics (pk_calculation.pk_fingerprint)
+    pk_fingerprint = models.CharField(max_length=64, null=True, blank=True)
 
     def get_single_dosing(self, substance) -> Intervention:
         """Returns a single intervention of type dosing and with substance if existing.
@@ -264,9 +373,12 @@ class SubSet(Accessible, Timecourseable):
     @cached_property
     def scatter_representation(self):
         scatter_x = self.merge_values(self.data_points.filter(dimensions__dimension=0).values(*self.keys_scatter_representation().values()), sort_values=None)
-        self.reformat_timecourse(scatter_x, self.keys_scatter_representation())
-
         scatter_y = self.merge_values(self.data_points.filter(dimensions__dimension=1).prefetch_related('outputs').values(*self.keys_scatter_representation().values()),sort_values=None)
+        return self.pivot_scatter(scatter_x, scatter_y)
+
+    def pivot_scatter(self, scatter_x: Dict, scatter_y: Dict) -> Dict:
+        """ Scatter representation from the merged values of the x and y dimension. """
+        self.reformat_timecourse(scatter_x, self.keys_scatter_representation())
         self.reformat_timecourse(scatter_y, self.keys_scatter_representation())
 
         identical_keys = ["study_sid", "study_name", "subset_pk", "subset_name"]
@@ -275,6 +387,35 @@ class SubSet(Accessible, Timecourseable):
                 **{f"x_{k}": v for k, v in scatter_x.items() if k not in identical_keys},
                 **{f"y_{k}": v for k, v in scatter_y.items() if k not in identical_keys}}
 
+    @classmethod
+    def scatter_representations(cls, subset_ids: Iterable,
+                                chunk_size: int = SCATTER_CHUNK_SIZE) -> Iterator[Dict]:
+        """ Scatter representations of many subsets, identical to scatter_representation.
+
+        The data points of chunk_size subsets are loaded with a single query and split by
+        subset and dimension, instead of two queries per subset.
+        """
+        # keys and reformatting do not depend on the instance
+        builder = cls()
+        keys = list(builder.keys_scatter_representation().values())
+        subset_ids = sorted(set(subset_ids))
+        for start in range(0, len(subset_ids), chunk_size):
+            chunk = subset_ids[start:start + chunk_size]
+            points = DataPoint.objects.filter(subset_id__in=chunk, dimensions__dimension__in=[0, 1]).values(*keys)
+
+            rows = defaultdict(list)
+            for point in points.iterator():
+                rows[(point["subset_id"], point["dimensions__dimension"])].append(point)
+
+            for subset_id in chunk:
+                if (subset_id, 0) not in rows or (subset_id, 1) not in rows:
+                    raise ValueError(f"Scatter subset '{subset_id}' requires data points "
+                                     f"for the x and y dimension.")
+                scatter_x = cls.merge_values(rows.pop((subset_id, 0)), sort_values=None)
+                scatter_y = cls.merge_values(rows.pop((subset_id, 1)), sort_values=None)
+                yield builder.pivot_scatter(scatter_x, scatter_y)
+
+
 class DataPoint(models.Model):
     """
     A DataSetPoint can have multiple dimensions. These dimensions are spanned by outputs.
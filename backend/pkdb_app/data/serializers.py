@@ -8,13 +8,13 @@ from pkdb_app.comments.serializers import DescriptionSerializer, CommentSerializ
     DescriptionElasticSerializer
 from pkdb_app.data.documents import SubSetDocument
 from pkdb_app.data.models import DataSet, Data, SubSet, Dimension, DataPoint
-from pkdb_app.outputs.models import Output
+from pkdb_app.outputs.models import Output, OutputIntervention
 from pkdb_app.subjects.models import Individual
-from pkdb_app.outputs.pk_calculation import pkoutputs_from_timecourse
+from pkdb_app.outputs.pk_calculation import pk_inputs, pk_fits, pkoutputs_from_fit, pk_fingerprint
 from pkdb_app.outputs.serializers import OUTPUT_FOREIGN_KEYS, OUTPUT_FIELDS
 from pkdb_app.serializers import WrongKeyValidationSerializer, ExSerializer, StudySmallElasticSerializer
 from pkdb_app.subjects.models import DataFile
-from pkdb_app.utils import _create, create_multiple_bulk, create_multiple_bulk_normalized, list_of_pk
+from pkdb_app.utils import _create, create_multiple_bulk_normalized, list_of_pk, _update
 from rest_framework import serializers
 import pandas as pd
 import numpy as np
@@ -22,6 +22,34 @@ import numpy as np
 from functools import lru_cache
 
 
+class StudyOutputs(object):
+    """ Normed outputs of a study, loaded once for a dataset upload.
+
+    The outputs (values() of the queryset) are stored in a DataFrame with an index of the rows
+    by label, so the subsets are created without querying the outputs of the study for every
+    subset.
+    """
+
+    def __init__(self, study_sid):
+        self.study_sid = study_sid
+        columns = [field.attname for field in Output._meta.concrete_fields]
+        self.df = pd.DataFrame(
+            list(Output.objects.filter(study__sid=study_sid, normed=True).values(*columns)),
+            columns=columns,
+        )
+        self.index = self.df.groupby("label", sort=False).indices
+
+    def select(self, labels) -> pd.DataFrame:
+        """ Outputs with one of the labels.
+
+        :return: copy of the rows in the order of the study outputs
+        """
+        index = self.index
+        positions = [index[label] for label in dict.fromkeys(labels) if label in index]
+        positions = np.sort(np.concatenate(positions)) if positions else []
+        return self.df.iloc[positions].copy()
+
+
 class DimensionSerializer(WrongKeyValidationSerializer):
     output = serializers.CharField(write_only=True, allow_null=False, allow_blank=False)
 
@@ -82,15 +110,36 @@ class SubSetSerializer(ExSerializer):
 
     def calculate_pks_from_timecourses(self, subset):
         # calculate pharmacokinetics outputs
+        self.calculate_pks_from_many_timecourses([subset], workers=1)
+
+    @staticmethod
+    def calculate_pks_from_many_timecourses(subsets, workers=None):
+        """ Calculates the pharmacokinetics outputs of many timecourses.
+
+        The fits run in a process pool (settings.PK_WORKERS), the calculated outputs of
+        all timecourses are inserted in bulk.
+        """
         try:
-            outputs = pkoutputs_from_timecourse(subset)
+            prepared = []
+            for subset in subsets:
+                timecourse = subset.timecourse
+                inputs = pk_inputs(timecourse, subset.get_single_dosing(timecourse["substance"]))
+                subset.pk_fingerprint = pk_fingerprint(timecourse, inputs)
+                if inputs is not None:
+                    prepared.append((subset, timecourse, inputs))
+            fits = pk_fits([inputs for _, _, inputs in prepared], workers=workers)
+
+            subset_outputs = []
+            for (subset, timecourse, inputs), fit in zip(prepared, fits):
+                for output in pkoutputs_from_fit(subset, timecourse, inputs["ctype"], fit):
+                    subset_outputs.append((subset, output))
         except Exception as e:
             raise serializers.ValidationError(
                 {"pharmacokinetics exception": traceback.format_exc()}
             )
 
         errors = []
-        for output in outputs:
+        for _, output in subset_outputs:
             try:
                 output["measurement_type"].validate_complete(output)
             except ValueError as err:
@@ -99,18 +148,15 @@ class SubSetSerializer(ExSerializer):
             raise serializers.ValidationError(
                 {"calculated outputs": errors},
             )
-        interventions = [o.pop("interventions") for o in outputs]
+        interventions = [output.pop("interventions") for _, output in subset_outputs]
 
-        outputs_dj = create_multiple_bulk(subset, "subset", outputs, Output)
-
-        for intervention, output in zip(interventions, outputs_dj):
-            output.interventions.add(*intervention)
+        outputs_dj = Output.objects.bulk_create(
+            [Output(subset=subset, **output) for subset, output in subset_outputs])
 
         if outputs_dj:
             outputs_normed = create_multiple_bulk_normalized(outputs_dj, Output)
-            for output in outputs_normed:
-                output.interventions.add(*output.raw.interventions.all())
-        subset.save()
+            OutputIntervention.create_links([outputs_dj, outputs_normed], interventions)
+        SubSet.objects.bulk_update(subsets, ["pk_fingerprint"])
 
     @staticmethod
     def _add_id_to_foreign_keys(value: str):
@@ -126,9 +172,15 @@ class SubSetSerializer(ExSerializer):
         else:
             return value
 
-    def create_scatter(self, dimensions, shared, subset_instance):
+    def study_outputs(self) -> StudyOutputs:
+        """ StudyOutputs of the dataset upload (DataSetSerializer.create) or of the study. """
         study = self.context["study"]
-        study_outputs = study.outputs.filter(normed=True)
+        study_outputs = self.context.get("study_outputs")
+        if study_outputs is None or study_outputs.study_sid != study.sid:
+            study_outputs = StudyOutputs(study.sid)
+        return study_outputs
+
+    def create_scatter(self, dimensions, shared, subset_instance):
         if len(dimensions) != 2:
             raise serializers.ValidationError(
                 f"Scatter plots have to be two dimensional. Dimensions: <{dimensions}> has a len of <{len(dimensions)}.> ")
@@ -136,9 +188,7 @@ class SubSetSerializer(ExSerializer):
         if not shared:
             raise serializers.ValidationError(
                 f"The <shared> field is required for scatter plots.")
-        outputs_pd = pd.DataFrame(study_outputs.values())
-
-        data_set = outputs_pd[outputs_pd['label'].isin(dimensions)]
+        data_set = self.study_outputs().select(dimensions)
         if len(data_set) == 0:
             raise serializers.ValidationError(
                 {"data_set": {
@@ -161,7 +211,7 @@ class SubSetSerializer(ExSerializer):
             raise serializers.ValidationError(
                 f"Outputs have no values on shared field")
 
-        subset_outputs = []
+        data_points = []
         for shared_values, shared_data in data_set.groupby(shared_reformated):
             x_data = shared_data[shared_data["dimension"] == 0]
             y_data = shared_data[shared_data["dimension"] == 1]
@@ -176,29 +226,35 @@ class SubSetSerializer(ExSerializer):
                     f" do not uniquely assign 1 x output to 1 y output. "
                     f"<{dimensions[0]}> has <{len(x_data)}> outputs. <{dimensions[1]}> has <{len(y_data)}> outputs."
                 )
-            data_point_instance = DataPoint.objects.create(subset=subset_instance)
-            x_output = study_outputs.get(pk=x_data["id"])
-            y_output = study_outputs.get(pk=y_data["id"])
-            subset_outputs.append(x_output)
-            subset_outputs.append(y_output)
-
-            Dimension.objects.create(dimension=0,
-                                     study=study,
-                                     output=x_output,
-                                     data_point=data_point_instance)
-            Dimension.objects.create(dimension=1,
-                                     study=study,
-                                     output=y_output,
-                                     data_point=data_point_instance)
-
-        subset_instance.pks.add(*subset_outputs)
+            data_points.append([int(x_data["id"].iloc[0]), int(y_data["id"].iloc[0])])
 
-    def create_timecourse(self, subset_instance, dimensions):
+        self.create_data_points(subset_instance, data_points)
+
+    def create_data_points(self, subset_instance, data_points):
+        """ Creates the data points of the subset with a constant number of queries.
+
+        The DataPoints are inserted with a single bulk_create (returning their pks),
+        afterwards all Dimensions with a second bulk_create.
+
+        :param data_points: list of data points, each a list of output pks by dimension
+        """
         study = self.context["study"]
+        data_point_instances = DataPoint.objects.bulk_create(
+            [DataPoint(subset=subset_instance) for _ in data_points]
+        )
+        Dimension.objects.bulk_create([
+            Dimension(dimension=dimension, study=study, output_id=output_pk, data_point=data_point_instance)
+            for data_point_instance, output_pks in zip(data_point_instances, data_points)
+            for dimension, output_pk in enumerate(output_pks)
+        ])
+        output_pks = [output_pk for output_pks in data_points for output_pk in output_pks]
+        Output.objects.filter(pk__in=output_pks).update(subset=subset_instance)
+
+    def create_timecourse(self, subset_instance, dimensions):
         if len(dimensions) != 1:
             raise serializers.ValidationError(
                 f"Timecourses have to be one-dimensional, but '{len(dimensions)}' dimensions found <{dimensions}>.")
-        subset_outputs = study.outputs.filter(normed=True, label=dimensions[0])
+        subset_outputs = self.study_outputs().select(dimensions)
         if len(subset_outputs) == 0:
             raise serializers.ValidationError(
                 f"Timecourses cannot be empty. No outputs found <{dimensions[0]}>.")
@@ -206,25 +262,15 @@ class SubSetSerializer(ExSerializer):
             raise serializers.ValidationError(
                 f"Timecourses require at least two outputs, but only a single output exists in timecourse. "
                 f"Encode the label <{dimensions[0]}> as 'output_type=output' instead of 'output_type=timecourse'.")
-        subset_instance.pks.add(*subset_outputs)
-        if not subset_outputs.exists():
-            raise serializers.ValidationError(
-                {"dataset": {
-                    "data": [
-                        {"subsets": {"name": f"Outputs with label <{dimensions}> do not exist."}}
-                    ]
-                }}
-            )
-
-        dimensions = []
-        for output in subset_outputs.iterator():
-            data_point_instance = DataPoint.objects.create(subset=subset_instance)
-
-            dimension = Dimension(dimension=0, study=study, output=output, data_point=data_point_instance)
-            dimensions.append(dimension)
-        Dimension.objects.bulk_create(dimensions)
+        self.create_data_points(subset_instance, [[output_pk] for output_pk in subset_outputs["id"].tolist()])
 
-        self.calculate_pks_from_timecourses(subset_instance)
+        pk_timecourses = self.context.get("pk_timecourses")
+        if pk_timecourses is not None:
+            # calculated for all timecourses of the dataset (DataSetSerializer.create)
+            pk_timecourses.append(subset_instance)
+        else:
+            self.calculate_pks_from_timecourses(subset_instance)
+            subset_instance.materialize_timecourse()
 
 
 class DataSerializer(ExSerializer):
@@ -264,11 +310,22 @@ class DataSerializer(ExSerializer):
                                             pop=['subsets'])
 
         for subset in poped_data["subsets"]:
-            subset_instance, poped_data = _create(model_serializer=SubSetSerializer(context=self.context),
-                                                  validated_data={**subset, "data": data_instance},
-                                                  create_multiple_keys=['comments', 'descriptions'])
+            self.create_subset(data_instance, subset)
+        return data_instance
+
+    def update(self, instance, validated_data):
+        """ Updates the data in place, the subsets are updated by the DataSetSerializer. """
+        data_instance, _ = _update(instance, validated_data, keep=["dataset_id"],
+                                   create_multiple_keys=['comments', 'descriptions'],
+                                   pop=['subsets', 'dataset'])
         return data_instance
 
+    def create_subset(self, data_instance, subset):
+        subset_instance, _ = _create(model_serializer=SubSetSerializer(context=self.context),
+                                     validated_data={**subset, "data": data_instance},
+                                     create_multiple_keys=['comments', 'descriptions'])
+        return subset_instance
+
 
 class DataSetSerializer(ExSerializer):
     data = DataSerializer(many=True, read_only=False, required=False, allow_null=True)
@@ -360,20 +417,124 @@ class DataSetSerializer(ExSerializer):
                                                validated_data=validated_data,
                                                create_multiple_keys=['comments', 'descriptions'],
                                                pop=['data'])
+        # timecourses are collected and their pharmacokinetics calculated together
+        self.context["pk_timecourses"] = []
+        # outputs are loaded once for all subsets
+        self.context["study_outputs"] = StudyOutputs(self.context["study"].sid)
         data_instance_container = []
+        subsets = []
+        hashes = []
         for data_single in poped_data['data']:
+            subset_hashes = {subset.get("name"): self.subset_hash(data_single, subset)
+                             for subset in data_single.get("subsets", [])}
             data_single["dataset"] = dataset_instance
             data_instance, _ = _create(
                 model_serializer=DataSerializer(context=self.context),
                 validated_data=data_single,
             )
+            for subset_instance in data_instance.subsets.all():
+                subsets.append(subset_instance)
+                hashes.append(subset_hashes[subset_instance.name])
 
             data_instance_container.append(data_instance)
 
+        self._calculate_pharmacokinetics()
         dataset_instance.data.add(*data_instance_container)
         dataset_instance.save()
+        self.store_ex_hashes("dataset", subsets, hashes)
         return dataset_instance
 
+    def update(self, instance, validated_data):
+        """ Updates the data set of an incremental upload per subset.
+
+        The data are matched by name and updated in place. Subsets with the content hash of the
+        last upload are kept with their calculated pharmacokinetics, changed subsets are replaced,
+        so the pharmacokinetics are only calculated for changed timecourses. The hashes contain the
+        pks of the outputs of the dimensions, so subsets of replaced outputs are changed.
+        """
+        dataset_instance, poped_data = _update(instance, validated_data,
+                                               create_multiple_keys=['comments', 'descriptions'],
+                                               pop=['data'])
+        self.context["pk_timecourses"] = []
+        self.context["study_outputs"] = StudyOutputs(self.context["study"].sid)
+        stored = self.context["study"].related_set_hashes("dataset").get("exs", {})
+        data_by_name = {data_instance.name: data_instance for data_instance in dataset_instance.data.all()}
+        study_subsets = []
+        hashes = []
+        created = []
+        for data_single in poped_data['data']:
+            subsets = data_single.get("subsets", [])
+            data_single["dataset"] = dataset_instance
+            data_instance = data_by_name.pop(data_single.get("name"), None)
+            serializer = DataSerializer(context=self.context)
+            if data_instance is None:
+                data_instance = serializer.create({**data_single, "subsets": []})
+            else:
+                data_instance = serializer.update(data_instance, data_single)
+
+            subsets_by_name = {subset.name: subset for subset in data_instance.subsets.all()}
+            for subset in subsets:
+                subset_hash = self.subset_hash(data_single, subset)
+                subset_instance = subsets_by_name.pop(subset.get("name"), None)
+                if subset_instance is None or stored.get(str(subset_instance.pk)) != subset_hash:
+                    if subset_instance is not None:
+                        self.delete_subsets([subset_instance.pk])
+                    subset_instance = serializer.create_subset(data_instance, subset)
+                    created.append(subset_instance.pk)
+                study_subsets.append(subset_instance)
+                hashes.append(subset_hash)
+            self.delete_subsets([subset.pk for subset in subsets_by_name.values()])
+
+        for data_instance in data_by_name.values():
+            self.delete_subsets(data_instance.subsets.values_list("pk", flat=True))
+            self.delete(Data.objects.filter(pk=data_instance.pk))
+
+        self._calculate_pharmacokinetics()
+        self.store_ex_hashes("dataset", study_subsets, hashes)
+        self.record_changes(SubSet, created)
+        calculated = Output.objects.filter(subset__in=created, ex__isnull=True)
+        self.record_changes(Output, calculated.values_list("pk", flat=True))
+        return dataset_instance
+
+    def subset_hash(self, data_single, subset) -> str:
+        """ Content hash of a subset with the data type and the pks of the outputs of its dimensions. """
+        dimensions = [dimension for dimension in subset.get("dimensions") or [] if isinstance(dimension, str)]
+        outputs = self.context["study_outputs"].select(dimensions)
+        return self.content_hash({
+            "data_type": data_single.get("data_type"),
+            "subset": subset,
+            "outputs": sorted(outputs["id"].tolist()),
+        })
+
+    def delete_subsets(self, subset_pks):
+        """ Deletes the subsets with their calculated pharmacokinetics, the outputs of the data
+        points are kept (Output.subset of the data points is set by the subsets). """
+        Output.objects.filter(subset__in=subset_pks, ex__isnull=False).update(subset=None)
+        self.delete(SubSet.objects.filter(pk__in=subset_pks))
+
+    def _calculate_pharmacokinetics(self):
+        """ Calculates the pharmacokinetics of the timecourses of the upload (pk_timecourses). """
+        self.context.pop("study_outputs")
+        pk_timecourses = self.context.pop("pk_timecourses")
+        upload_stage = self.context.get("upload_stage")
+        if upload_stage is not None:
+            # progress of an upload job (studies.views.upload_job)
+            upload_stage("pk")
+        if self.context.get("dry_run"):
+            # timecourses are validated without calculating the pharmacokinetics
+            errors = []
+            for subset_instance in pk_timecourses:
+                try:
+                    subset_instance.timecourse
+                except ValueError as err:
+                    errors.append(str(err))
+            if errors:
+                raise serializers.ValidationError({"timecourses": errors})
+        else:
+            SubSetSerializer.calculate_pks_from_many_timecourses(pk_timecourses)
+            for subset_instance in pk_timecourses:
+                subset_instance.materialize_timecourse()
+
 
 ################################
 # Read Serializer
@@ -551,6 +712,15 @@ class TimecourseSerializer(serializers.Serializer):
     class Meta:
         fields = ["study_sid", "study_name", "output_pk", "intervention_pk", "group_pk", "individual_pk", "normed",
                   "calculated"] + OUTPUT_FIELDS + MEASUREMENTTYPE_FIELDS
+        # kinds of the method fields in typed downloads (pkdata.sheet_kinds)
+        column_kinds = {
+            "output_pk": "int_list",
+            "intervention_pk": "int_list",
+            "group_pk": "int",
+            "individual_pk": "int",
+            "normed": "bool",
+            **{key: "float_list" for key in ["time", "value", "mean", "median", "min", "max", "sd", "se", "cv"]},
+        }
 
 
 class SubSetElasticSerializer(DocumentSerializer):
@@ -7,17 +7,23 @@ from drf_yasg.utils import swagger_auto_schema
 from rest_framework.generics import get_object_or_404
 from django_elasticsearch_dsl import fields, DEDField, Object, collections
 from django_elasticsearch_dsl_drf.viewsets import BaseDocumentViewSet
-from elasticsearch_dsl import analyzer, token_filter, Q
+from elasticsearch import helpers
+from elasticsearch_dsl import analyzer, token_filter, Q, Document as DslDocument, Keyword, Integer
+from elasticsearch_dsl.connections import connections
+from pkdb_app.pagination import IdSliceSearch
 from pkdb_app.studies.models import IdCollection
 
 from pkdb_app.users.models import PUBLIC
-from pkdb_app.users.permissions import user_group
+from pkdb_app.users.permissions import user_group, access_key
+
+# maximal number of terms of a terms query or terms lookup on the documents
+MAX_TERMS_COUNT = 65536*4
 
 elastic_settings = {
     'number_of_shards': 1,
     'number_of_replicas': 1,
     'max_ngram_diff': 15,
-    'max_terms_count': 65536*4,
+    'max_terms_count': MAX_TERMS_COUNT,
 }
 
 edge_ngram_filter = token_filter(
@@ -160,10 +166,85 @@ UUID_PARAM = openapi.Parameter(
 
 )
 
+class IdSetDocument(DslDocument):
+    """ Ids of IdCollections for terms lookups.
+
+    Queries restricted to a filter result reference the stored id set, instead of
+    sending the ids with every request. Documents are identified by uuid and resource.
+    """
+    uuid = Keyword()
+    resource = Keyword()
+    ids = Integer(index=False, doc_values=False, multi=True)
+
+    class Index:
+        name = 'id_sets'
+        settings = {
+            'number_of_shards': 1,
+            'number_of_replicas': 0,
+        }
+
+    @staticmethod
+    def doc_id(uuid, resource):
+        return f"{uuid}-{resource}"
+
+    @classmethod
+    def lookup(cls, uuid, resource):
+        """ Terms lookup of the ids, e.g. Q('terms', pk=IdSetDocument.lookup(uuid, resource)). """
+        return {"index": cls.Index.name, "id": cls.doc_id(uuid, resource), "path": "ids"}
+
+    @classmethod
+    def query(cls, field, uuid, resource, ids):
+        """ Query of the documents with the ids of the id set in the field.
+
+        Terms lookups are limited to MAX_TERMS_COUNT ids, larger id sets are queried with
+        an ids query (field '_id') or terms queries of at most MAX_TERMS_COUNT ids.
+        """
+        if len(ids) <= MAX_TERMS_COUNT:
+            return Q('terms', **{field: cls.lookup(uuid, resource)})
+        ids = list(ids)
+        if field == "_id":
+            return Q('ids', values=ids)
+        return reduce(operator.ior, [
+            Q('terms', **{field: ids[k:k + MAX_TERMS_COUNT]}) for k in range(0, len(ids), MAX_TERMS_COUNT)
+        ])
+
+    @classmethod
+    def exists(cls, uuid, resource):
+        return connections.get_connection().exists(index=cls.Index.name, id=cls.doc_id(uuid, resource))
+
+    @classmethod
+    def store(cls, uuid, ids):
+        """ Stores the id sets of a filter query.
+
+        :param ids: dictionary of resource -> ids
+        """
+        if not cls._index.exists():
+            cls.init()
+        actions = (
+            {
+                "_index": cls.Index.name,
+                "_id": cls.doc_id(uuid, resource),
+                "_source": {"uuid": str(uuid), "resource": resource, "ids": list(resource_ids)},
+            }
+            for resource, resource_ids in ids.items()
+        )
+        helpers.bulk(connections.get_connection(), actions)
+
+    @classmethod
+    def delete_uuids(cls, uuids):
+        if uuids and cls._index.exists():
+            cls.search().filter("terms", uuid=[str(uuid) for uuid in uuids]).delete()
+
+
+# query parameters which allow to page the ids of an IdCollection directly
+ID_PAGING_PARAMS = {"uuid", "page", "page_size", "data_type", "format"}
+
 
 @method_decorator(name='list', decorator=swagger_auto_schema( manual_parameters=[UUID_PARAM]))
 class AccessView(BaseDocumentViewSet):
     """Permissions on views."""
+    id_bitmap = None
+    id_paging = False
 
     def _get_resource(self):
         resource = self.request.query_params.get("data_type", self.document.Index.name)
@@ -186,13 +267,19 @@ class AccessView(BaseDocumentViewSet):
         _uuid = self.request.query_params.get("uuid", [])
 
         if _uuid:
-            ids = list(get_object_or_404(IdCollection, uuid=_uuid, resource=self._get_resource()).ids)
-            _qs_kwargs = {'values': ids}
-
-            self.search = self.search.query(
-                'ids',
-                **_qs_kwargs
-            )
+            resource = self._get_resource()
+            collection = get_object_or_404(IdCollection, uuid=_uuid, resource=resource)
+            self.id_bitmap = collection.id_bitmap()
+            # the ids are only paged directly if they are the current ids the user has access to,
+            # otherwise elastic filters and counts them (the query_key is reset when studies change)
+            self.id_paging = collection.query_key is not None and collection.access == access_key(self.request.user)
+            if not self.pages_by_ids():
+                if not IdSetDocument.exists(_uuid, resource):
+                    IdSetDocument.store(_uuid, {resource: self.id_bitmap.to_list()})
+
+                self.search = self.search.query(
+                    IdSetDocument.query("_id", _uuid, resource, self.id_bitmap.to_list())
+                )
 
         if group == "basic":
             return self.search.query(Q('term', access__raw=PUBLIC) | Q('term', allowed_users__raw=self.request.user.username))
@@ -202,3 +289,21 @@ class AccessView(BaseDocumentViewSet):
             return self.search.query()
         else:
             raise AssertionError("wrong group name")
+
+    def pages_by_ids(self):
+        """ Pages are sliced from the ids of the IdCollection, if the list is not filtered or ordered
+        further and the ids are the current ids the user has access to (id_paging). Only the ids of
+        the requested page are send to elastic.
+        """
+        return (
+            self.id_paging
+            and getattr(self, "action", None) == "list"
+            and self.paginator is not None
+            and set(self.request.query_params) <= ID_PAGING_PARAMS
+            and not getattr(self, "ordering", None)
+        )
+
+    def paginate_queryset(self, queryset):
+        if self.pages_by_ids():
+            queryset = IdSliceSearch(queryset, self.id_bitmap)
+        return super().paginate_queryset(queryset)
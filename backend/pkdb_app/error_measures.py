@@ -63,3 +63,37 @@ def calculate_cv(sd, count, se, mean):
         cv = np.true_divide(np.multiply(se, np.sqrt(count)), mean_clean)
 
     return cv
+
+
+def add_error_measures(sd, se, cv, mean, count):
+    """Calculates missing sd, se and cv of many values (vectorized Output.add_error_measures).
+
+    All arguments are float arrays in which missing values are nan. Measures which are missing
+    or zero are calculated in the order sd, se, cv with the rules of calculate_sd, calculate_se
+    and calculate_cv.
+
+    :return: tuple of arrays (sd, se, cv), nan where not calculatable
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sqrt_count = np.sqrt(count)
+        mean_clean = np.where(mean == 0.0, np.nan, mean)
+        has_count = ~np.isnan(count)
+        has_mean = ~np.isnan(mean)
+
+        # measures are calculated if missing or zero
+        sd = np.where(
+            np.isnan(sd) | (sd == 0.0),
+            np.where(~np.isnan(se) & has_count, se * sqrt_count, cv * mean),
+            sd,
+        )
+        se = np.where(
+            np.isnan(se) | (se == 0.0),
+            np.where(~np.isnan(sd) & has_count, sd / sqrt_count, cv * mean / sqrt_count),
+            se,
+        )
+        cv = np.where(
+            np.isnan(cv) | (cv == 0.0),
+            np.where(~np.isnan(sd) & has_mean, sd / mean_clean, se * sqrt_count / mean_clean),
+            cv,
+        )
+    return sd, se, cv
@@ -7,9 +7,9 @@ import pint
 
 from django.db import models
 from django.utils.translation import gettext_lazy as _
-from pint import UndefinedUnitError
 
 from pkdb_app.behaviours import Sidable
+from pkdb_app.info_nodes import units as units_cache
 from pkdb_app.info_nodes.units import ureg
 from pkdb_app.utils import CHAR_MAX_LENGTH, CHAR_MAX_LENGTH_LONG, _validate_required_key_and_value_or_nr, \
     _validate_required_key_and_value
@@ -26,6 +26,23 @@ class Annotation(models.Model):
     url = models.URLField(max_length=CHAR_MAX_LENGTH_LONG, null=False)
 
 
+class InfoNodeVersion(models.Model):
+    """ Version of the info nodes, increased on every change (see registry.InfoNodeRegistry).
+
+    A single row which is shared by all processes.
+    """
+    version = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def current(cls) -> int:
+        return cls.objects.filter(pk=1).values_list("version", flat=True).first() or 0
+
+    @classmethod
+    def increase(cls):
+        if not cls.objects.filter(pk=1).update(version=models.F("version") + 1):
+            cls.objects.get_or_create(pk=1, defaults={"version": 1})
+
+
 class CrossReference(models.Model):
     """ CrossReference. """
     name = models.CharField(max_length=CHAR_MAX_LENGTH, null=False)
@@ -148,7 +165,7 @@ class Unit(models.Model):
 
     @property
     def p_unit(self):
-        return ureg(self.name).u
+        return units_cache.p_units((self.name,))[0]
 
 
 class MeasurementType(AbstractInfoNode):
@@ -201,14 +218,15 @@ class MeasurementType(AbstractInfoNode):
         """
         :return: list of normalized units in the data format of pint
         """
-        return [unit.p_unit for unit in self.units.all()]
+        return list(units_cache.p_units(tuple(self.n_units)))
 
     @property
     def n_units(self):
         """
         :return: list of normalized units as strings
         """
-        return list(self.units.values_list("name", flat=True))
+        # iterates the units, so prefetched units (info node registry) are not queried again
+        return [unit.name for unit in self.units.all()]
 
     @property
     def valid_dimensions(self):
@@ -224,15 +242,7 @@ class MeasurementType(AbstractInfoNode):
 
     @staticmethod
     def p_unit(unit):
-        try:
-            p_unit = ureg(unit)
-            p_unit.u  # check if pint unit can be accessed
-            return p_unit
-        except (UndefinedUnitError, AttributeError):
-            if unit == "%":
-                raise ValueError(f"unit: [{unit}] has to be encoded as 'percent'")
-
-            raise ValueError(f"unit [{unit}] is not defined in unit registry or not allowed.")
+        return units_cache.p_unit(unit)
 
     def is_valid_unit(self, data):
         unit = data.get("unit", None)
@@ -311,13 +321,19 @@ class MeasurementType(AbstractInfoNode):
         return self.p_unit(unit).dimensionality
 
     def is_norm_unit(self, unit):
-        return ureg(unit) in self.n_p_units
+        return units_cache.p_unit(unit) in self.n_p_units
 
     def normalize(self, magnitude, unit):
-        this_unit_p = self.p_unit(unit)
-        this_norm_unit_p = self.norm_unit(unit)
-        result = (magnitude * this_unit_p).to(this_norm_unit_p)
-        return result
+        factor, norm_unit = self.norm_conversion(unit)
+        return ureg.Quantity(magnitude * factor, norm_unit)
+
+    def norm_conversion(self, unit, substance_mass=None):
+        """ Conversion of unit to the normalized unit (memoized).
+
+        :param substance_mass: molar mass for removing the substance dimension or None
+        :return: tuple (factor, unit), i.e., pre-factor and resulting unit
+        """
+        return units_cache.norm_conversion(self.info_node.name, tuple(self.n_units), unit, substance_mass)
 
     def is_valid_choice(self, choice):
         return choice in self.choices_list()
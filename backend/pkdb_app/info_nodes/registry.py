@@ -0,0 +1,149 @@
+"""
+Process wide registry of the info nodes.
+
+All info nodes with their typed objects (MeasurementType, Substance, Tissue, ...) are
+loaded with a single query and looked up by name, sid or pk instead of querying the
+database for every output, intervention or calculated pharmacokinetic.
+
+Changes of the info nodes (InfoNodeSerializer) increase the version of the info nodes
+(InfoNodeVersion) which is shared by all processes. The registry compares its version at
+most every VERSION_CHECK_INTERVAL seconds and reloads on a new version. Info nodes which
+are not in the registry are looked up in the database before the lookup fails.
+"""
+import threading
+import time
+
+from pkdb_app.info_nodes.models import InfoNode, InfoNodeVersion
+
+# seconds after which the version of the info nodes is checked again
+VERSION_CHECK_INTERVAL = 1.0
+
+# ntypes with typed objects, the ntype is the related name of the typed object
+TYPED_NTYPES = [
+    InfoNode.NTypes.MeasurementType,
+    InfoNode.NTypes.Substance,
+    InfoNode.NTypes.Tissue,
+    InfoNode.NTypes.Method,
+    InfoNode.NTypes.Route,
+    InfoNode.NTypes.Application,
+    InfoNode.NTypes.Form,
+    InfoNode.NTypes.Choice,
+    InfoNode.NTypes.CalculationType,
+]
+
+
+class InfoNodeRegistry(object):
+    """ Lookup of info nodes and their typed objects. """
+
+    def __init__(self, check_interval: float = VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._lookups = None
+        self._version = None
+        self._checked = 0.0
+
+    def invalidate(self):
+        """ Reloads the registry in all processes. """
+        InfoNodeVersion.increase()
+        with self._lock:
+            self._lookups = None
+
+    def _load(self):
+        by_name = {}
+        by_sid = {}
+        by_pk = {}
+        typed_by_pk = {}
+        info_nodes = InfoNode.objects.select_related(*TYPED_NTYPES).prefetch_related("measurement_type__units")
+        for info_node in info_nodes:
+            by_name[(info_node.ntype, info_node.name)] = info_node
+            by_sid[info_node.sid] = info_node
+            by_pk[info_node.pk] = info_node
+            if info_node.ntype in TYPED_NTYPES:
+                typed = getattr(info_node, info_node.ntype, None)
+                if typed is not None:
+                    typed_by_pk[(info_node.ntype, typed.pk)] = typed
+        return {"name": by_name, "sid": by_sid, "pk": by_pk, "typed_pk": typed_by_pk}
+
+    def _lookups_of_version(self, check: bool):
+        """ Lookups, reloaded if the version of the info nodes changed.
+
+        :param check: check the version independent of the interval
+        """
+        with self._lock:
+            if self._lookups is None or check or time.time() - self._checked > self.check_interval:
+                # the version is read before the info nodes, so changes during the load cause a reload
+                version = InfoNodeVersion.current()
+                self._checked = time.time()
+                if self._lookups is None or version != self._version:
+                    self._lookups = self._load()
+                    self._version = version
+            return self._lookups
+
+    @property
+    def lookups(self):
+        return self._lookups_of_version(check=False)
+
+    @staticmethod
+    def _find(lookups, ntype: str, name: str = None, sid: str = None, pk: int = None):
+        if name is not None:
+            info_node = lookups["name"].get((ntype, name))
+        elif sid is not None:
+            info_node = lookups["sid"].get(sid)
+        else:
+            info_node = lookups["pk"].get(pk)
+        if info_node is None or info_node.ntype != ntype:
+            return None
+        return info_node
+
+    def info_node(self, ntype: str, name: str = None, sid: str = None, pk: int = None) -> InfoNode:
+        """ InfoNode by name (of the ntype), sid or pk.
+
+        :raises InfoNode.DoesNotExist: if no info node exists
+        """
+        info_node = self._find(self.lookups, ntype, name=name, sid=sid, pk=pk)
+        if info_node is None:
+            info_node = self._find(self._lookups_of_version(check=True), ntype, name=name, sid=sid, pk=pk)
+
+        if info_node is None and self._in_database(ntype, name=name, sid=sid, pk=pk):
+            # changed without a new version (e.g. in the admin)
+            with self._lock:
+                self._lookups = None
+            info_node = self._find(self.lookups, ntype, name=name, sid=sid, pk=pk)
+
+        if info_node is None:
+            raise InfoNode.DoesNotExist(f"InfoNode <{ntype}> with name={name}, sid={sid}, pk={pk} does not exist.")
+        return info_node
+
+    @staticmethod
+    def _in_database(ntype: str, name: str = None, sid: str = None, pk: int = None) -> bool:
+        if name is not None:
+            return InfoNode.objects.filter(ntype=ntype, name=name).exists()
+        if sid is not None:
+            return InfoNode.objects.filter(ntype=ntype, sid=sid).exists()
+        return InfoNode.objects.filter(ntype=ntype, pk=pk).exists()
+
+    def get(self, ntype: str, name: str = None, sid: str = None, pk: int = None):
+        """ Typed object (e.g. MeasurementType) by name or sid of its info node, or by its pk.
+
+        :raises ObjectDoesNotExist: if no object exists
+        """
+        Model = InfoNode._meta.get_field(ntype).related_model
+        if name is None and sid is None:
+            typed = self.lookups["typed_pk"].get((ntype, pk))
+            if typed is None:
+                typed = self._lookups_of_version(check=True)["typed_pk"].get((ntype, pk))
+            if typed is None and Model.objects.filter(pk=pk).exists():
+                with self._lock:
+                    self._lookups = None
+                typed = self.lookups["typed_pk"].get((ntype, pk))
+            if typed is None:
+                raise Model.DoesNotExist(f"{Model.__name__} with pk={pk} does not exist.")
+            return typed
+
+        try:
+            return getattr(self.info_node(ntype, name=name, sid=sid), ntype)
+        except InfoNode.DoesNotExist as err:
+            raise Model.DoesNotExist(str(err))
+
+
+info_node_registry = InfoNodeRegistry()
@@ -1,35 +1,50 @@
 from rest_framework import serializers
 
 from pkdb_app import utils
+from pkdb_app.data.models import SubSet
 from pkdb_app.info_nodes.documents import InfoNodeDocument
+from pkdb_app.info_nodes.registry import info_node_registry
 from pkdb_app.info_nodes.models import InfoNode, Synonym, Annotation, Unit, MeasurementType, Substance, Choice, Route, \
     Form, Tissue, Application, Method, CrossReference, CalculationType
 from pkdb_app.serializers import WrongKeyValidationSerializer, ExSerializer, SidNameLabelSerializer, FloatNRField
 from pkdb_app.utils import update_or_create_multiple
+from django.utils.encoding import smart_str
 from rest_framework.fields import empty
 
+
+class InfoNodeSlugRelatedField(utils.SlugRelatedField):
+    """ Info node of a ntype by name, looked up in the info node registry. """
+
+    def __init__(self, ntype, **kwargs):
+        self.ntype = ntype
+        kwargs.setdefault("slug_field", "name")
+        kwargs.setdefault("queryset", InfoNode.objects.filter(ntype=ntype))
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        try:
+            return info_node_registry.info_node(self.ntype, name=str(data))
+        except InfoNode.DoesNotExist:
+            self.fail('does_not_exist', slug_name=self.slug_field, value=smart_str(data))
+
+
 class EXMeasurementTypeableSerializer(ExSerializer):
     measurement_type = serializers.CharField(allow_blank=False)
     measurement_type_map = serializers.CharField(allow_blank=False)
 
 
 class MeasurementTypeableSerializer(EXMeasurementTypeableSerializer):
-    substance = utils.SlugRelatedField(
-        slug_field="name",
-        queryset=InfoNode.objects.filter(ntype=InfoNode.NTypes.Substance),
+    substance = InfoNodeSlugRelatedField(
+        InfoNode.NTypes.Substance,
         read_only=False,
         required=False,
         allow_null=True,
     )
 
-    measurement_type = utils.SlugRelatedField(
-        slug_field="name",
-        queryset=InfoNode.objects.filter(ntype=InfoNode.NTypes.MeasurementType)
-    )
+    measurement_type = InfoNodeSlugRelatedField(InfoNode.NTypes.MeasurementType)
 
-    calculation_type = utils.SlugRelatedField(
-        slug_field="name",
-        queryset=InfoNode.objects.filter(ntype=InfoNode.NTypes.CalculationType),
+    calculation_type = InfoNodeSlugRelatedField(
+        InfoNode.NTypes.CalculationType,
         allow_null=True,
     )
 
@@ -110,6 +125,12 @@ class ChoiceExtraSerializer(serializers.ModelSerializer):
         fields = ["measurement_types"]
 
 
+def _name_and_label(info_node):
+    """ Name and label of the info node in the database, which are contained in the stored timecourses. """
+    if info_node is not None:
+        return InfoNode.objects.filter(pk=info_node.pk).values_list("name", "label").first()
+
+
 class InfoNodeListSerializer(serializers.ListSerializer):
 
     def run_validation(self, data=empty):
@@ -120,11 +141,13 @@ class InfoNodeListSerializer(serializers.ListSerializer):
 
     def create(self, validated_data):
         info_nodes_pks = []
+        renamed_pks = []
         for validated_data_single in validated_data:
             try:
                 instance = InfoNode.objects.get(sid=validated_data_single.get("sid"))
             except InfoNode.DoesNotExist:
                 instance = None
+            name_and_label = _name_and_label(instance)
 
             info_node_serializer = InfoNodeSerializer(data=validated_data_single, context=self.context, instance=instance)
             info_node_serializer.is_valid(raise_exception=True)
@@ -133,9 +156,13 @@ class InfoNodeListSerializer(serializers.ListSerializer):
                 instance=instance,
                 update_document=False)
             info_nodes_pks.append(info_node.pk)
+            if name_and_label is not None and name_and_label != _name_and_label(info_node):
+                renamed_pks.append(info_node.pk)
 
         instances = InfoNode.objects.filter(pk__in=info_nodes_pks)
         InfoNodeDocument().update(instances)
+        # stored timecourses contain names and labels of info nodes
+        SubSet.invalidate_timecourses_of_info_nodes(renamed_pks)
         return instances
 
 
@@ -215,11 +242,15 @@ class InfoNodeSerializer(serializers.ModelSerializer):
         if update_document:
             InfoNodeDocument().update(instance)
 
+        info_node_registry.invalidate()
         return instance
 
     def update(self, instance, validated_data):
-
-        return self.update_or_create(validated_data=validated_data, instance=instance)
+        name_and_label = _name_and_label(instance)
+        instance = self.update_or_create(validated_data=validated_data, instance=instance)
+        if name_and_label != _name_and_label(instance):
+            SubSet.invalidate_timecourses_of_info_nodes([instance.pk])
+        return instance
 
     def create(self, validated_data):
         return self.update_or_create(validated_data=validated_data)
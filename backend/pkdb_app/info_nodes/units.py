@@ -1,4 +1,8 @@
+from functools import lru_cache
+from typing import Optional, Tuple
+
 import pint
+from pint import UndefinedUnitError
 
 ureg = pint.UnitRegistry()
 
@@ -10,3 +14,71 @@ ureg.define('percent = 0.01*count')
 ureg.define('IU = [activity_amount]')
 ureg.define('NO_UNIT = [no_unit]')
 ureg.define('arbitrary_unit = [arbitrary_unit]')
+
+# maximal number of cached unit parsings and conversions
+UNIT_CACHE_SIZE = 2048
+
+
+@lru_cache(maxsize=UNIT_CACHE_SIZE)
+def p_unit(unit):
+    """ Parsed pint quantity of the unit.
+
+    The returned quantity is shared between callers and must not be modified in place.
+    """
+    try:
+        p_unit = ureg(unit)
+        p_unit.u  # check if pint unit can be accessed
+        return p_unit
+    except (UndefinedUnitError, AttributeError):
+        if unit == "%":
+            raise ValueError(f"unit: [{unit}] has to be encoded as 'percent'")
+
+        raise ValueError(f"unit [{unit}] is not defined in unit registry or not allowed.")
+
+
+@lru_cache(maxsize=UNIT_CACHE_SIZE)
+def p_units(units: Tuple[str, ...]) -> Tuple:
+    """ Parsed pint units of the normalized units. """
+    return tuple(ureg(unit).u for unit in units)
+
+
+@lru_cache(maxsize=UNIT_CACHE_SIZE)
+def norm_conversion(measurement_type: str, norm_units: Tuple[str, ...], unit: str,
+                    substance_mass: Optional[float] = None) -> Tuple[float, str]:
+    """ Conversion of values in unit to the normalized units of a measurement type.
+
+    The substance dimension is removed via the molar mass in [g/mole] (mole -> g),
+    afterwards the unit is converted to the normalized unit with the same dimension.
+
+    :param measurement_type: name of the measurement type
+    :param norm_units: normalized units of the measurement type
+    :param substance_mass: molar mass of the substance or None
+    :return: tuple (factor, unit), normalized values are values * factor in unit
+    """
+    factor, target = 1.0, unit
+    if not unit:
+        return factor, target
+
+    # remove substance unit
+    if substance_mass:
+        dimension = p_unit(unit).dimensionality.get('[substance]')
+        if dimension != 0:
+            quantity = p_unit(unit) * (ureg("g/mol") * substance_mass) ** dimension
+            if ureg(str(quantity.units)) != ureg(unit):
+                factor, target = quantity.magnitude, str(quantity.units)
+
+    # normalization
+    n_p_units = p_units(norm_units)
+    if ureg(target) not in n_p_units:
+        dimension = p_unit(target).dimensionality
+        dimension_to_n_unit = {str(n_unit_p.dimensionality): n_unit_p for n_unit_p in n_p_units}
+        try:
+            norm_unit = dimension_to_n_unit[str(dimension)]
+        except KeyError:
+            raise ValueError(
+                f"Dimension [{dimension}] is not allowed for measurement type [{measurement_type}]."
+                f" Dimension was calculated from unit :[{target}]")
+        factor *= p_unit(target).to(norm_unit).magnitude
+        target = str(norm_unit)
+
+    return factor, target
@@ -5,11 +5,10 @@ import itertools
 import re
 from rest_framework import serializers
 import numpy as np
-from pkdb_app import utils
 from pkdb_app.behaviours import VALUE_FIELDS_NO_UNIT, \
     MEASUREMENTTYPE_FIELDS, map_field, EX_MEASUREMENTTYPE_FIELDS
 from pkdb_app.info_nodes.models import InfoNode
-from pkdb_app.info_nodes.serializers import MeasurementTypeableSerializer
+from pkdb_app.info_nodes.serializers import MeasurementTypeableSerializer, InfoNodeSlugRelatedField
 from pkdb_app.subjects.serializers import EXTERN_FILE_FIELDS
 from ..comments.serializers import DescriptionSerializer, CommentSerializer, DescriptionElasticSerializer, \
     CommentElasticSerializer
@@ -25,7 +24,7 @@ from ..subjects.models import DataFile
 # Serializer FIELDS
 # ----------------------------------
 from ..utils import list_of_pk, list_duplicates, _validate_required_key, _create, create_multiple_bulk, \
-    create_multiple_bulk_normalized, _validate_required_key_and_value
+    create_multiple_bulk_normalized, _validate_required_key_and_value, _update, update_multiple_normalized
 
 MEDICATION = "medication"
 DOSING = "dosing"
@@ -53,20 +52,17 @@ OUTPUT_MAP_FIELDS = map_field(OUTPUT_FIELDS)
 
 
 class InterventionSerializer(MeasurementTypeableSerializer):
-    route = utils.SlugRelatedField(
-        slug_field="name",
-        required=False,
-        queryset=InfoNode.objects.filter(ntype=InfoNode.NTypes.Route))
+    route = InfoNodeSlugRelatedField(
+        InfoNode.NTypes.Route,
+        required=False)
 
-    application = utils.SlugRelatedField(
-        slug_field="name",
-        required=False,
-        queryset=InfoNode.objects.filter(ntype=InfoNode.NTypes.Application))
+    application = InfoNodeSlugRelatedField(
+        InfoNode.NTypes.Application,
+        required=False)
 
-    form = utils.SlugRelatedField(
-        slug_field="name",
-        required=False,
-        queryset=InfoNode.objects.filter(ntype=InfoNode.NTypes.Form))
+    form = InfoNodeSlugRelatedField(
+        InfoNode.NTypes.Form,
+        required=False)
 
     time = serializers.CharField(allow_null=True)
 
@@ -256,19 +252,44 @@ class InterventionExSerializer(MappingSerializer):
 
     def create(self, validated_data):
         intervention_set = validated_data.pop("intervention_set")
+        interventions_by_name = validated_data.pop("interventions_by_name", {})
         intervention_ex, poped_data = _create(model_manager=intervention_set.intervention_exs,
                                               validated_data=validated_data,
                                               create_multiple_keys=['descriptions', 'comments'],
                                               pop=['interventions'])
 
-        interventions = poped_data["interventions"]
+        self._create_interventions(intervention_ex, poped_data["interventions"], interventions_by_name)
+        intervention_ex.save()
+        return intervention_ex
+
+    def update(self, instance, validated_data):
+        """ Updates the intervention ex in place (InterventionSetSerializer.update). """
+        validated_data.pop("intervention_set")
+        interventions_by_name = validated_data.pop("interventions_by_name", {})
+        intervention_ex, poped_data = _update(instance, validated_data, keep=["interventionset_id"],
+                                              create_multiple_keys=['descriptions', 'comments'],
+                                              pop=['interventions'])
+        self._create_interventions(intervention_ex, poped_data["interventions"], interventions_by_name)
+        return intervention_ex
+
+    def _create_interventions(self, intervention_ex, interventions, interventions_by_name):
+        """ Creates the interventions of the intervention ex, existing interventions with the same
+        name (interventions_by_name) are updated in place with their normalized interventions. """
+        created = []
+        updated = []
         for intervention in interventions:
             intervention["study"] = self.context["study"]
-
-        not_norm_interventions = create_multiple_bulk(intervention_ex, "ex", interventions, Intervention)
+            existing = interventions_by_name.get(intervention["name"])
+            if existing is None:
+                created.append(intervention)
+            else:
+                dj_intervention = Intervention(pk=existing.pk, ex=intervention_ex, **intervention)
+                dj_intervention.save(force_update=True)
+                updated.append(dj_intervention)
+
+        not_norm_interventions = create_multiple_bulk(intervention_ex, "ex", created, Intervention)
         create_multiple_bulk_normalized(not_norm_interventions, Intervention)
-        intervention_ex.save()
-        return intervention_ex
+        update_multiple_normalized(updated, Intervention)
 
 
 class InterventionSetSerializer(ExSerializer):
@@ -319,11 +340,62 @@ class InterventionSetSerializer(ExSerializer):
                                         create_multiple_keys=['descriptions', 'comments'], pop=['intervention_exs'])
 
         intervention_exs =  poped_data['intervention_exs']
+        hashes = [self.content_hash(intervention_ex) for intervention_ex in intervention_exs]
         for intervention_ex in intervention_exs:
             intervention_ex["intervention_set"] = interventionset
 
-        InterventionExSerializer(context=self.context,many=True).create(validated_data=poped_data['intervention_exs'])
+        study_intervention_exs = InterventionExSerializer(context=self.context,many=True).create(
+            validated_data=poped_data['intervention_exs'])
+        self.store_ex_hashes("interventionset", study_intervention_exs, hashes)
+
+        return interventionset
 
+    def update(self, instance, validated_data):
+        """ Updates the intervention set of an incremental upload per intervention ex.
+
+        Intervention exs with the content hash of the last upload are kept. Changed intervention
+        exs are updated in place (new exs are created, removed exs deleted); their interventions
+        are matched by name with the interventions of the changed exs of the last upload and
+        updated in place, so the interventions keep their pks (see GroupSetSerializer.update).
+        """
+        interventionset, poped_data = _update(instance, validated_data,
+                                              create_multiple_keys=['descriptions', 'comments'],
+                                              pop=['intervention_exs'])
+        intervention_exs = poped_data['intervention_exs']
+        hashes = [self.content_hash(intervention_ex) for intervention_ex in intervention_exs]
+        unchanged, stale = self.match_exs("interventionset", hashes, interventionset.intervention_exs.all())
+
+        names = {intervention["name"] for intervention_ex in intervention_exs
+                 for intervention in intervention_ex["interventions"]}
+        interventions_by_name = {
+            intervention.name: intervention
+            for intervention in Intervention.objects.filter(ex__in=stale, normed=False, name__in=names)
+        }
+
+        study_intervention_exs = []
+        changed_exs = []
+        updated_exs = list(stale)
+        for intervention_ex, unchanged_ex in zip(intervention_exs, unchanged):
+            if unchanged_ex is not None:
+                study_intervention_exs.append(unchanged_ex)
+                continue
+            intervention_ex.update(
+                {"intervention_set": interventionset, "interventions_by_name": interventions_by_name})
+            if updated_exs:
+                study_intervention_ex = InterventionExSerializer(context=self.context).update(
+                    updated_exs.pop(0), intervention_ex)
+            else:
+                study_intervention_ex = InterventionExSerializer(context=self.context).create(
+                    validated_data=intervention_ex)
+            study_intervention_exs.append(study_intervention_ex)
+            changed_exs.append(study_intervention_ex)
+
+        # interventions of the changed exs which are not uploaded again, and the removed exs
+        interventions = Intervention.objects.filter(ex__in=changed_exs)
+        self.delete(Intervention.objects.filter(ex__in=stale).exclude(pk__in=interventions))
+        self.delete(InterventionEx.objects.filter(pk__in=[ex.pk for ex in updated_exs]))
+        self.store_ex_hashes("interventionset", study_intervention_exs, hashes)
+        self.record_changes(Intervention, interventions.values_list("pk", flat=True))
         return interventionset
 
 
@@ -0,0 +1,65 @@
+"""
+Background jobs in a local process pool.
+
+Jobs run in worker processes spawned by the web worker, so no message broker
+is required. State and progress of a job are stored in the Job model and can
+be polled from every web worker.
+"""
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.conf import settings
+from django.db import connection
+
+_executor = None
+
+
+def _init_worker():
+    django.setup()
+
+
+def executor() -> ProcessPoolExecutor:
+    """ Process pool of the web worker, created on first use. """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.JOB_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+    return _executor
+
+
+def submit(job, function, *args):
+    """ Runs function(job, *args) in the process pool.
+
+    The function has to be defined on module level, the arguments have to be picklable.
+    """
+    global _executor
+    try:
+        return executor().submit(run, function, job.pk, *args)
+    except BrokenProcessPool:
+        # a worker process died, the pool is replaced
+        _executor = None
+        return executor().submit(run, function, job.pk, *args)
+
+
+def run(function, job_pk, *args):
+    """ Executes a job in the worker process and stores status and errors. """
+    from pkdb_app.studies.models import Job
+
+    job = Job.objects.get(pk=job_pk)
+    job.status = Job.Status.Running
+    job.save()
+    try:
+        function(job, *args)
+        job.status = Job.Status.Finished
+    except Exception:
+        job.status = Job.Status.Failed
+        job.error = traceback.format_exc()
+    finally:
+        job.save()
+        connection.close()
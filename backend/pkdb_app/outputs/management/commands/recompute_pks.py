@@ -0,0 +1,52 @@
+"""
+Recomputes the calculated pharmacokinetics outputs of timecourses with changed inputs.
+
+Only timecourses whose fingerprint (points, units, dosing, substance mass, version of
+pkdb_analysis) changed since the last calculation are recalculated.
+
+python manage.py recompute_pks --workers 4
+python manage.py recompute_pks --studies PKDB00198 PKDB00199 --force
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from pkdb_app.outputs.pk_recompute import recompute_studies
+from pkdb_app.studies.models import Study
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the calculated pharmacokinetics outputs of timecourses with changed inputs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--studies', nargs="+", default=None, help="Sids of the studies (default all)")
+        parser.add_argument('--workers', type=int, default=settings.PK_WORKERS,
+                            help="Number of studies processed in parallel")
+        parser.add_argument('--force', action="store_true", help="Recompute all timecourses")
+        parser.add_argument('--dry-run', action="store_true", help="Only report the changed timecourses")
+
+    def handle(self, *args, **options):
+        studies = Study.objects.all()
+        if options["studies"]:
+            studies = studies.filter(sid__in=options["studies"])
+        study_pks = list(studies.order_by("sid").values_list("pk", flat=True))
+
+        time_start = time.time()
+        totals = {"timecourses": 0, "deleted": 0, "created": 0, "failed": 0}
+        for summary in recompute_studies(study_pks, workers=options["workers"], force=options["force"],
+                                         dry_run=options["dry_run"]):
+            if summary["error"]:
+                totals["failed"] += 1
+                self.stderr.write(f"{summary['study']}: {summary['error']}")
+                continue
+            for key in ["timecourses", "deleted", "created"]:
+                totals[key] += summary[key]
+            if summary["timecourses"]:
+                self.stdout.write(
+                    f"{summary['study']}: timecourses {summary['timecourses']}, deleted {summary['deleted']}, "
+                    f"created {summary['created']} ({summary['time']:.2f} s)")
+
+        self.stdout.write(
+            f"studies: {len(study_pks)}, timecourses: {totals['timecourses']}, deleted: {totals['deleted']}, "
+            f"created: {totals['created']}, failed: {totals['failed']} ({time.time() - time_start:.2f} s)")
@@ -18,11 +18,14 @@ from .managers import (
 )
 from ..behaviours import (
     Externable, Accessible)
-from ..error_measures import calculate_cv, calculate_se, calculate_sd
+from ..error_measures import calculate_cv, calculate_se, calculate_sd, add_error_measures
 from ..utils import CHAR_MAX_LENGTH
 
 TIME_NORM_UNIT = "hr"
 
+# through rows of outputs and interventions inserted per query
+OUTPUT_INTERVENTION_BATCH_SIZE = 5000
+
 
 # -------------------------------------------------
 # OUTPUTS
@@ -180,6 +183,27 @@ class Output(AbstractOutput, Outputable, Accessible):
                     se=self.se, count=self.group.count, mean=self.mean, sd=self.sd
                 )
 
+    @staticmethod
+    def add_error_measures_bulk(outputs):
+        """ add_error_measures of many outputs, calculated on numpy columns. """
+        outputs = [output for output in outputs if output.group]
+        if not outputs:
+            return
+
+        def column(values):
+            return np.array([np.nan if value is None else value for value in values], dtype=float)
+
+        sd, se, cv = add_error_measures(
+            sd=column(output.sd for output in outputs),
+            se=column(output.se for output in outputs),
+            cv=column(output.cv for output in outputs),
+            mean=column(output.mean for output in outputs),
+            count=column(output.group.count for output in outputs),
+        )
+        for key, values in {"sd": sd, "se": se, "cv": cv}.items():
+            for output, value in zip(outputs, values.tolist()):
+                setattr(output, key, None if math.isnan(value) else value)
+
 
 class OutputIntervention(Accessible, models.Model):
     output = models.ForeignKey(Output, on_delete=models.CASCADE)
@@ -188,6 +212,23 @@ class OutputIntervention(Accessible, models.Model):
     class Meta:
         unique_together = ("output", "intervention")
 
+    @classmethod
+    def create_links(cls, outputs_lists, interventions, batch_size=OUTPUT_INTERVENTION_BATCH_SIZE):
+        """ Links outputs to their interventions with bulk inserted through rows.
+
+        :param outputs_lists: lists of outputs (e.g. raw outputs and their normed outputs),
+            each in the order of interventions
+        :param interventions: interventions (instances or pks) of each output
+        :return: created OutputIntervention
+        """
+        links = [
+            cls(output_id=output.pk, intervention_id=intervention_pk)
+            for outputs in outputs_lists
+            for output, output_interventions in zip(outputs, interventions)
+            for intervention_pk in {getattr(i, "pk", i) for i in output_interventions}
+        ]
+        return cls.objects.bulk_create(links, batch_size=batch_size)
+
     @property
     def study(self):
         return self.intervention.study
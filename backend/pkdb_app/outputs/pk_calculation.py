@@ -1,21 +1,29 @@
 """
 Calculate pharmacokinetics
+
+The calculation is split in the preparation of plain inputs from the timecourse (pk_inputs),
+the fit (pk_fit.pk_fit, independent of Django) and the creation of the outputs from the fit
+(pkoutputs_from_fit). The fits of many timecourses can run in a process pool (pk_fits).
 """
-from typing import List, Dict
+import hashlib
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from importlib import metadata
+from typing import List, Dict, Optional
 from rest_framework import serializers
 import logging
 import warnings
 import numpy as np
 from django.apps import apps
-from pkdb_app.info_nodes.units import ureg
-from pkdb_analysis.pk import pharmacokinetics
+from django.conf import settings
+from pkdb_app.info_nodes.registry import info_node_registry
+from pkdb_app.outputs.pk_fit import pk_fit
 
 logger = logging.getLogger(__name__)
 
-MeasurementType = apps.get_model('info_nodes.MeasurementType')
-Substance = apps.get_model('info_nodes.Substance')
-Method = apps.get_model('info_nodes.Method')
-Tissue = apps.get_model('info_nodes.Tissue')
+InfoNode = apps.get_model('info_nodes.InfoNode')
 Output = apps.get_model('outputs.Output')
 
 Subset = apps.get_model('data.Subset')
@@ -23,89 +31,91 @@ Individual = apps.get_model('subjects.Individual')
 Group = apps.get_model('subjects.Group')
 
 
+# pharmacokinetic parameter -> name of measurement type
+PK_MEASUREMENT_TYPES = {
+    "auc": "auc_end",
+    "aucinf": "auc_inf",
+    "cl": "clearance",
+    "cmax": "cmax",
+    "kel": "kel",
+    "thalf": "thalf",
+    "tmax": "tmax",
+    "vd": "vd",
+    "vdss": "vd_ss",
+}
+
+
+def measurement_type(name: str):
+    """ MeasurementType by name from the info node registry. """
+    return info_node_registry.get(InfoNode.NTypes.MeasurementType, name=name)
+
+
 def pkoutputs_from_timecourse(subset: Subset) -> List[Dict]:
     """Calculates pharmacokinetics outputs for timecourse.
 
     :param subset: models.SubSet
     :return:
     """
-    outputs = []
     timecourse = subset.timecourse
-    dosing = subset.get_single_dosing(timecourse["substance"])
-    # dosing information must exist
-
-    # pharmacokinetics are only calculated on normalized concentrations
-    if timecourse["measurement_type_name"] == "concentration":
-        variables = _timecourse_to_pkdict(timecourse, dosing)
-        if "concentration" in variables:
-            ctype = variables.pop("ctype", None)
-            pkinf = None
-            if dosing:
-                if dosing.application.info_node.name == "single dose" and timecourse["substance"] == dosing.substance.pk:
-                    pkinf = pharmacokinetics.TimecoursePK(**variables)
-
-            if not pkinf:
-                _ = variables.pop("dosing", None)
-                _ = variables.pop("intervention_time", None)
-                print(variables)
-                pkinf = pharmacokinetics.TimecoursePKNoDosing(**variables)
-
-            pk = pkinf.pk
-            key_mapping = {
-                "auc": MeasurementType.objects.get(info_node__name="auc_end"),
-                "aucinf": MeasurementType.objects.get(info_node__name="auc_inf"),
-                "cl": MeasurementType.objects.get(info_node__name="clearance"),
-                "cmax": MeasurementType.objects.get(info_node__name="cmax"),
-                "kel": MeasurementType.objects.get(info_node__name="kel"),
-                "thalf": MeasurementType.objects.get(info_node__name="thalf"),
-                "tmax": MeasurementType.objects.get(info_node__name="tmax"),
-                "vd": MeasurementType.objects.get(info_node__name="vd"),
-                "vdss": MeasurementType.objects.get(info_node__name="vd_ss"),
-            }
-
-            def get_or_none(id, model):
-                if id:
-                    return model.objects.get(id=id)
-
-            for key in key_mapping.keys():
-                pk_par = getattr(pk, key, None)
-                # check that exists
-                if pk_par and not np.isnan(pk_par.magnitude):
-                    output_dict = {}
-                    output_dict[ctype] = pk_par.magnitude
-                    output_dict["unit"] = str(pk_par.units)
-                    output_dict["measurement_type"] = key_mapping[key]
-                    output_dict["calculated"] = True
-                    output_dict["tissue"] = get_or_none(timecourse["tissue"], model=Tissue)
-                    output_dict["method"] = get_or_none(timecourse["method"], model=Method)
-                    output_dict["substance"] = get_or_none(id=timecourse["substance"], model=Substance)
-                    output_dict["group"] =  get_or_none(id=timecourse["group"],model=Group)
-                    output_dict["individual"] = get_or_none(timecourse["individual"], model=Individual)
-                    output_dict["interventions"] = timecourse["interventions"]
-                    output_dict["study"] = subset.study
-                    if output_dict["measurement_type"].info_node.name == "auc_end":
-                        output_dict["time"] = max(timecourse["time"])
-                        output_dict["time_unit"] = str(timecourse["time_unit"])
-
-                    outputs.append(output_dict)
+    inputs = pk_inputs(timecourse, subset.get_single_dosing(timecourse["substance"]))
+    if inputs is None:
+        return []
+    return pkoutputs_from_fit(subset, timecourse, inputs["ctype"], pk_fit(inputs))
 
-    return outputs
 
+def pkoutputs_from_fit(subset: Subset, timecourse: Dict, ctype: str, pk: Dict) -> List[Dict]:
+    """ Calculated outputs of a timecourse from the fitted pharmacokinetics.
 
-def _timecourse_to_pkdict(tc: dict, dosing) -> Dict:
+    :param pk: dictionary of parameter -> (magnitude, unit), see pk_fit.pk_fit
+    """
+    outputs = []
+    if not pk:
+        return outputs
+
+    key_mapping = {key: measurement_type(name) for key, name in PK_MEASUREMENT_TYPES.items()}
+
+    def get_or_none(id, ntype):
+        if id:
+            return info_node_registry.get(ntype, pk=id)
+
+    tissue = get_or_none(timecourse["tissue"], InfoNode.NTypes.Tissue)
+    method = get_or_none(timecourse["method"], InfoNode.NTypes.Method)
+    substance = get_or_none(timecourse["substance"], InfoNode.NTypes.Substance)
+    group = Group.objects.get(id=timecourse["group"]) if timecourse["group"] else None
+    individual = Individual.objects.get(id=timecourse["individual"]) if timecourse["individual"] else None
+
+    for key in key_mapping.keys():
+        if key in pk:
+            magnitude, unit = pk[key]
+            output_dict = {}
+            output_dict[ctype] = magnitude
+            output_dict["unit"] = unit
+            output_dict["measurement_type"] = key_mapping[key]
+            output_dict["calculated"] = True
+            output_dict["tissue"] = tissue
+            output_dict["method"] = method
+            output_dict["substance"] = substance
+            output_dict["group"] = group
+            output_dict["individual"] = individual
+            output_dict["interventions"] = timecourse["interventions"]
+            output_dict["study"] = subset.study
+            if output_dict["measurement_type"].info_node.name == "auc_end":
+                output_dict["time"] = max(timecourse["time"])
+                output_dict["time_unit"] = str(timecourse["time_unit"])
+
+            outputs.append(output_dict)
 
-    """Create dictionary for pk calculation from timecourse.
+    return outputs
 
-    :return: dict
-    """
-    pk_dict = {}
-    Q_ = ureg.Quantity
-    pk_dict['ureg'] = ureg  # for unit conversions
 
-    # substance
-    pk_dict["substance"] = tc["substance_name"]
-    # time
-    pk_dict["time"] = Q_(np.array(tc["time"]), tc["time_unit"])
+def pk_inputs(tc: dict, dosing) -> Optional[Dict]:
+    """Create plain inputs for the pk calculation (pk_fit.pk_fit) from timecourse.
+
+    Pharmacokinetics are only calculated on normalized concentrations.
+    :return: dict or None if no pharmacokinetics are calculated
+    """
+    if tc["measurement_type_name"] != "concentration":
+        return None
 
     # concentration
     values = None
@@ -119,19 +129,29 @@ def _timecourse_to_pkdict(tc: dict, dosing) -> Dict:
     elif tc["value"]:
         values = np.array(tc["value"])
         ctype = "value"
-    if ctype is not None:
-        pk_dict["concentration"] = Q_(values, tc["unit"])
-        pk_dict['ctype'] = ctype
-    # dosing
-    pk_dict["dose"] = Q_(np.nan, "mg")
+    if ctype is None:
+        return None
+
+    pk_dict = {
+        "substance": tc["substance_name"],
+        "time": np.array(tc["time"]),
+        "time_unit": tc["time_unit"],
+        "concentration": values,
+        "unit": tc["unit"],
+        "ctype": ctype,
+        # dosing
+        "dose": (np.nan, "mg"),
+        "intervention_time": None,
+        "single_dose": False,
+    }
 
     if dosing:
         if dosing.substance.pk == tc["substance"]:
             # pharmacokinetics is only calculated for single dose experiments
             # where the applied substance is the measured substance!
-            if MeasurementType.objects.get(info_node__name="restricted dosing")._is_valid_unit(dosing.unit):
+            if measurement_type("restricted dosing")._is_valid_unit(dosing.unit):
                 if dosing.value is not None:
-                    pk_dict["dose"] = Q_(dosing.value, dosing.unit)
+                    pk_dict["dose"] = (dosing.value, dosing.unit)
                 else:
                     warnings.warn(f"restricted dosing requires value: {dosing}")
                 try:
@@ -141,5 +161,82 @@ def _timecourse_to_pkdict(tc: dict, dosing) -> Dict:
                     warnings.warn(f"Intervention time is not used for pk calculation. : {dosing_time}")
 
                 if dosing_time is not None:
-                    pk_dict["intervention_time"] = Q_(dosing_time, dosing.time_unit)
+                    pk_dict["intervention_time"] = (dosing_time, dosing.time_unit)
+
+        pk_dict["single_dose"] = (dosing.application.info_node.name == "single dose"
+                                  and tc["substance"] == dosing.substance.pk)
     return pk_dict
+
+
+def pk_library_version() -> str:
+    try:
+        return metadata.version("pkdb_analysis")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def pk_fingerprint(tc: Dict, inputs: Optional[Dict]) -> str:
+    """ Fingerprint of everything the calculated outputs of a timecourse depend on.
+
+    The fingerprint covers the inputs of the fit (points, units, dosing), the fields copied
+    to the calculated outputs, the info nodes used for their normalization and the version
+    of pkdb_analysis.
+    """
+    substance = None
+    if tc["substance"]:
+        substance = info_node_registry.get(InfoNode.NTypes.Substance, pk=tc["substance"])
+    if inputs is not None:
+        inputs = {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in inputs.items()}
+
+    data = {
+        "inputs": inputs,
+        "outputs": {key: tc[key] for key in ["tissue", "method", "substance", "group", "individual", "interventions"]},
+        "substance_mass": substance.mass if substance else None,
+        "units": {key: sorted(unit.name for unit in measurement_type(name).units.all())
+                  for key, name in PK_MEASUREMENT_TYPES.items()},
+        "version": pk_library_version(),
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+_executor = None
+
+
+def executor() -> ProcessPoolExecutor:
+    """ Process pool of the pharmacokinetics fits, created on first use. """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.PK_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+def pk_fits(inputs: List[Dict], workers: int = None) -> List[Dict]:
+    """ Fits of many timecourses, in the process pool for more than one worker.
+
+    :param inputs: plain inputs of the timecourses (see pk_inputs)
+    :param workers: number of processes, defaults to settings.PK_WORKERS
+    :return: results of pk_fit.pk_fit in the order of the inputs
+    """
+    global _executor
+    workers = settings.PK_WORKERS if workers is None else workers
+    if workers < 2 or len(inputs) < 2:
+        return [pk_fit(single_inputs) for single_inputs in inputs]
+
+    try:
+        futures = [executor().submit(pk_fit, single_inputs) for single_inputs in inputs]
+    except BrokenProcessPool:
+        # a worker process died, the pool is replaced
+        _executor = None
+        futures = [executor().submit(pk_fit, single_inputs) for single_inputs in inputs]
+
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except BrokenProcessPool:
+            _executor = None
+            raise
+    return results
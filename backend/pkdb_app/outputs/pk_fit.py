@@ -0,0 +1,49 @@
+"""
+Pharmacokinetics fits on plain inputs.
+
+The module does not depend on Django, so fits can run in worker processes which
+only import numpy, pint and pkdb_analysis (see pk_calculation.pk_fits). Inputs and
+results are plain python/numpy values which can be pickled.
+"""
+from typing import Dict
+
+import numpy as np
+from pkdb_analysis.pk import pharmacokinetics
+
+from pkdb_app.info_nodes.units import ureg
+
+# pharmacokinetic parameters of the fits
+PK_KEYS = ["auc", "aucinf", "cl", "cmax", "kel", "thalf", "tmax", "vd", "vdss"]
+
+
+def pk_fit(inputs: Dict) -> Dict:
+    """ Calculates the pharmacokinetics of a timecourse.
+
+    :param inputs: plain inputs (see pk_calculation.pk_inputs)
+    :return: dictionary of parameter -> (magnitude, unit) for all defined parameters
+    """
+    Q_ = ureg.Quantity
+    variables = {
+        "ureg": ureg,  # for unit conversions
+        "substance": inputs["substance"],
+        "time": Q_(np.array(inputs["time"]), inputs["time_unit"]),
+        "concentration": Q_(inputs["concentration"], inputs["unit"]),
+        "dose": Q_(*inputs["dose"]),
+    }
+    if inputs["intervention_time"] is not None:
+        variables["intervention_time"] = Q_(*inputs["intervention_time"])
+
+    if inputs["single_dose"]:
+        pkinf = pharmacokinetics.TimecoursePK(**variables)
+    else:
+        _ = variables.pop("intervention_time", None)
+        pkinf = pharmacokinetics.TimecoursePKNoDosing(**variables)
+
+    pk = pkinf.pk
+    results = {}
+    for key in PK_KEYS:
+        pk_par = getattr(pk, key, None)
+        # check that exists
+        if pk_par and not np.isnan(pk_par.magnitude):
+            results[key] = (pk_par.magnitude, str(pk_par.units))
+    return results
@@ -0,0 +1,130 @@
+"""
+Incremental recomputation of the calculated pharmacokinetics outputs.
+
+Every timecourse stores the fingerprint of the inputs of its calculated outputs
+(SubSet.pk_fingerprint, see pk_calculation.pk_fingerprint). Only timecourses with a
+changed fingerprint are recalculated, e.g. after an update of pkdb_analysis or of
+the substance masses. The calculated outputs of these timecourses are replaced in bulk
+and only the affected elastic documents are updated.
+
+Studies are independent and processed in parallel worker processes.
+"""
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+import django
+from django.db import connection, transaction
+from rest_framework import serializers
+
+from pkdb_app.data.models import Data, SubSet
+from pkdb_app.data.serializers import SubSetSerializer
+from pkdb_app.outputs.documents import OutputDocument, OutputInterventionDocument
+from pkdb_app.outputs.models import Output, OutputIntervention
+from pkdb_app.outputs.pk_calculation import pk_inputs, pk_fingerprint
+from pkdb_app.studies.documents import StudyDocument
+from pkdb_app.studies.models import Study, IdCollection
+
+logger = logging.getLogger(__name__)
+
+RELATED_OUTPUTS = [
+    'individual',
+    'group',
+    'measurement_type__info_node',
+    'tissue__info_node',
+    'substance__info_node',
+]
+
+RELATED_OUTPUTS_INTERVENTION = [
+    'intervention',
+    'output',
+    'output__individual',
+    'output__group',
+    'output__measurement_type__info_node',
+    'output__tissue__info_node',
+    'output__substance__info_node',
+]
+
+
+def changed_timecourses(study: Study, force: bool = False) -> List[SubSet]:
+    """ Timecourses of the study whose fingerprint changed. """
+    changed = []
+    subsets = SubSet.objects.filter(study=study, data__data_type=Data.DataTypes.Timecourse).order_by("pk")
+    for subset in subsets:
+        timecourse = subset.timecourse
+        inputs = pk_inputs(timecourse, subset.get_single_dosing(timecourse["substance"]))
+        if force or pk_fingerprint(timecourse, inputs) != subset.pk_fingerprint:
+            changed.append(subset)
+    return changed
+
+
+def recompute_study(study_pk: int, force: bool = False, dry_run: bool = False) -> Dict:
+    """ Recomputes the calculated outputs of the changed timecourses of a study.
+
+    Errors of the study are stored in the summary, so the other studies are recomputed.
+    :return: summary of the study, with the error if the calculation failed
+    """
+    time_start = time.time()
+    summary = {"study": study_pk, "timecourses": 0, "deleted": 0, "created": 0, "error": None}
+    try:
+        study = Study.objects.get(pk=study_pk)
+        summary["study"] = study.sid
+        changed = changed_timecourses(study, force=force)
+        summary["timecourses"] = len(changed)
+        if not changed or dry_run:
+            return summary
+
+        with transaction.atomic():
+            old_outputs = list(Output.objects.filter(subset__in=changed, calculated=True))
+            old_output_interventions = list(OutputIntervention.objects.filter(output__in=old_outputs))
+            Output.objects.filter(pk__in=[output.pk for output in old_outputs]).delete()
+            SubSetSerializer.calculate_pks_from_many_timecourses(changed, workers=1)
+
+        new_outputs = Output.objects.filter(subset__in=changed, calculated=True)
+        summary["deleted"] = len(old_outputs)
+        summary["created"] = new_outputs.count()
+
+        # only the documents of the replaced outputs are updated
+        OutputInterventionDocument().update(old_output_interventions, action="delete")
+        OutputDocument().update(old_outputs, action="delete")
+        OutputDocument().update(new_outputs.select_related(*RELATED_OUTPUTS).prefetch_related('interventions'))
+        OutputInterventionDocument().update(
+            OutputIntervention.objects.select_related(*RELATED_OUTPUTS_INTERVENTION).filter(output__in=new_outputs))
+        StudyDocument().update(study)
+        IdCollection.invalidate_cache()
+
+    except serializers.ValidationError as err:
+        summary["error"] = err.detail
+    except Exception as err:
+        logger.exception(f"Recomputation of the pharmacokinetics of study <{summary['study']}> failed.")
+        summary["error"] = f"{type(err).__name__}: {err}"
+    finally:
+        summary["time"] = time.time() - time_start
+    return summary
+
+
+def _recompute_study(study_pk: int, force: bool, dry_run: bool) -> Dict:
+    """ recompute_study in a worker process. """
+    try:
+        return recompute_study(study_pk, force=force, dry_run=dry_run)
+    finally:
+        connection.close()
+
+
+def recompute_studies(study_pks: List[int], workers: int = 1, force: bool = False, dry_run: bool = False):
+    """ Recomputes the calculated outputs of the studies, in parallel for more than one worker.
+
+    :return: iterator of the summaries of the studies (in order of completion for workers > 1)
+    """
+    if workers < 2 or len(study_pks) < 2:
+        for study_pk in study_pks:
+            yield recompute_study(study_pk, force=force, dry_run=dry_run)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=django.setup) as executor:
+        futures = [executor.submit(_recompute_study, study_pk, force, dry_run) for study_pk in study_pks]
+        for future in futures:
+            yield future.result()
@@ -6,15 +6,15 @@ import warnings
 
 from rest_framework import serializers
 
-from pkdb_app import utils
 from pkdb_app.behaviours import MEASUREMENTTYPE_FIELDS, EX_MEASUREMENTTYPE_FIELDS, VALUE_FIELDS, map_field
 from pkdb_app.info_nodes.models import InfoNode
-from pkdb_app.info_nodes.serializers import MeasurementTypeableSerializer
+from pkdb_app.info_nodes.serializers import MeasurementTypeableSerializer, InfoNodeSlugRelatedField
 from pkdb_app.interventions.serializers import InterventionSmallElasticSerializer
 from .models import (
     Output,
     OutputSet,
-    OutputEx)
+    OutputEx,
+    OutputIntervention)
 from ..comments.serializers import DescriptionSerializer, CommentSerializer, DescriptionElasticSerializer, \
     CommentElasticSerializer
 from ..interventions.models import Intervention
@@ -27,7 +27,7 @@ from ..subjects.serializers import (
 # Serializer FIELDS
 # ----------------------------------
 from ..utils import list_of_pk, _validate_required_key, create_multiple, _create, create_multiple_bulk_normalized, \
-    create_multiple_bulk
+    create_multiple_bulk, _update
 
 EXTRA_FIELDS = ["tissue", "method", "label", "output_type"]
 TIME_FIELDS = ["time", "time_unit"]
@@ -67,17 +67,15 @@ class OutputSerializer(MeasurementTypeableSerializer):
         queryset=Intervention.objects.all(),
         many=True, required=True, allow_null=True)
 
-    tissue = utils.SlugRelatedField(
-        slug_field="name",
-        queryset=InfoNode.objects.filter(ntype=InfoNode.NTypes.Tissue),
+    tissue = InfoNodeSlugRelatedField(
+        InfoNode.NTypes.Tissue,
         read_only=False,
         required=False,
         allow_null=True,
     )
 
-    method = utils.SlugRelatedField(
-        slug_field="name",
-        queryset=InfoNode.objects.filter(ntype=InfoNode.NTypes.Method),
+    method = InfoNodeSlugRelatedField(
+        InfoNode.NTypes.Method,
         read_only=False,
         required=False
     )
@@ -211,22 +209,27 @@ class OutputExSerializer(ExSerializer):
             create_multiple_keys=['comments', 'descriptions'],
             pop=['outputs']
         )
+        self._create_outputs(output_ex, poped_data["outputs"])
+        return output_ex
+
+    def update(self, instance, validated_data):
+        """ Updates the output ex in place, its outputs are replaced (OutputSetSerializer.update). """
+        output_ex, poped_data = _update(instance, validated_data,
+                                        create_multiple_keys=['comments', 'descriptions'],
+                                        pop=['outputs'])
+        self.delete(output_ex.outputs.all())
+        self._create_outputs(output_ex, poped_data["outputs"])
+        return output_ex
 
-        outputs = poped_data["outputs"]
+    def _create_outputs(self, output_ex, outputs):
         outputs_interventions = []
         for output in outputs:
             output["study"] = self.context["study"]
             outputs_interventions.append(output.pop('interventions', []))
 
         outputs_dj = create_multiple_bulk(output_ex, 'ex', outputs, Output)
-        for output, interventions in zip(outputs_dj, outputs_interventions):
-            output.interventions.add(*interventions)
-
-        outputs_normed = create_multiple_bulk_normalized(outputs_dj, Output)
-        for output in outputs_normed:
-            output.interventions.add(*output.raw.interventions.all())
-
-        return output_ex
+        outputs_normed = create_multiple_bulk_normalized(outputs_dj, Output) or []
+        OutputIntervention.create_links([outputs_dj, outputs_normed], outputs_interventions)
 
 
 class OutputSetSerializer(ExSerializer):
@@ -262,6 +265,7 @@ class OutputSetSerializer(ExSerializer):
             pop=pop_keys
         )
 
+        hashes = [self.content_hash(output_ex) for output_ex in poped_data["output_exs"]]
         for k in pop_keys:
             for external_data in poped_data[k]:
                 external_data["outputset"] = outputset
@@ -278,17 +282,58 @@ class OutputSetSerializer(ExSerializer):
                 outputs_exs.append(output_ex_instance)
             outputset.output_exs.add(*outputs_exs)
             outputset.save()
+            self.store_ex_hashes("outputset", outputs_exs, hashes)
+            self._create_warnings(ws)
+        return outputset
 
+    def update(self, instance, validated_data):
+        """ Updates the output set of an incremental upload per output ex.
+
+        Output exs with the content hash of the last upload are kept with their outputs. Changed
+        output exs are updated in place and their outputs replaced, new exs are created and
+        removed exs deleted. The hashes contain the pks of the referenced groups, individuals
+        and interventions, so output exs referencing replaced instances are changed.
+        """
+        outputset, poped_data = _update(instance, validated_data,
+                                        create_multiple_keys=['descriptions', 'comments'],
+                                        pop=["output_exs"])
+        output_exs = poped_data["output_exs"]
+        hashes = [self.content_hash(output_ex) for output_ex in output_exs]
+        unchanged, stale = self.match_exs("outputset", hashes, outputset.output_exs.all())
 
-            # create warning messages
-            if len(ws) > 0:
+        with warnings.catch_warnings(record=True) as ws:
+            # warnings come from pharmacokinetics and error_measures
+            outputs_exs = []
+            changed_exs = []
+            updated_exs = list(stale)
+            for output_ex, unchanged_ex in zip(output_exs, unchanged):
+                if unchanged_ex is not None:
+                    outputs_exs.append(unchanged_ex)
+                    continue
+                output_ex["outputset"] = outputset
+                output_ex_serializer = OutputExSerializer(context=self.context)
+                if updated_exs:
+                    output_ex_instance = output_ex_serializer.update(updated_exs.pop(0), output_ex)
+                else:
+                    output_ex_instance = output_ex_serializer.create(output_ex)
+                outputs_exs.append(output_ex_instance)
+                changed_exs.append(output_ex_instance)
+            self._create_warnings(ws)
 
-                create_multiple(self.context["study"], [
-                    {
-                        "text": f"{w.filename}: '{w.message}'"
-                    } for w in ws], 'warnings')
+        self.delete(OutputEx.objects.filter(pk__in=[output_ex.pk for output_ex in updated_exs]))
+        self.store_ex_hashes("outputset", outputs_exs, hashes)
+        self.record_changes(Output, Output.objects.filter(ex__in=changed_exs).values_list("pk", flat=True))
         return outputset
 
+    def _create_warnings(self, ws):
+        # create warning messages
+        if len(ws) > 0:
+
+            create_multiple(self.context["study"], [
+                {
+                    "text": f"{w.filename}: '{w.message}'"
+                } for w in ws], 'warnings')
+
 
 # -----------------------
 # Elastic Serializer
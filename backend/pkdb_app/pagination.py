@@ -14,4 +14,27 @@ class CustomPagination(pagination.PageNumberPagination):
                 "prev_page_url": self.get_previous_link(),
                 "data": {"count": self.page.paginator.count, "data": data},
             }
-        )
\ No newline at end of file
+        )
+
+
+class IdSliceSearch(object):
+    """ Search restricted to the ids of a bitmap, paged by slicing the bitmap.
+
+    Only the ids of the requested page are decoded and send to elastic.
+    """
+
+    def __init__(self, search, bitmap):
+        self.search = search
+        self.bitmap = bitmap
+
+    def count(self):
+        return len(self.bitmap)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError("IdSliceSearch only supports slicing.")
+        ids = self.bitmap.slice(key.start, key.stop).tolist()
+        return self.search.query('ids', values=ids)[0:len(ids)]
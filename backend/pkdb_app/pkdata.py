@@ -0,0 +1,585 @@
+"""
+Helpers for filtering and downloading PKData.
+
+Filter results are cached under a key of the normalized query (see filter_query_key).
+
+The ids of a concise query are aggregated in postgres (concise_ids).
+
+Large id sets of the elastic lookups are restricted in postgres via temporary tables
+(IdTables) instead of IN lists with literal ids.
+
+The elastic lookups of a filter query are independent of each other and run concurrently
+on a thread pool with a dedicated elastic connection.
+
+The download archive is streamed: every sheet is written row by row as csv into a zip
+stream, which is send to the client chunk by chunk. The memory per request is therefore
+bounded by the size of a single chunk and not by the size of the export.
+
+Besides csv the sheets can be written as typed columnar files (parquet or arrow IPC), see
+FILE_FORMATS. These are written in record batches of ARROW_BATCH_SIZE rows, the column
+types are given by the serializer fields of the sheet (see sheet_kinds).
+"""
+import csv
+import hashlib
+import itertools
+import json
+import logging
+import time
+import uuid
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from typing import Callable, Dict, Iterable, Iterator, List
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.conf import settings
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from elasticsearch_dsl import Q as ESQ
+from elasticsearch_dsl.connections import connections
+from elasticsearch_dsl.query import Query
+from rest_framework import serializers
+
+from pkdb_app.outputs.models import Output
+from pkdb_app.users.permissions import user_group
+
+logger = logging.getLogger(__name__)
+
+# number of characters collected before a csv chunk is written to the archive
+CSV_CHUNK_SIZE = 2 ** 16
+
+# number of rows per record batch of parquet and arrow sheets
+ARROW_BATCH_SIZE = 10000
+
+# id sets with more ids are restricted via temporary tables
+ID_TABLE_MIN_SIZE = 1000
+
+# elastic connection alias of the pk lookups
+PKDATA_ES_ALIAS = "pkdata"
+
+Sheet = namedtuple("Sheet", ["sheet_name", "query_dict", "viewset", "serializer", "function", "boost_performance"])
+
+DOWNLOAD_EXTRA = [
+    ('download_extra/README.md', 'README.md'),
+    ('download_extra/TERMS_OF_USE.md', 'TERMS_OF_USE.md'),
+]
+
+
+def filter_query_key(params: Dict[str, str], concise: bool, user) -> str:
+    """ Key of a filter query.
+
+    Queries with the same parameters (independent of order) and the same
+    visible studies have the same key.
+
+    :param params: prefixed filter parameters, e.g. {"outputs__measurement_type__in": "auc__cmax"}
+    :param concise: concise flag of the query
+    :param user: user of the request
+    """
+    normalized = []
+    for key, value in params.items():
+        value = value.strip()
+        if key.endswith("__in"):
+            value = "__".join(sorted(v for v in value.split("__") if v))
+        normalized.append([key, value])
+
+    group = user_group(user)
+    query = {
+        "params": sorted(normalized),
+        "concise": bool(concise),
+        "group": group,
+        # basic users see their own private studies
+        "user": user.username if group == "basic" else None,
+    }
+    return hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest()
+
+
+def concise_ids(outputs) -> Dict[str, List[int]]:
+    """ Distinct ids of the resources of the outputs.
+
+    A single aggregation query with array_agg(DISTINCT ...) per resource.
+    """
+    timecourses = Q(subset_id__isnull=False, output_type=Output.OutputTypes.Timecourse)
+    scatters = Q(subset_id__isnull=False, output_type=Output.OutputTypes.Array)
+
+    ids = outputs.select_related(None).prefetch_related(None).order_by().aggregate(
+        studies=ArrayAgg("study_id", distinct=True),
+        groups=ArrayAgg("group_id", distinct=True, filter=Q(group_id__isnull=False)),
+        individuals=ArrayAgg("individual_id", distinct=True,
+                             filter=Q(group_id__isnull=True, individual_id__isnull=False)),
+        interventions=ArrayAgg("interventions__id", distinct=True, filter=Q(interventions__id__isnull=False)),
+        outputs=ArrayAgg("id", distinct=True),
+        timecourses=ArrayAgg("subset_id", distinct=True, filter=timecourses),
+        scatters=ArrayAgg("subset_id", distinct=True, filter=scatters),
+    )
+    # aggregations over no rows are None
+    return {resource: resource_ids or [] for resource, resource_ids in ids.items()}
+
+
+def concise_ids_loop(outputs) -> Dict[str, List[int]]:
+    """ Distinct ids of the resources of the outputs.
+
+    Iterates over all output x intervention rows, superseded by concise_ids
+    (used for benchmarking).
+    """
+    studies = set()
+    groups = set()
+    individuals = set()
+    interventions = set()
+    outputs_ids = set()
+    timecourses = set()
+    scatters = set()
+
+    for output in outputs.values("study_id", "group_id", "individual_id", "id", "interventions__id",
+                                 "subset__id", "output_type"):
+        studies.add(output["study_id"])
+        if output["group_id"]:
+            groups.add(output["group_id"])
+        else:
+            individuals.add(output["individual_id"])
+        outputs_ids.add(output["id"])
+
+        if output["interventions__id"]:
+            interventions.add(output["interventions__id"])
+
+        if (output["subset__id"] is not None) & (output["output_type"] == Output.OutputTypes.Timecourse):
+            timecourses.add(output["subset__id"])
+
+        if (output["subset__id"] is not None) & (output["output_type"] == Output.OutputTypes.Array):
+            scatters.add(output["subset__id"])
+
+    return {
+        "studies": list(studies),
+        "groups": list(groups),
+        "individuals": list(individuals),
+        "interventions": list(interventions),
+        "outputs": list(outputs_ids),
+        "timecourses": list(timecourses),
+        "scatters": list(scatters),
+    }
+
+
+class IdTables(object):
+    """ Temporary tables of id sets in the database session.
+
+    Large sets are copied into a temporary table and used as subquery, e.g.
+    Output.objects.filter(id__in=id_tables.subquery(pks)). Tables are removed with drop()
+    or at the end of the database session.
+    """
+
+    def __init__(self, min_size: int = ID_TABLE_MIN_SIZE):
+        self.min_size = min_size
+        self.tables = []
+
+    def subquery(self, ids: List[int]):
+        """ Ids for an __in lookup, the ids itself for small sets. """
+        if len(ids) < self.min_size:
+            return ids
+
+        table = f"pkdata_ids_{uuid.uuid4().hex}"
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TEMPORARY TABLE {table} (id integer NOT NULL)")
+            cursor.copy_from(StringIO("\n".join(str(pk) for pk in ids)), table, columns=("id",))
+            cursor.execute(f"ANALYZE {table}")
+        self.tables.append(table)
+        return RawSQL(f"SELECT id FROM {table}", [])
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            for table in self.tables:
+                cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        self.tables = []
+
+
+def pkdata_es_connection():
+    """ Elastic connection of the pk lookups, the connection pool is sized for the worker threads. """
+    try:
+        return connections.get_connection(PKDATA_ES_ALIAS)
+    except KeyError:
+        return connections.create_connection(
+            alias=PKDATA_ES_ALIAS,
+            maxsize=settings.PKDATA_ES_WORKERS,
+            **settings.ELASTICSEARCH_DSL["default"]
+        )
+
+
+def _timed(lookup: Callable):
+    """ Runs lookup in a worker thread and returns (result, duration). """
+    time_start = time.time()
+    try:
+        return lookup(), time.time() - time_start
+    finally:
+        # every thread opens its own database connection (permission lookups)
+        connection.close()
+
+
+def resolve_concurrent(lookups: Dict[str, Callable], workers: int = None):
+    """ Evaluates independent lookups concurrently.
+
+    :param lookups: dictionary of key -> callable without arguments
+    :param workers: number of threads, defaults to settings.PKDATA_ES_WORKERS
+    :return: (results, timings) dictionaries with the keys of lookups
+    """
+    workers = settings.PKDATA_ES_WORKERS if workers is None else workers
+    results = {}
+    timings = {}
+    if workers < 2 or len(lookups) < 2:
+        for key, lookup in lookups.items():
+            time_start = time.time()
+            results[key] = lookup()
+            timings[key] = time.time() - time_start
+        return results, timings
+
+    pkdata_es_connection()
+    with ThreadPoolExecutor(max_workers=min(workers, len(lookups))) as executor:
+        futures = {key: executor.submit(_timed, lookup) for key, lookup in lookups.items()}
+        for key, future in futures.items():
+            results[key], timings[key] = future.result()
+    return results, timings
+
+
+def data_queryset(request, query_dict, viewset, serializer, boost):
+    """ Elastic search of a download sheet.
+
+    :param query_dict: dictionary of field -> query or terms of the field
+    """
+    view = viewset(request=request)
+    queryset = view.get_queryset()
+    if query_dict is not None:
+        for field, terms in query_dict.items():
+            queryset = queryset.filter(terms if isinstance(terms, Query) else ESQ("terms", **{field: terms}))
+    if boost:
+        queryset = queryset.source(serializer.Meta.fields)
+    return queryset.params(size=5000)
+
+
+def iter_data_by_query_dict(request, query_dict, viewset, serializer, boost):
+    """ Serializes the hits of a download sheet one by one while scanning. """
+    queryset = data_queryset(request, query_dict, viewset, serializer, boost)
+    if boost:
+        return (hit.to_dict() for hit in queryset.scan())
+
+    else:
+        return (serializer(hit).data for hit in queryset.scan())
+
+
+def sheet_rows(request, sheet: Sheet):
+    """ Rows, fields and column kinds of a download sheet.
+
+    If the fields are None the keys of the first row are used as fields.
+    """
+    if sheet.function:
+        return sheet.function(sheet.query_dict["subset_pk"]), None, {}
+
+    rows = iter_data_by_query_dict(request, sheet.query_dict, sheet.viewset, sheet.serializer,
+                                   sheet.boost_performance)
+    # boosted hits only contain the fields with values
+    fields = sheet.serializer.Meta.fields if sheet.boost_performance else None
+    return rows, fields, sheet_kinds(sheet.serializer)
+
+
+class ZipStream(object):
+    """ Unseekable file object collecting the bytes written by a ZipFile.
+
+    The zipfile module falls back to data descriptors for unseekable files, so entries
+    can be written without knowing their size in advance.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        """ Returns and clears the bytes written since the last call. """
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def sheet_fields(rows: Iterator[Dict], fields: List = None):
+    """ Header of a sheet and the (unconsumed) rows.
+
+    If no fields are given the keys of the first row are used.
+    """
+    if fields is not None:
+        return list(fields), rows
+    rows = iter(rows)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return [], iter([])
+    return list(first.keys()), itertools.chain([first], rows)
+
+
+def csv_chunks(fields: List, rows: Iterable[Dict], chunk_size: int = CSV_CHUNK_SIZE) -> Iterator[bytes]:
+    """ Encoded csv content in chunks of approximately chunk_size characters.
+
+    The layout is identical to pandas.DataFrame.to_csv, i.e. with a leading index column.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(["", *fields])
+    for index, row in enumerate(rows):
+        writer.writerow([index, *(row.get(field) for field in fields)])
+        if buffer.tell() > chunk_size:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+class CountedRows(object):
+    """ Iterator over rows counting the consumed rows. """
+
+    def __init__(self, rows: Iterable[Dict]):
+        self.rows = iter(rows)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = next(self.rows)
+        self.count += 1
+        return row
+
+
+def csv_writer(entry, fields: List, rows: Iterable[Dict], kinds: Dict = None) -> Iterator:
+    """ Writes the rows as csv to the archive entry, yields after every chunk. """
+    for chunk in csv_chunks(fields, rows):
+        entry.write(chunk)
+        yield
+
+
+# kinds of the columns of serializer fields, the first matching class is used (see sheet_kinds)
+SERIALIZER_FIELD_KINDS = [
+    (serializers.BooleanField, "bool"),
+    (serializers.IntegerField, "int"),
+    ((serializers.FloatField, serializers.DecimalField), "float"),
+]
+
+ARROW_TYPES = {
+    "bool": pa.bool_(),
+    "int": pa.int64(),
+    "float": pa.float64(),
+    "int_list": pa.list_(pa.int64()),
+    "float_list": pa.list_(pa.float64()),
+    "string": pa.string(),
+}
+
+
+def sheet_kinds(serializer) -> Dict:
+    """ Kinds of the columns of a sheet from the fields of its serializer.
+
+    The kinds of SerializerMethodFields are declared in Meta.column_kinds of the serializer.
+    Columns without kind (and all columns of sheets without serializer) are strings.
+    :return: dictionary of field -> kind (see ARROW_TYPES)
+    """
+    if serializer is None:
+        return {}
+    kinds = {}
+    for name, field in serializer().fields.items():
+        for field_class, kind in SERIALIZER_FIELD_KINDS:
+            if isinstance(field, field_class):
+                kinds[name] = kind
+                break
+    kinds.update(getattr(getattr(serializer, "Meta", None), "column_kinds", {}))
+    return kinds
+
+
+def _to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def _to_int(value):
+    """ Integer value, floats are only accepted without fractional part. """
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return int(value)
+    raise ValueError(f"<{value}> is not an integer")
+
+
+def _to_list(convert):
+    def to_list(value):
+        if value is None:
+            return None
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [convert(v) for v in value]
+        return [convert(value)]
+    return to_list
+
+
+def _to_float(value):
+    return None if value is None else float(value)
+
+
+ARROW_CONVERTERS = {
+    "bool": lambda v: v if v is None else bool(v),
+    "int": _to_int,
+    "float": _to_float,
+    "int_list": _to_list(_to_int),
+    "float_list": _to_list(_to_float),
+    "string": _to_string,
+}
+
+
+def arrow_schema(fields: List, kinds: Dict):
+    """ Arrow schema of a sheet from the kinds of its columns (see sheet_kinds).
+
+    The schema only depends on the serializer of the sheet, so the types of a sheet are
+    identical for all downloads. Nested values of string columns are stored as json.
+    :return: (schema, kinds)
+    """
+    kinds = {field: kinds.get(field, "string") for field in fields}
+    schema = pa.schema([(field, ARROW_TYPES[kinds[field]]) for field in fields])
+    return schema, kinds
+
+
+def record_batches(fields: List, rows: Iterable[Dict], kinds: Dict, batch_size: int = ARROW_BATCH_SIZE):
+    """ Rows as arrow record batches, every batch is converted as soon as its rows are read.
+
+    :return: (schema, iterator of record batches)
+    """
+    rows = iter(rows)
+    schema, kinds = arrow_schema(fields, kinds)
+
+    def to_batch(batch: List[Dict]):
+        arrays = []
+        for field in fields:
+            convert = ARROW_CONVERTERS[kinds[field]]
+            try:
+                values = [convert(row.get(field)) for row in batch]
+                arrays.append(pa.array(values, type=schema.field(field).type))
+            except (TypeError, ValueError, pa.ArrowException) as err:
+                raise ValueError(f"Values of column '{field}' do not match the column type "
+                                 f"'{kinds[field]}': {err}") from err
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def batches():
+        batch = list(itertools.islice(rows, batch_size))
+        while batch:
+            yield to_batch(batch)
+            batch = list(itertools.islice(rows, batch_size))
+
+    return schema, batches()
+
+
+class EntryFile(object):
+    """ Write only file object of an archive entry which keeps track of the position.
+
+    The zip entries are not seekable, but the arrow writers query the position.
+    """
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.entry.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        # the entry is closed by the archive
+        self.closed = True
+
+
+def parquet_writer(entry, fields: List, rows: Iterable[Dict], kinds: Dict = None) -> Iterator:
+    """ Writes the rows as compressed parquet file to the archive entry, yields after every batch. """
+    schema, batches = record_batches(fields, rows, kinds or {})
+    writer = pq.ParquetWriter(EntryFile(entry), schema, compression="zstd")
+    try:
+        for batch in batches:
+            writer.write_table(pa.Table.from_batches([batch], schema=schema))
+            yield
+    finally:
+        writer.close()
+
+
+def arrow_writer(entry, fields: List, rows: Iterable[Dict], kinds: Dict = None) -> Iterator:
+    """ Writes the rows as compressed arrow IPC file to the archive entry, yields after every batch. """
+    schema, batches = record_batches(fields, rows, kinds or {})
+    options = pa.ipc.IpcWriteOptions(compression="zstd")
+    writer = pa.ipc.new_file(EntryFile(entry), schema, options=options)
+    try:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield
+    finally:
+        writer.close()
+
+
+FileFormat = namedtuple("FileFormat", ["extension", "writer", "compress_type"])
+
+# the columnar files are compressed already and stored without zip compression
+FILE_FORMATS = {
+    "csv": FileFormat("csv", csv_writer, zipfile.ZIP_DEFLATED),
+    "parquet": FileFormat("parquet", parquet_writer, zipfile.ZIP_STORED),
+    "arrow": FileFormat("arrow", arrow_writer, zipfile.ZIP_STORED),
+}
+
+
+def stream_archive(sheets: Dict[str, Callable], progress: Callable = None,
+                   file_format: str = "csv") -> Iterator[bytes]:
+    """ Zip archive of sheets as stream of bytes.
+
+    :param sheets: dictionary of sheet key -> callable returning (rows, fields, kinds), rows are
+        dictionaries, kinds the column kinds of the typed formats (see sheet_kinds). The callable
+        is only evaluated when the sheet is written.
+    :param progress: optional callback progress(key, rows, finished), called for every written chunk
+    :param file_format: format of the sheets, one of FILE_FORMATS
+    """
+    file_format = FILE_FORMATS[file_format]
+    stream = ZipStream()
+    download_times = {}
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for key, sheet in sheets.items():
+            download_time_start = time.time()
+            rows, fields, kinds = sheet()
+            fields, rows = sheet_fields(rows, fields)
+            rows = CountedRows(rows)
+            info = zipfile.ZipInfo(f'{key}.{file_format.extension}', date_time=time.localtime()[:6])
+            info.compress_type = file_format.compress_type
+            info.external_attr = 0o600 << 16
+            with archive.open(info, 'w', force_zip64=True) as entry:
+                for _ in file_format.writer(entry, fields, rows, kinds):
+                    if progress:
+                        progress(key, rows.count, False)
+                    data = stream.pop()
+                    if data:
+                        yield data
+            if progress:
+                progress(key, rows.count, True)
+            download_times[key] = time.time() - download_time_start
+
+        for path, name in DOWNLOAD_EXTRA:
+            archive.write(path, name)
+        yield stream.pop()
+    yield stream.pop()
+
+    for k, v in download_times.items():
+        logger.debug(f"file creation {k}: {v}")
@@ -1,12 +1,15 @@
 import copy
+import hashlib
+import io
+import json
 import numbers
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple, defaultdict
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-from django.db.models import Q
+from django.db import models
 from pkdb_app.info_nodes.models import InfoNode
 from rest_framework import serializers
 from rest_framework.settings import api_settings
@@ -311,15 +314,32 @@ class MappingSerializer(WrongKeyValidationSerializer):
                               f"file with the suffix: <.tsv>"
                 })
 
+        # parsed DataFrames and subsets are cached for the upload by (DataFile pk, content hash),
+        # the cached DataFrames are shared and must not be modified
+        frames = self.source_frames()
+        hashes = self.source_hashes()
+
         # read the TSV
         try:
-            df = pd.read_csv(
-                src.file,
-                delimiter="\t",
-                keep_default_na=False,
-                na_values=NA_VALUES,
-            )
-            df.columns = df.columns.str.strip()
+            content = None
+            if hashes.get(str(src.pk)) is None:
+                with src.file.open("rb") as f:
+                    content = f.read()
+                hashes[str(src.pk)] = hashlib.sha256(content).hexdigest()
+            key = (src.pk, hashes[str(src.pk)])
+            df = frames.get(key)
+            if df is None:
+                if content is None:
+                    with src.file.open("rb") as f:
+                        content = f.read()
+                df = pd.read_csv(
+                    io.BytesIO(content),
+                    delimiter="\t",
+                    keep_default_na=False,
+                    na_values=NA_VALUES,
+                )
+                df.columns = df.columns.str.strip()
+                frames[key] = df
 
         except Exception as e:
             raise serializers.ValidationError(
@@ -331,19 +351,61 @@ class MappingSerializer(WrongKeyValidationSerializer):
 
         # filter subset
         if subset:
-            if "&" in subset:
-                for subset_single in [s.strip() for s in subset.split("&")]:
-                    df = self.subset_pd(subset_single, df)
-            else:
-                df = self.subset_pd(subset, df)
+            subsets = [s.strip() for s in subset.split("&")]
+            for k, subset_single in enumerate(subsets):
+                subset_key = key + tuple(subsets[:k + 1])
+                if subset_key not in frames:
+                    frames[subset_key] = self.subset_pd(subset_single, df)
+                df = frames[subset_key]
 
         return df
 
-    def make_entry(self, entry, template, data, source):
-        entry_dict = copy.deepcopy(template)
-        recursive_entry_dict = list(recursive_iter(entry_dict))
+    def source_frames(self) -> dict:
+        """ Cache of parsed source files and subsets of the upload, stored in the serializer context. """
+        return self.context.setdefault("source_frames", {})
+
+    def source_hashes(self) -> dict:
+        """ Content hashes of the source files of the upload by DataFile pk (str), stored in the
+        serializer context, so every file is read once per upload. """
+        return self.context.setdefault("source_hashes", {})
+
+    @staticmethod
+    def _source_columns(df) -> dict:
+        """ Columns which can be referenced by 'col==', i.e. the fields of df.itertuples().
 
-        for keys, value in recursive_entry_dict:
+        :return: dict of field -> position in df (-1 for the index)
+        """
+        fields = namedtuple("Pandas", ["Index"] + [str(c) for c in df.columns], rename=True)._fields
+        return {field: k - 1 for k, field in enumerate(fields)}
+
+    @staticmethod
+    def _column_values(column) -> list:
+        """ Values of a source column with stripped strings and nan -> None. """
+        is_string = column.dtype == object or pd.api.types.is_string_dtype(column.dtype)
+        if is_string:
+            try:
+                stripped = column.str.strip()
+                # non strings are nan after strip
+                column = stripped.where(stripped.notna(), column)
+            except AttributeError:
+                pass
+        values = column.tolist()
+        if is_string or np.issubdtype(column.dtype, np.floating):
+            na = pd.isna(column).to_numpy()
+            for k in np.flatnonzero(na):
+                if isinstance(values[k], numbers.Number):
+                    values[k] = None
+        return values
+
+    def compile_template(self, template, df, data, source) -> list:
+        """ Compiles the 'col==' references of the template.
+
+        :return: list of operations (keys, values), values of the referenced column for all rows of df
+        """
+        columns = self._source_columns(df)
+        column_values = {}
+        operations = []
+        for keys, value in recursive_iter(template):
             if isinstance(value, str):
                 if ITEM_MAPPER in value:
                     values = value.split(ITEM_MAPPER)
@@ -352,43 +414,69 @@ class MappingSerializer(WrongKeyValidationSerializer):
                         raise serializers.ValidationError(
                             ["Field has wrong pattern col=='col_value'.", data]
                         )
-                    try:
-                        entry_value = getattr(entry, values[1])
-
-                    except AttributeError:
-
+                    column = values[1]
+                    if column not in columns:
                         raise serializers.ValidationError(
                             [
-                                f"Header key <{values[1]}> does not exist in <{DataFile.objects.get(pk=source).file}>.",
+                                f"Header key <{column}> does not exist in <{DataFile.objects.get(pk=source).file}>.",
                                 data
                             ]
                         )
-                    if isinstance(entry_value, numbers.Number):
-                        if np.isnan(entry_value):
-                            entry_value = None
-
-                    if isinstance(entry_value, str):
-                        entry_value = entry_value.strip()
+                    if column not in column_values:
+                        position = columns[column]
+                        series = df.index.to_series() if position == -1 else df.iloc[:, position]
+                        column_values[column] = self._column_values(series)
 
                     if keys[0] in ["interventions", "dimensions", "shared"]:
-                        entry_value = self.string_to_list(entry_value)
-                        set_keys(entry_dict, entry_value, *keys[:1])
-
+                        operations.append(
+                            (keys[:1], [self.string_to_list(v) for v in column_values[column]])
+                        )
                     else:
-                        set_keys(entry_dict, entry_value, *keys)
-        return entry_dict
+                        operations.append((keys, column_values[column]))
+        return operations
+
+    @staticmethod
+    def _copy_template(template):
+        """ Copy of the containers of the template, leaves are immutable json values. """
+        if isinstance(template, dict):
+            return {key: MappingSerializer._copy_template(value) for key, value in template.items()}
+        if isinstance(template, list):
+            return [MappingSerializer._copy_template(value) for value in template]
+        return template
+
+    def make_entries(self, template, operations, rows) -> list:
+        """ Entries of the template for the given rows (positions in df) of the compiled operations. """
+        entries = []
+        for row in rows:
+            entry_dict = self._copy_template(template)
+            for keys, values in operations:
+                set_keys(entry_dict, values[row], *keys)
+            entries.append(entry_dict)
+        return entries
 
     def _groupby_with_list(self, keys, template, df, data, source, groupby, entries):
         poped_keys = {key: template.pop(key) for key in keys if key in template}
-        for non_values_keys, group_df in df.groupby(groupby, sort=False):
-            entry_dict = self.make_entry(next(group_df.itertuples()), template, data, source)
+        codes = np.asarray(df.groupby(groupby, sort=False).ngroup(), dtype=float)
+        if len(df) == 0:
+            return
+
+        operations = self.compile_template(template, df, data, source)
+        poped_operations = {
+            key: [self.compile_template(value, df, values, source) for value in values]
+            for key, values in poped_keys.items()
+        }
+
+        valid = np.flatnonzero(codes >= 0)
+        order = valid[np.argsort(codes[valid], kind="stable")]
+        groups = np.split(order, np.flatnonzero(np.diff(codes[order])) + 1) if len(order) else []
+        for group_rows in groups:
+            entry_dict = self.make_entries(template, operations, group_rows[:1])[0]
 
             new_values = []
-            for entry in group_df.itertuples():
+            for row in group_rows:
                 for key, values in poped_keys.items():
-                    for value in values:
-                        value = self.make_entry(entry, value, values, source)
-                        new_values.append(value)
+                    for value, value_operations in zip(values, poped_operations[key]):
+                        new_values.extend(self.make_entries(value, value_operations, [row]))
 
                     entry_dict[key] = new_values
             entries.append(entry_dict)
@@ -426,10 +514,9 @@ class MappingSerializer(WrongKeyValidationSerializer):
                             data
                         ]
                     )
-            else:
-                for entry in df.itertuples():
-                    entry_dict = self.make_entry(entry, template, data, source)
-                    entries.append(entry_dict)
+            elif len(df):
+                operations = self.compile_template(template, df, data, source)
+                entries.extend(self.make_entries(template, operations, range(len(df))))
 
             if len(mappings) == 0 and len(entries) == 0:
                 raise serializers.ValidationError(
@@ -471,18 +558,115 @@ class MappingSerializer(WrongKeyValidationSerializer):
         return rep
 
 
+class StudyLookup(object):
+    """ Name -> pk lookup of the groups, individuals and normed interventions of a study.
+
+    The names of each model are loaded with a single query on first use instead of querying
+    every row of an upload. Groups, individuals and interventions are uploaded before the
+    rows referencing them, so the lookup does not change during an upload.
+    """
+
+    def __init__(self, study_sid):
+        self.study_sid = study_sid
+        self._pks = {}
+
+    def _load(self, model):
+        queryset = model.objects.filter(study__sid=self.study_sid)
+        if model is Intervention:
+            queryset = queryset.filter(normed=True)
+        pks = {}
+        for pk, name in queryset.values_list("pk", "name"):
+            pks.setdefault(name, []).append(pk)
+        return pks
+
+    def get(self, model, name) -> int:
+        """ pk of the object with the name.
+
+        :raises model.DoesNotExist: if no object has the name
+        :raises model.MultipleObjectsReturned: if multiple objects have the name
+        """
+        if model not in self._pks:
+            self._pks[model] = self._load(model)
+        pks = self._pks[model].get(str(name), [])
+        if not pks:
+            raise model.DoesNotExist(f"{model.__name__} <{name}> does not exist.")
+        if len(pks) > 1:
+            raise model.MultipleObjectsReturned(f"{model.__name__} <{name}> is defined multiple times.")
+        return pks[0]
+
+
 class ExSerializer(MappingSerializer):
 
+    def study_lookup(self, study_sid) -> StudyLookup:
+        """ StudyLookup of the upload, stored in the serializer context. """
+        lookup = self.context.get("study_lookup")
+        if lookup is None or lookup.study_sid != study_sid:
+            lookup = StudyLookup(study_sid)
+            self.context["study_lookup"] = lookup
+        return lookup
+
+    # ----------------------------------
+    # incremental uploads
+    # ----------------------------------
+    @staticmethod
+    def content_hash(validated_data) -> str:
+        """ Content hash of validated data, instances are hashed by their pks.
+
+        Instances referenced by the data (e.g. the group of an output) are part of the hash, so
+        the hash changes if they are replaced.
+        """
+        def default(value):
+            if isinstance(value, models.Model):
+                return f"{value._meta.label}:{value.pk}"
+            return str(value)
+
+        content = json.dumps(validated_data, sort_keys=True, default=default)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def match_exs(self, related_set, hashes, exs):
+        """ Matches the uploaded exs to the exs of the last upload by their content hashes.
+
+        :param related_set: related set of the study (Study.related_set_hashes)
+        :param hashes: content hashes of the uploaded exs
+        :param exs: exs of the last upload
+        :return: the unchanged ex for every uploaded ex (None if changed), the exs of the last
+                 upload which are not unchanged
+        """
+        stored = self.context["study"].related_set_hashes(related_set).get("exs", {})
+        exs_by_hash = defaultdict(list)
+        for ex in exs:
+            exs_by_hash[stored.get(str(ex.pk))].append(ex)
+        unchanged = [exs_by_hash[ex_hash].pop(0) if exs_by_hash.get(ex_hash) else None for ex_hash in hashes]
+        unchanged_pks = {ex.pk for ex in unchanged if ex is not None}
+        return unchanged, [ex for ex in exs if ex.pk not in unchanged_pks]
+
+    def store_ex_hashes(self, related_set, exs, hashes):
+        """ Stores the content hashes of the uploaded exs (saved with the study). """
+        self.context["study"].related_set_hashes(related_set)["exs"] = {
+            str(ex.pk): ex_hash for ex, ex_hash in zip(exs, hashes)
+        }
+
+    def record_changes(self, model, pks):
+        """ Records the created or updated instances of an upload (UploadChanges). """
+        changes = self.context.get("upload_changes")
+        if changes is not None:
+            changes.change(model, pks)
+
+    def delete(self, queryset):
+        """ Deletes the queryset, the deleted instances are recorded for an upload (UploadChanges). """
+        changes = self.context.get("upload_changes")
+        if changes is not None:
+            changes.delete(queryset)
+        else:
+            queryset.delete()
 
     def to_internal_related_fields(self, data):
         study_sid = self.context["request"].path.split("/")[-2]
+        lookup = self.study_lookup(study_sid)
         if "group" in data:
             if data["group"]:
                 try:
-                    data["group"] = Group.objects.get(
-                        Q(study__sid=study_sid)
-                        & Q(name=data.get("group"))
-                    ).pk
+                    data["group"] = lookup.get(Group, data.get("group"))
                 except ObjectDoesNotExist:
                     raise serializers.ValidationError(
                         f'Group <{data.get("group")}> does not exist, check groups.'
@@ -495,9 +679,7 @@ class ExSerializer(MappingSerializer):
         if "individual" in data:
             if data["individual"]:
                 try:
-                    data["individual"] = Individual.objects.get(
-                        Q(study__sid=study_sid) & Q(name=data.get("individual"))
-                    ).pk
+                    data["individual"] = lookup.get(Individual, data.get("individual"))
 
                 except ObjectDoesNotExist:
                     raise serializers.ValidationError(
@@ -518,12 +700,7 @@ class ExSerializer(MappingSerializer):
 
                 for intervention in data["interventions"]:
                     try:
-                        interventions.append(
-                            Intervention.objects.get(
-                                Q(study__sid=study_sid)
-                                & Q(name=intervention, normed=True)
-                            ).pk
-                        )
+                        interventions.append(lookup.get(Intervention, intervention))
                     except ObjectDoesNotExist:
                         raise serializers.ValidationError(
                             f"Intervention <{intervention}> does not exist, check interventions."
@@ -237,6 +237,12 @@ ELASTICSEARCH_DSL = {
         'hosts': 'elasticsearch:9200'
     },
 }
+# number of concurrent elastic lookups in the filter endpoint (1 for serial lookups)
+PKDATA_ES_WORKERS = int(os.getenv("PKDB_PKDATA_ES_WORKERS", 5))
+# number of worker processes for background jobs (per web worker)
+JOB_WORKERS = int(os.getenv("PKDB_JOB_WORKERS", 2))
+# number of worker processes for the pharmacokinetics fits of an upload (1 for serial fits)
+PK_WORKERS = int(os.getenv("PKDB_PK_WORKERS", 4))
 
 DJANGO_CONFIGURATION = os.environ['PKDB_DJANGO_CONFIGURATION']
 # ------------------------------
@@ -0,0 +1,105 @@
+"""
+Benchmark of the concise id collection of the filter endpoint.
+
+Compares the SQL aggregation (concise_ids) with the former python loop over
+the output x intervention rows (concise_ids_loop) on a synthetic study.
+The synthetic study is created in a transaction which is rolled back.
+
+python manage.py benchmark_concise_ids --outputs 200000 --interventions 5
+"""
+import time
+
+from django.core.management import CommandError
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from pkdb_app.data.models import Data, SubSet
+from pkdb_app.info_nodes.models import MeasurementType
+from pkdb_app.interventions.models import Intervention
+from pkdb_app.outputs.models import Output, OutputIntervention
+from pkdb_app.pkdata import concise_ids, concise_ids_loop
+from pkdb_app.studies.models import Study
+from pkdb_app.subjects.models import Group, Individual
+from pkdb_app.users.models import User, PUBLIC
+
+BATCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = 'Benchmark of the concise id collection on a synthetic study (rolled back).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--outputs', type=int, default=200000, help="Number of outputs")
+        parser.add_argument('--interventions', type=int, default=5, help="Number of interventions per output")
+        parser.add_argument('--repeat', type=int, default=3, help="Number of repetitions")
+
+    def handle(self, *args, **options):
+        measurement_type = MeasurementType.objects.first()
+        if measurement_type is None:
+            raise CommandError("The benchmark requires measurement types, upload the info nodes first.")
+
+        with transaction.atomic():
+            time_start = time.time()
+            study = self.synthetic_study(measurement_type, options["outputs"], options["interventions"])
+            self.stdout.write(f"synthetic study: {time.time() - time_start:.2f} s")
+
+            outputs = Output.objects.filter(study=study, normed=True)
+            rows = OutputIntervention.objects.filter(output__study=study).count()
+            self.stdout.write(f"outputs: {options['outputs']}, output-intervention rows: {rows}")
+
+            results = {}
+            for name, function in [("loop", concise_ids_loop), ("sql", concise_ids)]:
+                durations = []
+                for _ in range(options["repeat"]):
+                    time_start = time.time()
+                    results[name] = function(outputs)
+                    durations.append(time.time() - time_start)
+                self.stdout.write(f"{name}: min {min(durations):.3f} s, mean {sum(durations) / len(durations):.3f} s")
+
+            for resource, ids in results["loop"].items():
+                if set(ids) != set(results["sql"][resource]):
+                    raise CommandError(f"Different ids for '{resource}'.")
+            self.stdout.write("identical ids")
+
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def synthetic_study(measurement_type, n_outputs, n_interventions):
+        creator = User.objects.create(username="benchmark_concise_ids")
+        study = Study.objects.create(
+            sid="BENCHMARK0", name="benchmark_concise_ids", access=PUBLIC, creator=creator)
+
+        n_groups = max(n_outputs // 100, 1)
+        groups = Group.objects.bulk_create(
+            [Group(name=f"group_{k}", count=10, study=study) for k in range(n_groups)])
+        individuals = Individual.objects.bulk_create(
+            [Individual(name=f"individual_{k}", group=groups[k % n_groups], study=study) for k in range(n_groups)])
+        interventions = Intervention.objects.bulk_create(
+            [Intervention(name=f"intervention_{k}", measurement_type=measurement_type, normed=True, study=study)
+             for k in range(max(n_interventions * 4, 1))])
+
+        data = Data.objects.create(name="benchmark", data_type=Data.DataTypes.Timecourse)
+        subsets = SubSet.objects.bulk_create(
+            [SubSet(name=f"subset_{k}", data=data, study=study) for k in range(max(n_outputs // 20, 1))])
+
+        for start in range(0, n_outputs, BATCH_SIZE):
+            outputs = []
+            for k in range(start, min(start + BATCH_SIZE, n_outputs)):
+                on_group = k % 2 == 0
+                output_type = [Output.OutputTypes.Output, Output.OutputTypes.Timecourse, Output.OutputTypes.Array][k % 3]
+                outputs.append(Output(
+                    study=study,
+                    measurement_type=measurement_type,
+                    normed=True,
+                    output_type=output_type,
+                    group=groups[k % n_groups] if on_group else None,
+                    individual=None if on_group else individuals[k % n_groups],
+                    subset=None if output_type == Output.OutputTypes.Output else subsets[k % len(subsets)],
+                ))
+            outputs = Output.objects.bulk_create(outputs)
+            OutputIntervention.objects.bulk_create([
+                OutputIntervention(output=output, intervention=interventions[(k + i) % len(interventions)])
+                for k, output in enumerate(outputs) for i in range(n_interventions)
+            ], batch_size=BATCH_SIZE)
+
+        return study
@@ -2,10 +2,13 @@
 Django model for Study.
 """
 import datetime
+import time
+import uuid
 from django.utils.timezone import make_aware
 
 from django.contrib.postgres.fields import ArrayField
 from django.db import models
+from pkdb_app.bitmaps import Bitmap
 from pkdb_app.data.models import DataSet, Data
 
 from pkdb_app.info_nodes.models import Substance, InfoNode
@@ -41,6 +44,29 @@ STUDY_ACCESS_DATA = [
 ]
 STUDY_ACCESS_CHOICES = [(t, t) for t in STUDY_ACCESS_DATA]
 
+# related sets which are deleted or have to be uploaded again if a related set is replaced: sets
+# referencing its instances and the outputs of the subsets (timecourses and scatters are deleted
+# with their subsets)
+RELATED_SET_DEPENDENTS = {
+    "groupset": ["individualset", "outputset"],
+    "individualset": ["outputset"],
+    "interventionset": ["outputset"],
+    "outputset": ["dataset"],
+    "dataset": ["outputset"],
+}
+
+
+def related_set_dependents(related_sets) -> set:
+    """ Related sets with all the sets depending on them (RELATED_SET_DEPENDENTS). """
+    dependents = set()
+    pending = list(related_sets)
+    while pending:
+        related_set = pending.pop()
+        if related_set not in dependents:
+            dependents.add(related_set)
+            pending.extend(RELATED_SET_DEPENDENTS.get(related_set, []))
+    return dependents
+
 
 # ---------------------------------------------------
 
@@ -139,6 +165,10 @@ class Study(Sidable, models.Model):
     )
 
     files = models.ManyToManyField(DataFile)
+    # content hashes of the uploaded related sets by related set: "set" is the hash of the uploaded
+    # set (studies.views.upload_hash), "exs" the hashes of its exs (subsets of the dataset) by pk
+    # (ExSerializer.content_hash)
+    upload_hashes = models.JSONField(default=dict, blank=True)
 
 
     class Meta:
@@ -150,6 +180,19 @@ class Study(Sidable, models.Model):
     def __str__(self):
         return '%s' % self.name
 
+    def related_set_hashes(self, related_set) -> dict:
+        """ Stored hashes of the related set (see upload_hashes), changes are saved with the study. """
+        hashes = self.upload_hashes.get(related_set)
+        if not isinstance(hashes, dict):
+            hashes = self.upload_hashes[related_set] = {}
+        return hashes
+
+    def drop_upload_hashes(self, related_set):
+        """ Drops the stored set hashes of the replaced related set and of the sets depending on it,
+        so they are uploaded again. The hashes of the exs are compared on their next upload. """
+        for name in related_set_dependents([related_set]):
+            self.related_set_hashes(name).pop("set", None)
+
     @property
     def reference_date(self):
         return self.reference.date
@@ -304,7 +347,12 @@ def expire():
 # FIXME: rename to something what it is (FilterQuery, IdCollection ?)
 class IdCollection(models.Model):
     """
-    DOCUMENT ME
+    Resulting ids of a filter query for a single resource.
+
+    All resources of a filter query share the uuid. The query_key identifies the
+    normalized filter query, it is reset when the data changes (see invalidate_cache).
+    The ids are stored as compressed bitmap, 'ids' is only set for old collections.
+    The access is the access key of the user of the filter query (users.permissions.access_key).
     """
 
     class Recourses(models.TextChoices):
@@ -321,8 +369,100 @@ class IdCollection(models.Model):
     resource = models.CharField(choices=Recourses.choices, max_length=CHAR_MAX_LENGTH)
     uuid = models.UUIDField(null=False, blank=False, editable=False)
     ids = ArrayField(models.IntegerField(), null=True, blank=True)
-    expire = models.DateTimeField(default=expire(), blank=True, editable=False)
+    bitmap = models.BinaryField(null=True, blank=True)
+    expire = models.DateTimeField(default=expire, blank=True, editable=False)
+    query_key = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    access = models.CharField(max_length=CHAR_MAX_LENGTH, null=True, blank=True)
 
     class Meta:
         unique_together = ['uuid', 'resource']
 
+    @classmethod
+    def cached(cls, query_key):
+        """ Ids of the unexpired filter query with the query_key.
+
+        The expiration of a hit is renewed.
+        :return: (uuid, {resource: ids}) or None
+        """
+        collection = cls.objects.filter(
+            query_key=query_key, expire__gt=make_aware(datetime.datetime.now())).order_by("-expire").first()
+        if collection is None:
+            return None
+
+        collections = cls.objects.filter(uuid=collection.uuid)
+        collections.update(expire=expire())
+        return collection.uuid, {c.resource: c.id_bitmap().to_list() for c in collections}
+
+    @classmethod
+    def from_ids(cls, ids, **kwargs) -> 'IdCollection':
+        return cls(bitmap=Bitmap.from_ids(ids).to_bytes(), **kwargs)
+
+    def id_bitmap(self) -> Bitmap:
+        if self.bitmap is not None:
+            return Bitmap.from_bytes(self.bitmap)
+        return Bitmap.from_ids(self.ids or [])
+
+    @property
+    def count(self) -> int:
+        return len(self.id_bitmap())
+
+    @classmethod
+    def invalidate_cache(cls):
+        """ Filter queries are not reused after studies changed.
+
+        The collections stay accessible via their uuid until they expire.
+        """
+        cls.objects.filter(query_key__isnull=False).update(query_key=None)
+
+
+class Job(models.Model):
+    """
+    Background job, e.g. the download archive of a filter query or a study upload.
+
+    The job is executed in the local job pool (see pkdb_app.jobs). The progress is stored
+    per step (e.g. per sheet of the archive), so the job can be polled from any web worker.
+    """
+
+    class JobTypes(models.TextChoices):
+        """ Job Types"""
+        Export = 'export', _('export')
+        Upload = 'upload', _('upload')
+
+    class Status(models.TextChoices):
+        """ Job Status"""
+        Pending = 'pending', _('pending')
+        Running = 'running', _('running')
+        Finished = 'finished', _('finished')
+        Failed = 'failed', _('failed')
+
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    job_type = models.CharField(choices=JobTypes.choices, max_length=CHAR_MAX_LENGTH)
+    status = models.CharField(choices=Status.choices, default=Status.Pending, max_length=CHAR_MAX_LENGTH)
+    progress = models.JSONField(default=dict, blank=True)
+    result = models.FileField(upload_to="jobs", null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE, related_name="jobs")
+    created = models.DateTimeField(auto_now_add=True)
+    expire = models.DateTimeField(default=expire, blank=True, editable=False)
+
+    # minimal interval between writes of the progress (seconds)
+    PROGRESS_INTERVAL = 1.0
+
+    def set_progress(self, key, force=False, **values):
+        """ Updates the progress of a step.
+
+        The progress is written at most every PROGRESS_INTERVAL seconds, unless forced.
+        """
+        self.progress[key] = {**self.progress.get(key, {}), **values}
+        now = time.time()
+        if force or now - getattr(self, "_progress_saved", 0) > self.PROGRESS_INTERVAL:
+            Job.objects.filter(pk=self.pk).update(progress=self.progress)
+            self._progress_saved = now
+
+    @classmethod
+    def delete_expired(cls):
+        """ Deletes expired jobs with their results. """
+        expired = cls.objects.filter(expire__lte=make_aware(datetime.datetime.now()))
+        for job in expired.exclude(result=""):
+            job.result.delete(save=False)
+        expired.delete()
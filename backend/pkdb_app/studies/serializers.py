@@ -7,12 +7,13 @@ from drf_yasg.utils import swagger_auto_schema
 from pkdb_app.data.models import DataSet
 from pkdb_app.data.serializers import DataSetSerializer, DataSetElasticSmallSerializer
 from rest_framework import serializers
+from rest_framework.reverse import reverse
 
 from pkdb_app import utils
 from pkdb_app.outputs.models import OutputSet
 from pkdb_app.outputs.serializers import OutputSetSerializer, OutputSetElasticSmallSerializer
 from pkdb_app.users.permissions import get_study_file_permission
-from .models import Reference, Author, Study, Rating
+from .models import Reference, Author, Study, Rating, Job
 from ..comments.models import Description, Comment
 from ..comments.serializers import DescriptionSerializer, CommentSerializer, CommentElasticSerializer, \
     DescriptionElasticSerializer
@@ -361,10 +362,16 @@ class StudySerializer(SidSerializer):
 
         for name, serializer in self.related_serializer().items():
             if related[name] is not None:
-                if getattr(study, name):
-                    getattr(study, name).delete()
                 this_serializer = serializer(context=context)
-                instance = this_serializer.create(validated_data={**related[name]})
+                if context.get("upload_changes") is not None and getattr(study, name):
+                    # incremental upload, the set is updated per ex (studies.views.upload_job)
+                    instance = this_serializer.update(getattr(study, name), {**related[name]})
+                else:
+                    if getattr(study, name):
+                        getattr(study, name).delete()
+                    # the hashes of the uploaded sets are stored by upload jobs (studies.views.upload_job)
+                    study.drop_upload_hashes(name)
+                    instance = this_serializer.create(validated_data={**related[name]})
                 setattr(study, name, instance)
                 study.save()
 
@@ -635,3 +642,16 @@ class StudyAnalysisSerializer(serializers.Serializer):
         ]
 
         read_only_fields = fields
+
+
+class JobSerializer(serializers.ModelSerializer):
+    """ Status and progress of a background job. """
+    download = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = ["uuid", "job_type", "status", "progress", "error", "created", "expire", "download"]
+
+    def get_download(self, obj):
+        if obj.status == Job.Status.Finished and obj.result:
+            return reverse("filter_jobs-download", kwargs={"uuid": obj.uuid}, request=self.context["request"])
@@ -1,19 +1,23 @@
-import tempfile
+import copy
+import hashlib
+import json
+import logging
+from contextlib import nullcontext
+import os
 import uuid
-import zipfile
-from collections import namedtuple
 from datetime import datetime
-from io import StringIO
+from functools import partial
 from typing import Dict
 import time
-import pandas as pd
-from django.db import connection
+from django.db import connection, transaction
 from django.test.client import RequestFactory
 
 import django_filters.rest_framework
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Q as DQ, Prefetch
-from django.http import JsonResponse, HttpResponse
+from django.contrib.auth.models import AnonymousUser
+from django.core.files.storage import default_storage
+from django.http import JsonResponse, StreamingHttpResponse, FileResponse, Http404
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django_elasticsearch_dsl_drf.constants import LOOKUP_QUERY_IN, LOOKUP_QUERY_EXCLUDE
@@ -29,36 +33,43 @@ from pkdb_app.data.documents import DataAnalysisDocument, SubSetDocument
 from pkdb_app.data.models import SubSet, Data
 from pkdb_app.data.serializers import TimecourseSerializer
 from pkdb_app.data.views import SubSetViewSet
-from pkdb_app.documents import UUID_PARAM
+from pkdb_app.documents import UUID_PARAM, IdSetDocument
 from pkdb_app.info_nodes.serializers import InfoNodeElasticSerializer, IndoNodeFlatSerializer
 from pkdb_app.info_nodes.views import InfoNodeElasticViewSet
 from pkdb_app.interventions.serializers import InterventionElasticSerializerAnalysis
 from pkdb_app.outputs.serializers import OutputInterventionSerializer
 from pkdb_app.subjects.serializers import GroupCharacteristicaSerializer, IndividualCharacteristicaSerializer
 from rest_framework.generics import get_object_or_404
+from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework import filters, status, serializers
 from rest_framework import viewsets
+from rest_framework.decorators import action
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
+from rest_framework.permissions import IsAuthenticated
 
 from pkdb_app.interventions.documents import InterventionDocument
 from pkdb_app.outputs.documents import OutputDocument, \
     OutputInterventionDocument
 from pkdb_app.outputs.models import OutputIntervention
+from pkdb_app.jobs import submit
 from pkdb_app.pagination import CustomPagination
+from pkdb_app.pkdata import Sheet, stream_archive, resolve_concurrent, pkdata_es_connection, data_queryset, \
+    sheet_rows, filter_query_key, IdTables, concise_ids, FILE_FORMATS
 from pkdb_app.studies.documents import ReferenceDocument, StudyDocument
 from pkdb_app.subjects.documents import GroupDocument, IndividualDocument, \
     GroupCharacteristicaDocument, IndividualCharacteristicaDocument
-from pkdb_app.subjects.models import GroupCharacteristica, IndividualCharacteristica, Group, Individual
+from pkdb_app.subjects.models import GroupCharacteristica, IndividualCharacteristica, Group, Individual, DataFile
 from pkdb_app.users.models import PUBLIC
-from pkdb_app.users.permissions import IsAdminOrCreatorOrCurator, StudyPermission, user_group
+from pkdb_app.users.permissions import IsAdminOrCreatorOrCurator, StudyPermission, user_group, access_key
+from pkdb_app.utils import UploadChanges
 from rest_framework.views import APIView
 
 from .serializers import (
     ReferenceSerializer,
     StudySerializer,
     ReferenceElasticSerializer,
-    StudyElasticSerializer, StudyAnalysisSerializer,
+    StudyElasticSerializer, StudyAnalysisSerializer, JobSerializer,
 )
 
 from django.db.models import Subquery
@@ -67,10 +78,12 @@ from pkdb_app.interventions.views import ElasticInterventionViewSet, ElasticInte
 from pkdb_app.outputs.models import Output
 from pkdb_app.interventions.models import Intervention
 from pkdb_app.outputs.views import ElasticOutputViewSet, OutputInterventionViewSet
-from pkdb_app.studies.models import Study, IdCollection, Reference
+from pkdb_app.studies.models import Study, IdCollection, Reference, Job, related_set_dependents
 from pkdb_app.subjects.views import GroupViewSet, IndividualViewSet, GroupCharacteristicaViewSet, \
     IndividualCharacteristicaViewSet
 
+logger = logging.getLogger(__name__)
+
 
 class ReferencesViewSet(viewsets.ModelViewSet):
     """ ReferenceViewSet """
@@ -137,8 +150,17 @@ class StudyViewSet(viewsets.ModelViewSet):
 
         related_elastic = related_elastic_dict(instance)
         delete_elastic_study(related_elastic)
+        IdCollection.invalidate_cache()
         return super().destroy(request, *args, **kwargs)
 
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        IdCollection.invalidate_cache()
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        IdCollection.invalidate_cache()
+
 
 ###############################################################################################
 # Elastic ViewSets
@@ -155,17 +177,26 @@ def update_index_study(request):
         except ObjectDoesNotExist:
             return JsonResponse({"success": "False", "reason": "Instance not in database"})
 
-        related_elastic = related_elastic_dict(study)
-        for doc, instances in related_elastic.items():
-            # code you want to evaluate
+        index_study(study, action=data.get('action', 'index'))
+        return JsonResponse({"success": "True"})
 
-            try:
-                action = data.get('action', 'index')
-                doc().update(thing=instances, action=action)
-            except helpers.BulkIndexError:
-                raise helpers.BulkIndexError
 
-        return JsonResponse({"success": "True"})
+def index_study(study, action="index", progress=None, related_sets=None):
+    """ Updates the elastic documents of the study.
+
+    :param progress: callback with the name of each updated document
+    :param related_sets: only the documents of these related sets (see related_elastic_dict)
+    """
+    related_elastic = related_elastic_dict(study, related_sets=related_sets)
+    for doc, instances in related_elastic.items():
+        try:
+            doc().update(thing=instances, action=action)
+        except helpers.BulkIndexError:
+            raise helpers.BulkIndexError
+        if progress is not None:
+            progress(doc.__name__)
+
+    IdCollection.invalidate_cache()
 
 
 def delete_elastic_study(related_elastic):
@@ -176,10 +207,82 @@ def delete_elastic_study(related_elastic):
             return False, "BulkIndexError"
 
 
-def related_elastic_dict(study):
+# related set of the study of the elastic documents, the other documents belong to the study
+ELASTIC_RELATED_SETS = {
+    GroupDocument: "groupset",
+    GroupCharacteristicaDocument: "groupset",
+    IndividualDocument: "individualset",
+    IndividualCharacteristicaDocument: "individualset",
+    InterventionDocument: "interventionset",
+    OutputDocument: "outputset",
+    OutputInterventionDocument: "outputset",
+    DataAnalysisDocument: "dataset",
+    SubSetDocument: "dataset",
+}
+
+
+# lookups from the instances of the elastic documents to the instances which are part of the
+# documents, the documents of the instances changed by an incremental upload are indexed
+ELASTIC_CHANGED_LOOKUPS = {
+    GroupDocument: {Group: "pk"},
+    GroupCharacteristicaDocument: {Group: "group"},
+    IndividualDocument: {Individual: "pk", Group: "group"},
+    IndividualCharacteristicaDocument: {Individual: "individual", Group: "individual__group"},
+    InterventionDocument: {Intervention: "pk"},
+    OutputDocument: {Output: "pk", Group: "group", Individual: "individual", Intervention: "interventions"},
+    OutputInterventionDocument: {
+        Output: "output",
+        Intervention: "intervention",
+        Group: "output__group",
+        Individual: "output__individual",
+    },
+    DataAnalysisDocument: {SubSet: "data_point__subset", Output: "output"},
+    SubSetDocument: {
+        SubSet: "pk",
+        Output: "data_points__outputs",
+        Group: "data_points__outputs__group",
+        Individual: "data_points__outputs__individual",
+        Intervention: "data_points__outputs__interventions",
+    },
+}
+
+
+def index_upload_changes(study, changes: UploadChanges, progress=None):
+    """ Updates the elastic documents of the instances changed by an incremental upload.
+
+    The documents of the deleted instances are deleted. The documents of the study and the
+    documents containing changed instances (ELASTIC_CHANGED_LOOKUPS) are indexed.
+
+    :param progress: callback with the name of each updated document
+    """
+    for doc in ELASTIC_CHANGED_LOOKUPS:
+        model = doc.Django.model
+        if changes.removed.get(model):
+            delete_elastic_study({doc: [model(pk=pk) for pk in changes.removed[model]]})
+
+    for doc, instances in related_elastic_dict(study).items():
+        lookups = ELASTIC_CHANGED_LOOKUPS.get(doc)
+        if lookups is not None:
+            query = DQ()
+            for model, lookup in lookups.items():
+                if changes.changed.get(model):
+                    query |= DQ(**{f"{lookup}__in": changes.changed[model]})
+            if not query:
+                continue
+            instances = instances.filter(query).distinct()
+        doc().update(thing=instances, action="index")
+        if progress is not None:
+            progress(doc.__name__)
+
+    IdCollection.invalidate_cache()
+
+
+def related_elastic_dict(study, related_sets=None, study_docs=True):
     """ Dictionary of elastic documents for given study.
 
     :param study:
+    :param related_sets: only documents of these related sets (default all)
+    :param study_docs: include the documents of the study and its reference
     :return:
     """
     interventions = study.interventions.all()
@@ -224,6 +327,10 @@ def related_elastic_dict(study):
     }
     if study.reference:
         docs_dict[ReferenceDocument] = study.reference
+    if related_sets is not None:
+        docs_dict = {doc: instances for doc, instances in docs_dict.items()
+                     if ELASTIC_RELATED_SETS.get(doc) in related_sets
+                     or (study_docs and doc not in ELASTIC_RELATED_SETS)}
     return docs_dict
 
 
@@ -309,14 +416,12 @@ class ElasticStudyViewSet(BaseDocumentViewSet, APIView):
 
         _uuid = self.request.query_params.get("uuid", [])
         if _uuid:
-            ids = list(get_object_or_404(IdCollection, uuid=_uuid, resource=self.document.Index.name).ids)
-
-            _qs_kwargs = {'values': ids}
+            resource = self.document.Index.name
+            ids = get_object_or_404(IdCollection, uuid=_uuid, resource=resource).id_bitmap().to_list()
+            if not IdSetDocument.exists(_uuid, resource):
+                IdSetDocument.store(_uuid, {resource: ids})
 
-            self.search = self.search.query(
-                'ids',
-                **_qs_kwargs
-            )
+            self.search = self.search.query(IdSetDocument.query("_id", _uuid, resource, ids))
 
         if group in ["admin", "reviewer"]:
             return self.search.query()
@@ -428,10 +533,30 @@ class PKData(object):
             'group_id', 'individual_id', "id", "interventions__id", "subset__id", "output_type")
 
         #  --- Elastic ---
+        lookups = {}
         if studies_query:
             self.studies_query = studies_query
-            studies_pks = self.study_pks()
-            time_elastic_studies = time.time()
+            lookups["studies"] = self.study_pks
+
+        if groups_query or individuals_query:
+            self.groups_query = groups_query
+            lookups["groups"] = self.group_pks
+            self.individuals_query = individuals_query
+            lookups["individuals"] = self.individual_pks
+
+        if interventions_query:
+            self.interventions_query = {"normed": "true", **interventions_query}
+            lookups["interventions"] = self.intervention_pks
+
+        if outputs_query:
+            self.outputs_query = {"normed": "true", **outputs_query}
+            lookups["outputs"] = self.output_pks
+
+        pks, self.timings = resolve_concurrent(lookups)
+        id_tables = IdTables()
+
+        if studies_query:
+            studies_pks = id_tables.subquery(pks["studies"])
             self.outputs = self.outputs.filter(study_id__in=studies_pks)
 
         else:
@@ -441,13 +566,8 @@ class PKData(object):
         self.studies = Study.objects.filter(id__in=studies_pks)
 
         if groups_query or individuals_query:
-            self.groups_query = groups_query
-            groups_pks = self.group_pks()
-            time_elastic_groups = time.time()
-
-            self.individuals_query = individuals_query
-            individuals_pks = self.individual_pks()
-            time_elastic_individuals = time.time()
+            groups_pks = id_tables.subquery(pks["groups"])
+            individuals_pks = id_tables.subquery(pks["individuals"])
             if concise:
                 self.outputs = self.outputs.filter(
                     DQ(group_id__in=groups_pks) | DQ(individual_id__in=individuals_pks))
@@ -456,18 +576,14 @@ class PKData(object):
                     DQ(groups__id__in=groups_pks) | DQ(individuals__id__in=individuals_pks))
 
         if interventions_query:
-            self.interventions_query = {"normed": "true", **interventions_query}
-            interventions_pks = self.intervention_pks()
-            time_elastic_interventions = time.time()
+            interventions_pks = id_tables.subquery(pks["interventions"])
             if concise:
                 self.outputs = self.outputs.filter(interventions__id__in=interventions_pks)
             else:
                 self.studies = self.studies.filter(interventions__id__in=interventions_pks)
 
         if outputs_query:
-            self.outputs_query = {"normed": "true", **outputs_query}
-            outputs_pks = self.output_pks()
-            time_elastic_outputs = time.time()
+            outputs_pks = id_tables.subquery(pks["outputs"])
             if concise:
                 self.outputs = self.outputs.filter(id__in=outputs_pks)
             else:
@@ -478,41 +594,7 @@ class PKData(object):
 
         time_loop_start = time.time()
         if concise:
-            studies = set()
-            groups = set()
-            individuals = set()
-            interventions = set()
-            outputs = set()
-            timecourses = set()
-            scatters = set()
-
-            for output in self.outputs.values("study_id", "group_id", "individual_id", "id", "interventions__id",
-                                              "subset__id", "output_type"):
-                studies.add(output["study_id"])
-                if output["group_id"]:
-                    groups.add(output["group_id"])
-                else:
-                    individuals.add(output["individual_id"])
-                outputs.add(output["id"])
-
-                if output["interventions__id"]:
-                    interventions.add(output["interventions__id"])
-
-                if (output["subset__id"] is not None) & (output["output_type"] == Output.OutputTypes.Timecourse):
-                    timecourses.add(output["subset__id"])
-
-                if (output["subset__id"] is not None) & (output["output_type"] == Output.OutputTypes.Array):
-                    scatters.add(output["subset__id"])
-
-            self.ids = {
-                "studies": list(studies),
-                "groups": list(groups),
-                "individuals": list(individuals),
-                "interventions": list(interventions),
-                "outputs": list(outputs),
-                "timecourses": list(timecourses),
-                "scatters": list(scatters),
-            }
+            self.ids = concise_ids(self.outputs)
 
         else:
             study_pks = self.studies.distinct().values_list("pk", flat=True)
@@ -535,6 +617,7 @@ class PKData(object):
                     self.subset.filter(data__data_type=Data.DataTypes.Scatter).values_list("pk", flat=True)),
             }
 
+        id_tables.drop()
         time_loop_end = time.time()
 
         time_django = time.time()
@@ -544,6 +627,8 @@ class PKData(object):
 
         print("init:", time_init - time_start)
         print("elastic:", time_elastic - time_init)
+        for key, duration in self.timings.items():
+            logger.debug(f"elastic {key}: {duration}")
         print("django:", time_django - time_elastic)
         print("Loop:", time_loop_end - time_loop_start)
 
@@ -571,39 +656,39 @@ class PKData(object):
     def study_pks(self):
         return self._pks(view_class=ElasticStudyViewSet, query_dict=self.studies_query, pk_field="pk")
 
-    def set_request_get(self, query_dict: Dict):
-        """
+    def view_request(self, query_dict: Dict):
+        """ Copy of the request with query_dict as GET parameters.
 
+        Every lookup gets its own request, so that lookups can run concurrently.
         :param query_dict:
         :return:
         """
         get = self.empty_get()
         for k, v in query_dict.items():
             get[k] = v
-        self.request._request.GET = get
+        http_request = copy.copy(self.request._request)
+        http_request.GET = get
+        request = Request(http_request)
+        request.user = self.request.user
+        return request
 
     def _pks(self, view_class: DocumentViewSet, query_dict: Dict, pk_field: str = "pk", scan_size=10000):
         """
         query elastic search for pks.
         """
-        self.set_request_get(query_dict)
-        view = view_class(request=self.request)
+        view = view_class(request=self.view_request(query_dict))
         queryset = view.filter_queryset(view.get_queryset())
 
-        response = queryset.source([pk_field]).params(size=scan_size).scan()
+        response = queryset.using(pkdata_es_connection()).source([pk_field]).params(size=scan_size).scan()
         return [instance[pk_field] for instance in response]
 
     def data_by_query_dict(self, query_dict, viewset, serializer, boost):
-        view = viewset(request=self.request)
-        queryset = view.get_queryset()
-        if query_dict is not None:
-            queryset = queryset.filter("terms", **query_dict)
+        queryset = data_queryset(self.request, query_dict, viewset, serializer, boost)
         if boost:
-            queryset = queryset.source(serializer.Meta.fields)
-            return [hit.to_dict() for hit in queryset.params(size=5000).scan()]
+            return [hit.to_dict() for hit in queryset.scan()]
 
         else:
-            return serializer(queryset.params(size=5000).scan(), many=True).data
+            return serializer(queryset.scan(), many=True).data
 
 
 class ResponseSerializer(serializers.Serializer):
@@ -645,6 +730,7 @@ class PKDataView(APIView):
     ```
     Two main parameters control the output of the filter query:
     * `download`: which allows to download the results as zip archive
+      (`file_format`: format of the tables in the archive, 'csv', 'parquet' or 'arrow')
     * `concise`: switching between concise and non-concise data
 
     The filter endpoint provides the option of filtering on any of the tables mentioned
@@ -679,6 +765,16 @@ class PKDataView(APIView):
         default=False
     )
 
+    file_format__param = openapi.Parameter(
+        'file_format',
+        openapi.IN_QUERY,
+        description="Format of the tables in the download archive. 'csv' or the typed and compressed "
+                    "columnar formats 'parquet' and 'arrow' (Arrow IPC file).",
+        type=openapi.TYPE_STRING,
+        enum=list(FILE_FORMATS),
+        default="csv"
+    )
+
     concise__param = openapi.Parameter(
         'concise',
         openapi.IN_QUERY,
@@ -697,122 +793,122 @@ class PKDataView(APIView):
         default=True
     )
 
-    @swagger_auto_schema(
-        manual_parameters=[concise__param, download__param],
-        responses={
-            200: openapi.Response(
-                description="Returns a 'uuid' and the number of entries for each table. "
-                            "This 'uuid' can be used as an argument in the endpoints of the "
-                            "tables (studies, groups, individuals, interventions, outputs, subsets). "
-                            "For subsets endpoint the 'data_type'['timecourse', 'scatter'] "
-                            "has to be provided.",
-                schema=ResponseSerializer)
+    @staticmethod
+    def download_sheets(_uuid, ids: Dict) -> Dict:
+        """ Sheets of the download archive for the filter query.
+
+        The elastic sheets use terms lookups of the stored id sets (IdSetDocument.query).
+        """
+
+        def lookup(field, resource):
+            return {field: IdSetDocument.query(field, _uuid, resource, ids[resource])}
+
+        return {
+            "studies": Sheet("Studies", lookup("pk", "studies"), ElasticStudyViewSet, StudyAnalysisSerializer,
+                             None, False),
+            "groups": Sheet("Groups", lookup("group_pk", "groups"), GroupCharacteristicaViewSet,
+                            GroupCharacteristicaSerializer, None, True, ),
+            "individuals": Sheet("Individuals", lookup("individual_pk", "individuals"),
+                                 IndividualCharacteristicaViewSet, IndividualCharacteristicaSerializer, None, True),
+            "interventions": Sheet("Interventions", lookup("pk", "interventions"),
+                                   ElasticInterventionAnalysisViewSet, InterventionElasticSerializerAnalysis, None,
+                                   False),
+            "outputs": Sheet("Outputs", lookup("output_pk", "outputs"), OutputInterventionViewSet,
+                             OutputInterventionSerializer, None, True),
+            "timecourses": Sheet("Timecourses", lookup("pk", "timecourses"), SubSetViewSet,
+                                 TimecourseSerializer, None, False),
+            "scatters": Sheet("Scatter", {"subset_pk": ids["scatters"]}, None, None, SubSet.scatter_representations,
+                              False),
+            "info_nodes": Sheet("InfoNodes", None,
+                                InfoNodeElasticViewSet,
+                                IndoNodeFlatSerializer,
+                                None,
+                                False),
         }
 
-    )
-    def get(self, request, *args, **kw):
-        time_start_request = time.time()
+    def filter_ids(self, request):
+        """ Ids of the filter query in the GET parameters of the request.
 
+        Identical queries reuse the IdCollections of the query.
+        :return: (uuid, ids, cached)
+        """
         request.GET = request.GET.copy()
+        concise = "false" != request.GET.get("concise", True)
+        params = {k: v for k, v in request.GET.items() if k.startswith(tuple(self.EXTRA.values()))}
+        query_key = filter_query_key(params, concise, request.user)
+
+        delete_queries = IdCollection.objects.filter(expire__lte=datetime.now())
+        IdSetDocument.delete_uuids(set(delete_queries.values_list("uuid", flat=True)))
+        delete_queries.delete()
+        cached = IdCollection.cached(query_key)
+
+        if cached:
+            _uuid, ids = cached
+            if not IdSetDocument.exists(_uuid, "studies"):
+                IdSetDocument.store(_uuid, ids)
+            return _uuid, ids, True
+
         pkdata = PKData(
             request=request,
-            concise="false" != request.GET.get("concise", True),
+            concise=concise,
             studies_query=self._get_param("study", request),
             groups_query=self._get_param("group", request),
             individuals_query=self._get_param("individual", request),
             interventions_query=self._get_param("intervention", request),
             outputs_query=self._get_param("output", request),
         )
-
-        time_pkdata = time.time()
+        ids = pkdata.ids
 
         # calculation of uuid
         queries = []
-        delete_queries = IdCollection.objects.filter(expire__lte=datetime.now())
-        delete_queries.delete()
         _uuid = uuid.uuid4()
-        resources = {"uuid": _uuid}
-        for resource, ids in pkdata.ids.items():
-            query = IdCollection(resource=resource, ids=ids, uuid=_uuid)
+        for resource, resource_ids in ids.items():
+            query = IdCollection.from_ids(resource_ids, resource=resource, uuid=_uuid, query_key=query_key,
+                                          access=access_key(request.user))
             queries.append(query)
-            resources[resource] = len(ids)
         IdCollection.objects.bulk_create(queries)
+        IdSetDocument.store(_uuid, ids)
+        return _uuid, ids, False
 
-        time_uuid = time.time()
+    @swagger_auto_schema(
+        manual_parameters=[concise__param, download__param, file_format__param],
+        responses={
+            200: openapi.Response(
+                description="Returns a 'uuid' and the number of entries for each table. "
+                            "This 'uuid' can be used as an argument in the endpoints of the "
+                            "tables (studies, groups, individuals, interventions, outputs, subsets). "
+                            "For subsets endpoint the 'data_type'['timecourse', 'scatter'] "
+                            "has to be provided.",
+                schema=ResponseSerializer)
+        }
 
-        if request.GET.get("download") == "true":
+    )
+    def get(self, request, *args, **kw):
+        time_start_request = time.time()
+        file_format = request.GET.get("file_format", "csv")
+        if file_format not in FILE_FORMATS:
+            return Response({"file_format": f"File format has to be one of {list(FILE_FORMATS)}."},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-            def serialize_scatters(ids):
-                scatter_subsets = SubSet.objects.filter(id__in=ids)
-                return [t.scatter_representation for t in scatter_subsets]
-
-            Sheet = namedtuple("Sheet",
-                               ["sheet_name", "query_dict", "viewset", "serializer", "function", "boost_performance", ])
-            table_content = {
-                "studies": Sheet("Studies", {"pk": pkdata.ids["studies"]}, ElasticStudyViewSet, StudyAnalysisSerializer,
-                                 None, False),
-                "groups": Sheet("Groups", {"group_pk": pkdata.ids["groups"]}, GroupCharacteristicaViewSet,
-                                GroupCharacteristicaSerializer, None, True, ),
-                "individuals": Sheet("Individuals", {"individual_pk": pkdata.ids["individuals"]},
-                                     IndividualCharacteristicaViewSet, IndividualCharacteristicaSerializer, None, True),
-                "interventions": Sheet("Interventions", {"pk": pkdata.ids["interventions"]},
-                                       ElasticInterventionAnalysisViewSet, InterventionElasticSerializerAnalysis, None,
-                                       False),
-                "outputs": Sheet("Outputs", {"output_pk": pkdata.ids["outputs"]}, OutputInterventionViewSet,
-                                 OutputInterventionSerializer, None, True),
-                "timecourses": Sheet("Timecourses", {"pk": pkdata.ids["timecourses"]}, SubSetViewSet,
-                                     TimecourseSerializer, None, False),
-                "scatters": Sheet("Scatter", {"subset_pk": pkdata.ids["scatters"]}, None, None, serialize_scatters,
-                                  False),
-                "info_nodes": Sheet("InfoNodes", None,
-                                    InfoNodeElasticViewSet,
-                                    IndoNodeFlatSerializer,
-                                    None,
-                                    False),
-            }
+        _uuid, ids, cached = self.filter_ids(request)
+        time_pkdata = time.time()
 
-            # Create archive
-            with tempfile.SpooledTemporaryFile() as tmp:
-                with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as archive:
-                    download_times = {}
-
-                    for key, sheet in table_content.items():
-                        download_time_start = time.time()
-
-                        string_buffer = StringIO()
-                        if sheet.function:
-                            df = pd.DataFrame(sheet.function(sheet.query_dict["subset_pk"]))
-                            df.to_csv(string_buffer)
-                            archive.writestr(f'{key}.csv', string_buffer.getvalue())
-                            download_times[key] = time.time() - download_time_start
-
-                        else:
-                            df = pd.DataFrame(
-                                pkdata.data_by_query_dict(sheet.query_dict, sheet.viewset, sheet.serializer,
-                                                          sheet.boost_performance))
-                            if len(df) < 0:
-                                df = df[sheet.serializer.Meta.fields]
-                            df.to_csv(string_buffer)
-                            archive.writestr(f'{key}.csv', string_buffer.getvalue())
-                            download_times[key] = time.time() - download_time_start
-
-                    archive.write('download_extra/README.md', 'README.md')
-                    archive.write('download_extra/TERMS_OF_USE.md', 'TERMS_OF_USE.md')
-
-                tmp.seek(0)
-                resp = HttpResponse(tmp.read(), content_type='application/x-zip-compressed')
-                resp['Content-Disposition'] = "attachment; filename=%s" % "pkdata.zip"
-                print("-" * 80)
-                print("File Creation")
-                for k, v in download_times.items():
-                    print(k, v)
-
-                return resp
+        resources = {"uuid": _uuid, **{resource: len(resource_ids) for resource, resource_ids in ids.items()}}
+
+        time_uuid = time.time()
+
+        if request.GET.get("download") == "true":
+            sheets = {key: partial(sheet_rows, request, sheet) for key, sheet in self.download_sheets(_uuid, ids).items()}
+            resp = StreamingHttpResponse(stream_archive(sheets, file_format=file_format),
+                                         content_type='application/x-zip-compressed')
+            resp['Content-Disposition'] = "attachment; filename=%s" % "pkdata.zip"
+            return resp
 
         response = Response(resources, status=status.HTTP_200_OK)
         time_response = time.time()
 
         print("-" * 80)
+        logger.debug(f"cached: {cached}")
         print("pkdata:", time_pkdata - time_start_request)
         print("uuid:", time_uuid - time_pkdata)
         print("-" * 80)
@@ -820,3 +916,305 @@ class PKDataView(APIView):
         print("-" * 80)
 
         return response
+
+
+def export_job(job, _uuid, file_format="csv"):
+    """ Writes the download archive of the filter query with the uuid (executed in the job pool). """
+    request = Request(RequestFactory().get("/"))
+    request.user = job.user or AnonymousUser()
+
+    ids = {collection.resource: collection.id_bitmap().to_list()
+           for collection in IdCollection.objects.filter(uuid=_uuid)}
+    sheets = {key: partial(sheet_rows, request, sheet) for key, sheet in PKDataView.download_sheets(_uuid, ids).items()}
+
+    def progress(key, rows, finished):
+        job.set_progress(key, rows=rows, status="finished" if finished else "running", force=finished)
+
+    name = f"jobs/pkdata_{job.uuid}.zip"
+    path = default_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        for chunk in stream_archive(sheets, progress=progress, file_format=file_format):
+            f.write(chunk)
+    job.result.name = name
+
+
+# stages of a study upload, the related sets of the study are uploaded in this order
+UPLOAD_STAGES = ["parse", "groups", "individuals", "interventions", "outputs", "subsets", "pk", "indexing"]
+UPLOAD_SETS = {
+    "groups": "groupset",
+    "individuals": "individualset",
+    "interventions": "interventionset",
+    "outputs": "outputset",
+    "subsets": "dataset",
+}
+# stages which reference the instances of other stages
+UPLOAD_DEPENDENCIES = {
+    "individuals": ["groups"],
+    "outputs": ["groups", "individuals", "interventions"],
+    "subsets": ["outputs"],
+}
+# models of the instances of the stages
+UPLOAD_MODELS = {
+    "groups": Group,
+    "individuals": Individual,
+    "interventions": Intervention,
+    "outputs": Output,
+    "subsets": SubSet,
+}
+# fields of the related sets which reference data files
+UPLOAD_FILE_FIELDS = ["source", "image", "figure"]
+
+
+def upload_hash(value, file_hashes: Dict) -> str:
+    """ Content hash of an uploaded related set.
+
+    Data files are referenced by their pks, the references are replaced by the hashes of the
+    file contents, so a changed file changes the hash of the sets using it.
+
+    :param file_hashes: cache of file pk (str) -> hash of the content
+    """
+    def file_hash(pk):
+        if pk not in file_hashes:
+            datafile = DataFile.objects.filter(pk=pk).first()
+            if datafile is None or not datafile.file:
+                file_hashes[pk] = None
+            else:
+                with datafile.file.open("rb") as f:
+                    file_hashes[pk] = hashlib.sha256(f.read()).hexdigest()
+        return file_hashes[pk]
+
+    def with_files(value):
+        if isinstance(value, dict):
+            return {
+                key: ("||".join(str(file_hash(pk.strip())) for pk in str(v).split("||"))
+                      if key in UPLOAD_FILE_FIELDS and v is not None else with_files(v))
+                for key, v in value.items()
+            }
+        if isinstance(value, list):
+            return [with_files(v) for v in value]
+        return value
+
+    return hashlib.sha256(json.dumps(with_files(value), sort_keys=True, default=str).encode()).hexdigest()
+
+
+def upload_job(job, data, dry_run=False, incremental=False):
+    """ Uploads a study (executed in the job pool).
+
+    The study is created or updated from the study fields, afterwards the related sets are
+    uploaded one after the other (as with PATCH requests of the sets) and the study is indexed.
+    The documents of a set are deleted right before the set is replaced; if the upload fails,
+    the sets replaced so far are indexed before the error is raised.
+    The pharmacokinetics stage is reported by the DataSetSerializer. Validation errors are
+    stored in the progress of the failed stage.
+
+    In a dry run the upload is validated only. The sets reference the instances of the
+    previous sets, so the stages are run in a transaction which is rolled back. Timecourses are
+    validated without calculating pharmacokinetics, nothing is indexed. Stages are validated
+    unless a stage they depend on failed, so the errors of all stages are reported. The progress
+    is written when the job is finished.
+
+    In an incremental upload the existing sets are updated per ex: exs with the content hash of
+    the last upload are kept, changed exs are updated in place (see the update of the set
+    serializers). The changed and deleted instances are recorded (UploadChanges) and only their
+    documents are updated. Sets with the hash of the last upload (upload_hash) whose dependencies
+    did not change are not uploaded and reported as "unchanged".
+    """
+    sid = data["sid"]
+    request = Request(RequestFactory().patch(f"/api/v1/_studies/{sid}/"))
+    request.user = job.user
+    running = []
+    errors = {}
+    file_hashes = {}
+    source_frames = {}
+    changes = UploadChanges() if incremental else None
+    # related sets whose documents are deleted
+    deleted = set()
+
+    def progress(key, force=False, **values):
+        if dry_run:
+            # writes in the transaction would be rolled back, the job is saved by jobs.run
+            job.progress[key] = {**job.progress.get(key, {}), **values}
+        else:
+            job.set_progress(key, force=force, **values)
+
+    def stage(name):
+        if running:
+            progress(running.pop(), status="finished")
+        progress(name, status="running", force=True)
+        running.append(name)
+
+    def touched(name):
+        # instances of the stages the stage depends on were changed in this upload
+        return changes is not None and any(
+            changes.touched(UPLOAD_MODELS[dependency]) for dependency in UPLOAD_DEPENDENCIES.get(name, []))
+
+    def save(study, stage_data):
+        # the parsed source files are shared by the stages
+        context = {"request": request, "upload_stage": stage, "dry_run": dry_run, "upload_changes": changes,
+                   "source_frames": source_frames, "source_hashes": file_hashes}
+        serializer = StudySerializer(study, data=stage_data, partial=study is not None, context=context)
+        try:
+            serializer.is_valid(raise_exception=True)
+            # savepoint per stage in a dry run, so failed stages are rolled back
+            with transaction.atomic() if dry_run else nullcontext():
+                return serializer.save()
+        except serializers.ValidationError as err:
+            errors[running[-1]] = json.loads(json.dumps(err.detail, default=str))
+            progress(running[-1], errors=errors[running[-1]])
+            if not dry_run:
+                raise
+            progress(running.pop(), status="failed", force=True)
+            if study is not None:
+                # relations of the rolled back stage
+                study.refresh_from_db()
+            return study
+
+    try:
+        with transaction.atomic() if dry_run else nullcontext():
+            stage("parse")
+            study = Study.objects.filter(sid=sid).first()
+            hashes = {related_set: upload_hash(data[related_set], file_hashes)
+                      for related_set in UPLOAD_SETS.values() if data.get(related_set) is not None}
+            study = save(study, {key: value for key, value in data.items() if key not in UPLOAD_SETS.values()})
+            for name, related_set in UPLOAD_SETS.items():
+                failed = errors.keys() & {"parse", *UPLOAD_DEPENDENCIES.get(name, [])}
+                unchanged = (not failed and incremental and related_set in hashes and not touched(name)
+                             and study.related_set_hashes(related_set).get("set") == hashes[related_set])
+                if data.get(related_set) is None or failed or unchanged:
+                    status = "unchanged" if unchanged else "skipped"
+                    progress(name, status=status)
+                    if name == "subsets":
+                        progress("pk", status=status)
+                    continue
+                stage(name)
+                if not dry_run and not incremental:
+                    # documents of the instances which are deleted with the set (and its dependents)
+                    replaced = related_set_dependents([related_set]) - deleted
+                    delete_elastic_study(related_elastic_dict(study, related_sets=list(replaced), study_docs=False))
+                    deleted.update(replaced)
+                study = save(study, {related_set: data[related_set]})
+                if name not in errors:
+                    # sets referencing changed instances are uploaded again by the next upload
+                    for dependent in UPLOAD_DEPENDENCIES:
+                        if touched(dependent):
+                            study.related_set_hashes(UPLOAD_SETS[dependent]).pop("set", None)
+                    study.related_set_hashes(related_set)["set"] = hashes[related_set]
+                    study.save()
+
+            if dry_run:
+                if running:
+                    progress(running.pop(), status="finished")
+                progress("indexing", status="skipped")
+                if errors:
+                    raise serializers.ValidationError(errors)
+                transaction.set_rollback(True)
+                return
+
+        stage("indexing")
+        index_progress = partial(progress, "indexing")
+        if incremental:
+            index_upload_changes(study, changes, progress=lambda document: index_progress(document=document))
+        else:
+            index_study(study, progress=lambda document: index_progress(document=document))
+        progress(running.pop(), status="finished", force=True)
+    except Exception:
+        if running:
+            progress(running.pop(), status="failed", force=True)
+        if not dry_run and (deleted or changes is not None and (changes.changed or changes.removed)):
+            # the sets replaced (or instances changed) before the failure are committed
+            try:
+                if incremental:
+                    index_upload_changes(study, changes)
+                else:
+                    index_study(study, related_sets=list(deleted))
+            except Exception:
+                logger.exception(f"Indexing of the failed upload of study <{sid}> failed.")
+        raise
+
+
+class JobViewSet(viewsets.ViewSet):
+    """ Status of background jobs of a job type. """
+    swagger_schema = None
+    lookup_field = "uuid"
+    job_type = None
+
+    def get_job(self, request, _uuid):
+        job = get_object_or_404(Job, uuid=_uuid, job_type=self.job_type)
+        if job.user is not None and job.user != request.user:
+            raise Http404("No Job matches the given query.")
+        return job
+
+    def retrieve(self, request, uuid=None):
+        job = self.get_job(request, uuid)
+        return Response(JobSerializer(job, context={"request": request}).data)
+
+
+class FilterJobViewSet(JobViewSet):
+    """ Background downloads of filter queries.
+
+    POST the filter parameters (as for the filter endpoint) to start an export job. The job
+    reports its progress per sheet, the archive can be downloaded when the job is finished.
+    """
+    job_type = Job.JobTypes.Export
+
+    def create(self, request):
+        Job.delete_expired()
+        request.GET = request.GET.copy()
+        for key, value in request.data.items():
+            request.GET[key] = value
+        file_format = request.GET.get("file_format", "csv")
+        if file_format not in FILE_FORMATS:
+            return Response({"file_format": f"File format has to be one of {list(FILE_FORMATS)}."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        _uuid, ids, _ = PKDataView().filter_ids(request)
+        job = Job.objects.create(
+            job_type=Job.JobTypes.Export,
+            user=request.user if request.user.is_authenticated else None,
+            progress={key: {"status": "pending", "rows": 0} for key in PKDataView.download_sheets(_uuid, ids)}
+        )
+        submit(job, export_job, str(_uuid), file_format)
+        return Response(JobSerializer(job, context={"request": request}).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=["get"])
+    def download(self, request, uuid=None):
+        job = self.get_job(request, uuid)
+        if job.status != Job.Status.Finished or not job.result:
+            return Response({"detail": f"Job is {job.status}."}, status=status.HTTP_409_CONFLICT)
+        return FileResponse(job.result.open("rb"), as_attachment=True, filename="pkdata.zip",
+                            content_type='application/x-zip-compressed')
+
+
+class UploadJobViewSet(JobViewSet):
+    """ Background uploads of studies.
+
+    POST the study JSON with its related sets (groupset, individualset, interventionset,
+    outputset, dataset) to start an upload job. Files are referenced by the pks of the uploaded
+    data files. The job reports its progress per stage (UPLOAD_STAGES) and can be polled.
+    With the query parameter dry_run=true the upload is only validated, with incremental=true
+    only the exs which changed since the last upload are uploaded (see upload_job).
+    """
+    job_type = Job.JobTypes.Upload
+    permission_classes = (IsAuthenticated,)
+
+    def create(self, request):
+        Job.delete_expired()
+        data = dict(request.data)
+        dry_run = request.query_params.get("dry_run", "false").lower() == "true"
+        incremental = request.query_params.get("incremental", "false").lower() == "true"
+        if not data.get("sid"):
+            return Response({"sid": "The study sid is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        study = Study.objects.filter(sid=data["sid"]).first()
+        if study is not None and not StudyPermission().has_object_permission(request, self, study):
+            return Response({"detail": "You do not have permission to update this study."},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        job = Job.objects.create(
+            job_type=Job.JobTypes.Upload,
+            user=request.user,
+            progress={stage: {"status": "pending"} for stage in UPLOAD_STAGES}
+        )
+        submit(job, upload_job, data, dry_run, incremental)
+        return Response(JobSerializer(job, context={"request": request}).data, status=status.HTTP_201_CREATED)
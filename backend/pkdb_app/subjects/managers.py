@@ -17,6 +17,28 @@ class GroupManager(models.Manager):
             kwargs["parent"] = self.model.objects.filter(pk__in=study_groups).get(name=kwargs.get("parent"))
 
         group = super().create(*args, **kwargs)
+        self.create_characteristica(group, characteristica)
+        group.save()
+        return group
+
+    def replace(self, group, **kwargs):
+        """ Updates the group in place with the fields of create, the group keeps its pk.
+
+        The characteristica of the group have to be deleted before.
+        """
+        characteristica = kwargs.pop("characteristica", [])
+        study_groups = kwargs.pop("study_groups")
+
+        if kwargs.get("parent"):
+            kwargs["parent"] = self.model.objects.filter(pk__in=study_groups).get(name=kwargs.get("parent"))
+
+        group = self.model(pk=group.pk, **kwargs)
+        group.save(force_update=True)
+        self.create_characteristica(group, characteristica)
+        return group
+
+    @staticmethod
+    def create_characteristica(group, characteristica):
         characteristica_updated = []
         Characteristica = apps.get_model('subjects', 'Characteristica')
 
@@ -27,9 +49,6 @@ class GroupManager(models.Manager):
         not_norm_group = create_multiple_bulk(group, "group", characteristica_updated, Characteristica)
         create_multiple_bulk_normalized(not_norm_group, Characteristica)
 
-        group.save()
-        return group
-
 
 class CharacteristicaExManager(models.Manager):
     def create(self, *args, **kwargs):
@@ -47,8 +66,23 @@ class IndividualManager(models.Manager):
     def create(self, *args, **kwargs):
         characteristica = kwargs.pop("characteristica", [])
         individual = super().create(*args, **kwargs)
+        self.create_characteristica(individual, characteristica)
+        individual.save()
+        return individual
+
+    def replace(self, individual, **kwargs):
+        """ Updates the individual in place with the fields of create, the individual keeps its pk.
+
+        The characteristica of the individual have to be deleted before.
+        """
+        characteristica = kwargs.pop("characteristica", [])
+        individual = self.model(pk=individual.pk, **kwargs)
+        individual.save(force_update=True)
+        self.create_characteristica(individual, characteristica)
+        return individual
+
+    @staticmethod
+    def create_characteristica(individual, characteristica):
         Characteristica = apps.get_model('subjects', 'Characteristica')
         not_norm_individual = create_multiple_bulk(individual, "individual", characteristica, Characteristica)
         create_multiple_bulk_normalized(not_norm_individual, Characteristica)
-        individual.save()
-        return individual
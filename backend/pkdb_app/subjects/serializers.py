@@ -1,5 +1,6 @@
+from collections import defaultdict
+
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-from django.db.models import Q
 from drf_yasg.utils import swagger_serializer_method
 from pkdb_app.info_nodes.models import InfoNode
 from rest_framework import serializers
@@ -20,7 +21,7 @@ from .models import (
 from ..comments.serializers import DescriptionSerializer, CommentSerializer, DescriptionElasticSerializer, \
     CommentElasticSerializer
 from ..serializers import WrongKeyValidationSerializer, ExSerializer, ReadSerializer
-from ..utils import list_of_pk, _validate_required_key, create_multiple, _create
+from ..utils import list_of_pk, _validate_required_key, create_multiple, _create, _update
 
 CHARACTERISTICA_FIELDS = ['count']
 CHARACTERISTICA_MAP_FIELDS = map_field(CHARACTERISTICA_FIELDS)
@@ -48,6 +49,23 @@ class DataFileSerializer(WrongKeyValidationSerializer):
         return data
 
 
+def update_characteristica_all_normed(subjects, delete):
+    """ Updates the characteristica_all_normed of groups or individuals which changed.
+
+    :param delete: deletes the outdated links (ExSerializer.delete)
+    :return: pks of the changed groups or individuals
+    """
+    changed = []
+    for subject in subjects:
+        characteristica = set(subject._characteristica_all_normed.values_list("pk", flat=True))
+        if characteristica != set(subject.characteristica_all_normed.values_list("pk", flat=True)):
+            through = subject.characteristica_all_normed.through
+            delete(through.objects.filter(**{subject._meta.model_name: subject}))
+            subject.characteristica_all_normed.add(*characteristica)
+            changed.append(subject.pk)
+    return changed
+
+
 # ----------------------------------
 # Characteristica
 # ----------------------------------
@@ -257,21 +275,45 @@ class GroupExSerializer(ExSerializer):
 
     def create(self, validated_data):
         group_set = validated_data.pop("group_set")
+        groups_by_name = validated_data.pop("groups_by_name", {})
         group_ex, popped_data =  _create(validated_data=validated_data, model_manager=group_set.group_exs, create_multiple_keys=["comments", "descriptions"],pop=["characteristica_ex","groups","study_groups", "parent_ex"])
 
 
         for characteristica_ex_single in popped_data["characteristica_ex"]:
             group_ex.characteristica_ex.create(**characteristica_ex_single)
 
+        self._create_groups(group_ex, popped_data, groups_by_name)
+        group_ex.save()
+        return group_ex
+
+    def update(self, instance, validated_data):
+        """ Updates the group ex in place (GroupSetSerializer.update). """
+        validated_data.pop("group_set")
+        groups_by_name = validated_data.pop("groups_by_name", {})
+        group_ex, popped_data = _update(instance, validated_data, keep=["groupset_id"],
+                                        create_multiple_keys=["comments", "descriptions"],
+                                        pop=["characteristica_ex", "groups", "study_groups", "parent_ex"])
+
+        group_ex.characteristica_ex.all().delete()
+        for characteristica_ex_single in popped_data["characteristica_ex"]:
+            group_ex.characteristica_ex.create(**characteristica_ex_single)
+
+        self._create_groups(group_ex, popped_data, groups_by_name)
+        return group_ex
+
+    def _create_groups(self, group_ex, popped_data, groups_by_name):
+        """ Creates the groups of the group ex, existing groups (groups_by_name) are updated in place. """
         for group in popped_data["groups"]:
             group["study_groups"] = popped_data["study_groups"]
             group["study"] = self.context["study"]
-            dj_group = group_ex.groups.create(**group)
+            dj_group = groups_by_name.get(group["name"])
+            if dj_group is None:
+                dj_group = group_ex.groups.create(**group)
+            else:
+                self.delete(dj_group.characteristica.all())
+                dj_group = Group.objects.replace(dj_group, ex=group_ex, **group)
             popped_data["study_groups"].add(dj_group.pk)
 
-        group_ex.save()
-        return group_ex
-
     def validate_image(self, value):
         self._validate_image(value)
         return value
@@ -310,6 +352,7 @@ class GroupSetSerializer(ExSerializer):
         study_groups = set()
 
         group_exs = poped_data["group_exs"]
+        hashes = [self.content_hash(group_ex) for group_ex in group_exs]
         for group_ex in group_exs:
             group_ex["group_set"] = groupset
 
@@ -325,12 +368,72 @@ class GroupSetSerializer(ExSerializer):
             study_group_ex = GroupExSerializer(context=self.context).create(validated_data=group_ex)
             study_group_exs.append(study_group_ex)
         groupset.save()
+        self.store_ex_hashes("groupset", study_group_exs, hashes)
 
         # add characteristica from parents to the all_characteristica_normed if each group
         for group in groupset.groups:
             group.characteristica_all_normed.add(*group._characteristica_all_normed)
         return groupset
 
+    def update(self, instance, validated_data):
+        """ Updates the group set of an incremental upload per group ex.
+
+        Group exs with the content hash of the last upload are kept. Changed group exs are
+        updated in place (new exs are created, removed exs deleted); their groups are matched
+        by name with the groups of the changed exs of the last upload and updated in place, so
+        the groups keep their pks and the instances referencing them are kept.
+        """
+        groupset, poped_data = _update(instance, validated_data,
+                                       create_multiple_keys=['descriptions', 'comments'],
+                                       pop=["group_exs"])
+        group_exs = poped_data["group_exs"]
+        hashes = [self.content_hash(group_ex) for group_ex in group_exs]
+        unchanged, stale = self.match_exs("groupset", hashes, groupset.group_exs.all())
+
+        names = {group["name"] for group_ex in group_exs for group in group_ex["groups"]}
+        groups_by_name = {group.name: group for group in Group.objects.filter(ex__in=stale, name__in=names)}
+        study_groups = set(groupset.groups.values_list("pk", flat=True))
+
+        study_group_exs = []
+        changed_exs = []
+        updated_exs = list(stale)
+        for group_ex, unchanged_ex in zip(group_exs, unchanged):
+            if unchanged_ex is not None:
+                study_group_exs.append(unchanged_ex)
+                continue
+            group_ex.update(
+                {"group_set": groupset, "study_groups": study_groups, "groups_by_name": groups_by_name})
+            if updated_exs:
+                study_group_ex = GroupExSerializer(context=self.context).update(updated_exs.pop(0), group_ex)
+            else:
+                study_group_ex = GroupExSerializer(context=self.context).create(validated_data=group_ex)
+            study_group_exs.append(study_group_ex)
+            changed_exs.append(study_group_ex)
+
+        # groups of the changed exs which are not uploaded again, and the removed exs
+        self.delete(Group.objects.filter(ex__in=stale).exclude(name__in=names))
+        self.delete(GroupEx.objects.filter(pk__in=[group_ex.pk for group_ex in updated_exs]))
+        self.store_ex_hashes("groupset", study_group_exs, hashes)
+
+        # characteristica_all_normed of the changed groups, their subgroups and individuals
+        changed_groups = set(Group.objects.filter(ex__in=changed_exs).values_list("pk", flat=True))
+        self.record_changes(Group, changed_groups)
+        children = defaultdict(list)
+        for pk, parent_pk in groupset.groups.values_list("pk", "parent_id"):
+            children[parent_pk].append(pk)
+        pending = list(changed_groups)
+        while pending:
+            for pk in children[pending.pop()]:
+                if pk not in changed_groups:
+                    changed_groups.add(pk)
+                    pending.append(pk)
+
+        groups = Group.objects.filter(pk__in=changed_groups)
+        self.record_changes(Group, update_characteristica_all_normed(groups, self.delete))
+        individuals = Individual.objects.filter(group__in=changed_groups)
+        self.record_changes(Individual, update_characteristica_all_normed(individuals, self.delete))
+        return groupset
+
     @staticmethod
     def _group_validation(groups):
 
@@ -405,13 +508,10 @@ class IndividualSerializer(ExSerializer):
         model = Individual
         fields = ['name', 'group', 'characteristica']
 
-    @staticmethod
-    def group_to_internal_value(group, study_sid):
+    def group_to_internal_value(self, group, study_sid):
         if group:
             try:
-                group = Group.objects.get(
-                    Q(study__sid=study_sid) & Q(name=group)
-                ).pk
+                group = self.study_lookup(study_sid).get(Group, group)
             except ObjectDoesNotExist:
                 msg = f'group: {group} in study: {study_sid} does not exist'
                 raise serializers.ValidationError(msg)
@@ -480,13 +580,10 @@ class IndividualExSerializer(ExSerializer):
             'descriptions'
         ]
 
-    @staticmethod
-    def group_to_internal_value(group, study_sid):
+    def group_to_internal_value(self, group, study_sid):
         if group:
             try:
-                group = Group.objects.get(
-                    Q(study__sid=study_sid) & Q(name=group)
-                ).pk
+                group = self.study_lookup(study_sid).get(Group, group)
             except ObjectDoesNotExist:
                 msg = f'group: {group} in study: {study_sid} does not exist'
                 raise serializers.ValidationError(msg)
@@ -543,15 +640,13 @@ class IndividualExSerializer(ExSerializer):
 
     def create(self, validated_data):
         individual_set = validated_data.pop("individual_set")
+        individuals_by_name = validated_data.pop("individuals_by_name", {})
         individual_ex, poped_data = _create(model_manager=individual_set.individual_exs,
                                               validated_data=validated_data,
                                               create_multiple_keys=['descriptions', 'comments', 'characteristica_ex'],
                                               pop=['individuals'])
 
-        individuals = poped_data["individuals"]
-        for individual in individuals:
-            individual["study"] = self.context["study"]
-        individuals = create_multiple(individual_ex, individuals, "individuals")
+        individuals = self._create_individuals(individual_ex, poped_data["individuals"], individuals_by_name)
 
         # add characteristica from parents to the all_characteristica_normed if each individual
         for individual in individuals:
@@ -560,6 +655,33 @@ class IndividualExSerializer(ExSerializer):
         individual_ex.save()
         return individual_ex
 
+    def update(self, instance, validated_data):
+        """ Updates the individual ex in place (IndividualSetSerializer.update). """
+        validated_data.pop("individual_set")
+        individuals_by_name = validated_data.pop("individuals_by_name", {})
+        individual_ex, poped_data = _update(instance, validated_data, keep=["individualset_id"],
+                                            create_multiple_keys=['descriptions', 'comments',
+                                                                  'characteristica_ex'],
+                                            pop=['individuals'])
+        self._create_individuals(individual_ex, poped_data["individuals"], individuals_by_name)
+        return individual_ex
+
+    def _create_individuals(self, individual_ex, individuals, individuals_by_name):
+        """ Creates the individuals of the individual ex, existing individuals with the same name
+        (individuals_by_name) are updated in place. """
+        dj_individuals = []
+        for individual in individuals:
+            individual["study"] = self.context["study"]
+            existing = individuals_by_name.get(individual["name"])
+            if existing:
+                dj_individual = existing.pop(0)
+                self.delete(dj_individual.characteristica.all())
+                dj_individual = Individual.objects.replace(dj_individual, ex=individual_ex, **individual)
+            else:
+                dj_individual = individual_ex.individuals.create(**individual)
+            dj_individuals.append(dj_individual)
+        return dj_individuals
+
 
 class IndividualSetSerializer(ExSerializer):
     individual_exs = IndividualExSerializer(many=True, read_only=False, required=False)
@@ -586,11 +708,63 @@ class IndividualSetSerializer(ExSerializer):
                                        pop=["study", "individual_exs"])
 
         individual_exs = poped_data['individual_exs']
+        hashes = [self.content_hash(individual_ex) for individual_ex in individual_exs]
         for individual_ex in individual_exs:
             individual_ex["individual_set"] = individualset
 
-        IndividualExSerializer(context=self.context, many=True).create(validated_data=poped_data["individual_exs"])
+        study_individual_exs = IndividualExSerializer(context=self.context, many=True).create(
+            validated_data=poped_data["individual_exs"])
+        self.store_ex_hashes("individualset", study_individual_exs, hashes)
+
+        return individualset
 
+    def update(self, instance, validated_data):
+        """ Updates the individual set of an incremental upload per individual ex.
+
+        Individual exs with the content hash of the last upload are kept. Changed individual exs
+        are updated in place (new exs are created, removed exs deleted); their individuals are
+        matched by name with the individuals of the changed exs of the last upload and updated in
+        place, so the individuals keep their pks (see GroupSetSerializer.update).
+        """
+        individualset, poped_data = _update(instance, validated_data,
+                                            create_multiple_keys=['descriptions', 'comments'],
+                                            pop=["study", "individual_exs"])
+        individual_exs = poped_data["individual_exs"]
+        hashes = [self.content_hash(individual_ex) for individual_ex in individual_exs]
+        unchanged, stale = self.match_exs("individualset", hashes, individualset.individual_exs.all())
+
+        names = {individual["name"]
+                 for individual_ex in individual_exs for individual in individual_ex["individuals"]}
+        individuals_by_name = defaultdict(list)
+        for individual in Individual.objects.filter(ex__in=stale, name__in=names).order_by("pk"):
+            individuals_by_name[individual.name].append(individual)
+
+        study_individual_exs = []
+        changed_exs = []
+        updated_exs = list(stale)
+        for individual_ex, unchanged_ex in zip(individual_exs, unchanged):
+            if unchanged_ex is not None:
+                study_individual_exs.append(unchanged_ex)
+                continue
+            individual_ex.update(
+                {"individual_set": individualset, "individuals_by_name": individuals_by_name})
+            if updated_exs:
+                study_individual_ex = IndividualExSerializer(context=self.context).update(
+                    updated_exs.pop(0), individual_ex)
+            else:
+                study_individual_ex = IndividualExSerializer(context=self.context).create(
+                    validated_data=individual_ex)
+            study_individual_exs.append(study_individual_ex)
+            changed_exs.append(study_individual_ex)
+
+        # individuals of the changed exs which are not uploaded again, and the removed exs
+        individuals = Individual.objects.filter(ex__in=changed_exs)
+        self.delete(Individual.objects.filter(ex__in=stale).exclude(pk__in=individuals))
+        self.delete(IndividualEx.objects.filter(pk__in=[individual_ex.pk for individual_ex in updated_exs]))
+        self.store_ex_hashes("individualset", study_individual_exs, hashes)
+
+        update_characteristica_all_normed(individuals, self.delete)
+        self.record_changes(Individual, individuals.values_list("pk", flat=True))
         return individualset
 
 
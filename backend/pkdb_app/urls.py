@@ -31,7 +31,7 @@ from .studies.views import (
     StudyViewSet,
     ElasticReferenceViewSet,
     ElasticStudyViewSet,
-    update_index_study, PKDataView, StudyAnalysisViewSet,
+    update_index_study, PKDataView, StudyAnalysisViewSet, FilterJobViewSet, UploadJobViewSet,
 )
 from .subjects.views import (
     DataFileViewSet,
@@ -56,6 +56,8 @@ router = DefaultRouter()
 # -----------------------------------------------------------------------------
 router.register("statistics", StatisticsViewSet, basename="statistics")
 router.register("statistics/substances", SubstanceStatisticsViewSet, basename="statistics")
+router.register("filter_jobs", FilterJobViewSet, basename="filter_jobs")
+router.register("upload_jobs", UploadJobViewSet, basename="upload_jobs")
 
 # -----------------------------------------------------------------------------
 # Elastic URLs
@@ -87,6 +87,14 @@ def user_group(user):
     return user_group
 
 
+def access_key(user):
+    """ Key of the studies the user has access to: the group, for basic users also the username. """
+    group = user_group(user)
+    if group == "basic":
+        return f"{group}:{user.username}"
+    return group
+
+
 def get_study_permission(user, obj):
     try:
         allowed_user_modify = (user == obj.creator) or (user in obj.curators)
@@ -3,7 +3,11 @@ Generic utility functions.
 """
 import copy
 import os
+from collections import defaultdict
+
+import numpy as np
 import pandas as pd
+from django.db.models.deletion import Collector
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 
@@ -124,8 +128,61 @@ def create_multiple_bulk(parent, related_name_parent, children, class_child):
 
 def create_multiple_bulk_normalized(notnormalized_instances, model_class):
     if notnormalized_instances:
-        return model_class.objects.bulk_create(
-            [initialize_normed(notnorm_instance) for notnorm_instance in notnormalized_instances])
+        normed_instances = [copy_normed(notnorm_instance) for notnorm_instance in notnormalized_instances]
+        normalize_bulk(normed_instances)
+        # interventions and characteristica have no error measures
+        if hasattr(model_class, "add_error_measures_bulk"):
+            model_class.add_error_measures_bulk(normed_instances)
+        return model_class.objects.bulk_create(normed_instances)
+
+
+def update_multiple_normalized(notnormalized_instances, model_class):
+    """ Updates the normalized instances of updated not normalized instances in place.
+
+    The normalized instances keep their pks, missing normalized instances are created
+    (see create_multiple_bulk_normalized).
+    """
+    normed_pks = dict(
+        model_class.objects.filter(raw__in=notnormalized_instances).values_list("raw_id", "pk"))
+    normed_instances = []
+    for notnorm_instance in notnormalized_instances:
+        normed_instance = copy_normed(notnorm_instance)
+        normed_instance.pk = normed_pks.get(notnorm_instance.pk)
+        normed_instances.append(normed_instance)
+    normalize_bulk(normed_instances)
+    if hasattr(model_class, "add_error_measures_bulk"):
+        model_class.add_error_measures_bulk(normed_instances)
+
+    for normed_instance in normed_instances:
+        if normed_instance.pk is not None:
+            normed_instance.save(force_update=True)
+    model_class.objects.bulk_create(
+        [normed_instance for normed_instance in normed_instances if normed_instance.pk is None])
+    return normed_instances
+
+
+def normalize_bulk(instances):
+    """ Normalizes many instances (see Normalizable.normalize).
+
+    The conversion is resolved once per (measurement_type, unit, substance) and applied to
+    numpy columns of the norm fields of all instances with this combination.
+    """
+    groups = defaultdict(list)
+    for instance in instances:
+        key = (instance.measurement_type_id, instance.unit, getattr(instance, "substance_id", None))
+        groups[key].append(instance)
+
+    for group in groups.values():
+        factor, unit = group[0].norm_conversion
+        if unit == group[0].unit and factor == 1:
+            continue
+        for key in group[0].norm_fields:
+            values = np.array([getattr(instance, key) for instance in group], dtype=float) * factor
+            for instance, value in zip(group, values.tolist()):
+                if getattr(instance, key) is not None:
+                    setattr(instance, key, value)
+        for instance in group:
+            instance.unit = unit
 
 
 def _create(validated_data, model_manager=None, model_serializer=None,
@@ -149,11 +206,63 @@ def _create(validated_data, model_manager=None, model_serializer=None,
     return instance, popped_data
 
 
-def initialize_normed(not_norm_instance):
+def _update(instance, validated_data, keep=[], create_multiple_keys=[], pop=[]):
+    """ Updates the instance in place with the validated data of _create.
+
+    All fields are set from the validated data (fields which are missing are reset), the
+    instances of create_multiple_keys are replaced.
+
+    :param keep: fields of the instance which are kept (e.g. the foreign key of the parent)
+    """
+    popped_data = {related: validated_data.pop(related, []) for related in pop}
+    related_data_create = {related: validated_data.pop(related, []) for related in create_multiple_keys}
+    kept = {field: getattr(instance, field) for field in keep}
+    instance = instance.__class__(pk=instance.pk, **kept, **validated_data)
+    instance.save(force_update=True)
+
+    for key, item in related_data_create.items():
+        getattr(instance, key).all().delete()
+        create_multiple(instance, item, key)
+
+    return instance, popped_data
+
+
+class UploadChanges(object):
+    """ Instances which are changed or deleted by an incremental upload.
+
+    The serializers of the related sets record the pks of the instances they create or update
+    and delete instances via delete, which records the pks of all deleted instances (including
+    the instances deleted by cascades). Only the documents of these instances are updated
+    afterwards (see studies.views.upload_job).
+    """
+
+    def __init__(self):
+        self.changed = defaultdict(set)
+        self.removed = defaultdict(set)
+
+    def change(self, model, pks):
+        self.changed[model].update(pks)
+
+    def delete(self, queryset):
+        """ Deletes the queryset and records the deleted instances. """
+        collector = Collector(using=queryset.db)
+        collector.collect(queryset)
+        for model, instances in collector.data.items():
+            self.removed[model].update(instance.pk for instance in instances)
+        for fast_delete in collector.fast_deletes:
+            self.removed[fast_delete.model].update(fast_delete.values_list("pk", flat=True))
+        collector.delete()
+
+    def touched(self, model) -> bool:
+        """ Instances of the model were changed or deleted. """
+        return bool(self.changed.get(model) or self.removed.get(model))
+
+
+def copy_normed(not_norm_instance):
+    """ Copy of the instance which is saved as its normalized instance (not normalized yet). """
     norm = copy.copy(not_norm_instance)
     norm.pk = None
     norm.normed = True
-    norm.normalize()
     norm.raw_id = not_norm_instance.pk
 
     try:
@@ -165,12 +274,6 @@ def initialize_normed(not_norm_instance):
         norm.group_id = not_norm_instance.group.pk
     except AttributeError:
         pass
-
-    # interventions have no add add_error_measures() because they should have no mean,median,sd,se,cv ...
-    try:
-        norm.add_error_measures()
-    except AttributeError:
-        pass
     return norm
 
 